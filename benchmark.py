@@ -0,0 +1,435 @@
+"""
+오프라인 벤치마크 (GPU, 모델 다운로드, Gemini API 키 없이 실행)
+
+가짜 임베딩(fakes.HashEmbeddings)과 가짜 LLM(fakes.FakeLocationLLM)으로 RAG 파이프라인 각 단계를 측정합니다.
+data/test_data_small.csv를 복제해서 만든 합성 데이터(1만/10만/100만 행)로 규모별 성능을 비교할 수 있습니다.
+
+사용 예:
+    python benchmark.py --rows 10000 100000
+    python benchmark.py --rows 10000 --scenarios retrieval end_to_end --queries 200
+    python benchmark.py --rows 10000 --compare bench_results/이전결과.json
+    python benchmark.py --rows 100000 --scenarios load_db memmap_load retrieval memmap_retrieval recall \\
+        --memmap-dtype int8 --nlist 300
+
+memmap_* 시나리오는 MemmapVectorStore(양자화 memmap)를 Chroma와 같은 데이터로 측정하고,
+recall 시나리오는 float32 정확 검색 결과 대비 Chroma와 memmap 저장소의 recall@5를 계산합니다.
+batch_queries 시나리오는 run_rag_queries(일괄 비동기 처리)를 응답 시간이 들쭉날쭉한 가짜 LLM으로 측정합니다.
+(결과 순서와 항목별 오류가 맞는지는 selfcheck.py에서 확인)
+
+결과는 bench_results/ 아래 JSON으로 저장되고, --compare로 이전 결과와 비교하면
+threshold보다 느려진 항목이 있을 때 종료 코드 1을 돌려줍니다. (배포 전 회귀 확인용)
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+
+SOURCE_CSV = "data/test_data_small.csv"
+SCENARIOS = ("load_split", "create_db", "load_db", "retrieval", "end_to_end", "batch_queries",
+             "memmap_create", "memmap_load", "memmap_retrieval", "recall")
+COLLECTION_NAME = "bench"
+GENERIC_QUERIES = ["강릉 카페", "서울 병원 촬영지", "부산 바다", "드라마 공원", "영화 촬영지 식당"]
+
+
+# 합성 데이터 생성
+def generate_synthetic_csv(n_rows: int, out_dir: str = "./cache/bench", source: str = SOURCE_CSV,
+                           seed: int = 42, chunk_rows: int = 100_000):
+    """
+    원본 CSV 행을 복제해서 n_rows 행짜리 합성 CSV를 만듭니다. (같은 인자면 같은 파일)
+    복제본마다 일련번호를 새로 매기고 제목명/장소명에 번호를 붙이며 위경도를 조금씩 흔듭니다.
+
+    Returns:
+        str: 생성된(또는 이미 있던) CSV 경로.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, f"synthetic_{n_rows}_{seed}.csv")
+    if os.path.exists(path):
+        return path
+
+    base = pd.read_csv(source, encoding="utf-8-sig")
+    rng = np.random.default_rng(seed)
+    tmp_path = path + ".tmp"
+    written = 0
+    # 원본과 같은 형식(BOM이 있는 UTF-8)으로 쓰고, 큰 파일은 chunk_rows 행씩 나눠서 씀
+    with open(tmp_path, "w", encoding="utf-8-sig", newline="") as f:
+        while written < n_rows:
+            size = min(chunk_rows, n_rows - written)
+            positions = np.arange(written, written + size)
+            chunk = base.iloc[positions % len(base)].reset_index(drop=True)
+            copy_no = positions // len(base)
+            suffix = pd.Series(np.where(copy_no > 0, " " + copy_no.astype(str), ""))
+            chunk["일련번호"] = positions + 1
+            chunk["제목명"] = chunk["제목명"] + suffix
+            chunk["장소명"] = chunk["장소명"] + suffix
+            chunk["위치위도"] = (chunk["위치위도"] + rng.normal(0, 0.01, size)).round(6)
+            chunk["위치경도"] = (chunk["위치경도"] + rng.normal(0, 0.01, size)).round(6)
+            chunk.to_csv(f, index=False, header=written == 0)
+            written += size
+    os.replace(tmp_path, path)
+    return path
+
+
+def make_queries(csv_path: str, n_queries: int, seed: int = 42):
+    """데이터의 제목명/장소명과 일반 검색어를 섞어서 검색어 목록을 만듭니다."""
+    frame = pd.read_csv(csv_path, encoding="utf-8-sig", usecols=["제목명", "장소명"], nrows=50_000)
+    rng = random.Random(seed)
+    pool = list(frame["제목명"].dropna().unique()) + list(frame["장소명"].dropna().unique())
+    return [rng.choice(pool) if rng.random() < 0.8 else rng.choice(GENERIC_QUERIES) for _ in range(n_queries)]
+
+
+# 측정 도구
+def _reset_peak_rss():
+    """리눅스면 프로세스 최대 RSS(VmHWM)를 현재 값으로 초기화합니다. (준비 단계 메모리를 빼기 위해)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss 단위: 리눅스 KB, macOS byte
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _latency_stats(latencies: list):
+    values = sorted(latencies)
+    if not values:
+        return {}
+    return {
+        "p50_ms": values[len(values) // 2] * 1000,
+        "p99_ms": values[min(len(values) - 1, int(len(values) * 0.99))] * 1000,
+        "mean_ms": sum(values) / len(values) * 1000,
+    }
+
+
+# 시나리오 (각각 새 프로세스에서 실행해서 최대 RSS가 서로 섞이지 않게 함)
+def _db_path(config):
+    # 합성 CSV 파일마다(행 수 + seed) DB를 따로 둠
+    return os.path.join(config["workdir"], "chroma_" + os.path.splitext(os.path.basename(config["csv_path"]))[0])
+
+
+def _memmap_path(config, dtype=None, nlist=None):
+    dtype = dtype or config["memmap_dtype"]
+    nlist = config["nlist"] if nlist is None else nlist
+    return _db_path(config).replace("chroma_", f"memmap_{dtype}_{nlist}_", 1)
+
+
+def _ensure_memmap(config, rag_funcs, dtype=None, nlist=None):
+    """memmap 저장소가 없으면 만듭니다. (측정에서 제외)"""
+    import fakes
+
+    path = _memmap_path(config, dtype, nlist)
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        splits = rag_funcs.load_csv_and_split_documents(config["csv_path"])
+        rag_funcs.create_memmap_vector_db(splits, path, dtype=dtype or config["memmap_dtype"],
+                                          nlist=config["nlist"] if nlist is None else nlist,
+                                          embeddings=fakes.HashEmbeddings())
+    return path
+
+
+def _recall_at_k(queries: list, results: list, truth: list, embeddings, k: int = 5):
+    """
+    recall@k. 합성 데이터에는 거리가 같은 문서가 많아서, 찾은 문서의 정확한(float32) 거리가
+    정답 k번째 거리 이하이면 맞은 것으로 셉니다.
+    """
+    hits = []
+    for query, found, expected in zip(queries, results, truth):
+        if not expected:
+            continue
+        query_vector = np.asarray(embeddings.embed_query(query), dtype=np.float32)
+        found_vectors = np.asarray(embeddings.embed_documents([doc.page_content for doc in found[:k]]),
+                                   dtype=np.float32).reshape(-1, len(query_vector))
+        distances = ((found_vectors - query_vector) ** 2).sum(axis=1)
+        kth_distance = expected[:k][-1][1]
+        hits.append(np.count_nonzero(distances <= kth_distance + 1e-5) / len(expected[:k]))
+    return sum(hits) / len(hits) if hits else None
+
+
+def _ensure_db(config, rag_funcs):
+    """create_db 이후 시나리오용 벡터 DB가 없으면 만듭니다. (측정에서 제외)"""
+    import fakes
+
+    db_path = _db_path(config)
+    if os.path.exists(os.path.join(db_path, "chroma.sqlite3")):
+        return
+    splits = rag_funcs.load_csv_and_split_documents(config["csv_path"])
+    rag_funcs.create_vector_db_with_hf(splits, db_path=db_path, collection_name=COLLECTION_NAME,
+                                       embeddings=fakes.HashEmbeddings(), embedding_cache_dir=None)
+
+
+def run_scenario(name: str, config: dict):
+    """
+    시나리오 하나를 실행하고 결과 dict를 반환합니다.
+    (ProcessPoolExecutor 자식 프로세스에서 호출됨)
+    """
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+    import rag_funcs
+    import fakes
+    rag_funcs.configure_logging(config["log_level"])
+
+    db_path = _db_path(config)
+    embeddings = fakes.HashEmbeddings()
+    queries = config["queries"]
+    result = {"scenario": name, "rows": config["rows"]}
+    latencies = []
+
+    # 준비 단계 (측정 제외)
+    if name == "create_db":
+        splits = rag_funcs.load_csv_and_split_documents(config["csv_path"])
+        shutil.rmtree(db_path, ignore_errors=True)
+    elif name in ("load_db", "retrieval", "end_to_end", "batch_queries"):
+        _ensure_db(config, rag_funcs)
+    if name in ("retrieval", "end_to_end", "batch_queries"):
+        vector_db = rag_funcs.load_vector_db(db_path, COLLECTION_NAME, embeddings=embeddings)
+    if name in ("memmap_load", "memmap_retrieval", "recall"):
+        memmap_path = _ensure_memmap(config, rag_funcs)
+    if name == "memmap_create":
+        splits = rag_funcs.load_csv_and_split_documents(config["csv_path"])
+        memmap_path = _memmap_path(config)
+        shutil.rmtree(memmap_path, ignore_errors=True)
+    if name == "memmap_retrieval":
+        memmap_db = rag_funcs.load_memmap_vector_db(memmap_path, embeddings=embeddings, nprobe=config["nprobe"])
+    if name == "recall":
+        # 기준: float32 전체 정확 검색
+        _ensure_db(config, rag_funcs)
+        exact_db = rag_funcs.load_memmap_vector_db(_ensure_memmap(config, rag_funcs, "float32", 0),
+                                                   embeddings=embeddings)
+        vector_db = rag_funcs.load_vector_db(db_path, COLLECTION_NAME, embeddings=embeddings)
+        memmap_db = rag_funcs.load_memmap_vector_db(memmap_path, embeddings=embeddings, nprobe=config["nprobe"])
+    if name == "end_to_end":
+        title_index = rag_funcs.build_title_index(rag_funcs.load_csv_documents(config["csv_path"]))
+        llm = fakes.FakeLocationLLM(latency=config["llm_latency"])
+        chain = rag_funcs.get_rag_chain_with_json_output(vector_db, title_index=title_index, llm=llm)
+        rag_funcs.run_rag_query(chain, queries[0])  # 첫 호출 준비 비용 제외
+    if name == "batch_queries":
+        title_index = rag_funcs.build_title_index(rag_funcs.load_csv_documents(config["csv_path"]))
+        # 응답 시간을 들쭉날쭉하게 해서 완료 순서가 입력 순서와 달라지게 함
+        llm = fakes.FakeLocationLLM(latency=config["llm_latency"], slow_rate=0.3,
+                                    slow_latency=config["llm_latency"] + 0.02)
+
+    _reset_peak_rss()
+    started = time.perf_counter()
+    if name == "load_split":
+        splits = rag_funcs.load_csv_and_split_documents(config["csv_path"])
+        result.update(items=len(splits), unit="rows/s", work=config["rows"])
+    elif name == "create_db":
+        rag_funcs.create_vector_db_with_hf(splits, db_path=db_path, collection_name=COLLECTION_NAME,
+                                           embeddings=embeddings, embedding_cache_dir=None)
+        result.update(items=len(splits), unit="chunks/s", work=len(splits))
+    elif name == "load_db":
+        # 첫 로드(콜드)와 반복 로드를 함께 기록
+        for _ in range(config["repeat"]):
+            t0 = time.perf_counter()
+            vector_db = rag_funcs.load_vector_db(db_path, COLLECTION_NAME, embeddings=embeddings)
+            vector_db._collection.count()
+            latencies.append(time.perf_counter() - t0)
+        result.update(first_ms=latencies[0] * 1000, unit="loads/s", work=len(latencies))
+    elif name == "retrieval":
+        for query in queries:
+            t0 = time.perf_counter()
+            vector_db.similarity_search(query, k=5)
+            latencies.append(time.perf_counter() - t0)
+        result.update(unit="queries/s", work=len(queries))
+    elif name == "memmap_create":
+        rag_funcs.create_memmap_vector_db(splits, memmap_path, dtype=config["memmap_dtype"], nlist=config["nlist"],
+                                          embeddings=embeddings)
+        result.update(items=len(splits), unit="chunks/s", work=len(splits),
+                      disk_mb=sum(entry.stat().st_size for entry in os.scandir(memmap_path)) / 2 ** 20)
+    elif name == "memmap_load":
+        for _ in range(config["repeat"]):
+            t0 = time.perf_counter()
+            memmap_db = rag_funcs.load_memmap_vector_db(memmap_path, embeddings=embeddings, nprobe=config["nprobe"])
+            latencies.append(time.perf_counter() - t0)
+        result.update(first_ms=latencies[0] * 1000, unit="loads/s", work=len(latencies))
+    elif name == "memmap_retrieval":
+        for query in queries:
+            t0 = time.perf_counter()
+            memmap_db.similarity_search(query, k=5)
+            latencies.append(time.perf_counter() - t0)
+        result.update(unit="queries/s", work=len(queries))
+    elif name == "recall":
+        truth = [exact_db.similarity_search_with_score(query, k=5) for query in queries]
+        chroma_found = [vector_db.similarity_search(query, k=5) for query in queries]
+        memmap_found = [memmap_db.similarity_search(query, k=5) for query in queries]
+        result.update(
+            recall_chroma=_recall_at_k(queries, chroma_found, truth, embeddings),
+            recall_memmap=_recall_at_k(queries, memmap_found, truth, embeddings),
+            memmap=f"{config['memmap_dtype']}/nlist={config['nlist']}/nprobe={config['nprobe']}",
+            unit="queries/s", work=len(queries) * 3,
+        )
+    elif name == "end_to_end":
+        for query in queries:
+            t0 = time.perf_counter()
+            rag_funcs.run_rag_query(chain, query)
+            latencies.append(time.perf_counter() - t0)
+        result.update(unit="queries/s", work=len(queries))
+    elif name == "batch_queries":
+        batch = rag_funcs.run_rag_queries(queries, vector_db, llm=llm, concurrency=8, requests_per_minute=None,
+                                          title_index=title_index)
+        latencies = [item["seconds"] for item in batch if item["seconds"] is not None]
+        result.update(unit="queries/s", work=len(queries), errors=sum(item["error"] is not None for item in batch))
+    else:
+        raise ValueError(f"알 수 없는 시나리오: {name}")
+    seconds = time.perf_counter() - started
+
+    result.update(seconds=seconds, throughput=result["work"] / seconds if seconds else None,
+                  peak_rss_mb=_peak_rss_mb(), **_latency_stats(latencies))
+    return result
+
+
+def run_isolated(name: str, config: dict):
+    """시나리오를 새 프로세스(spawn)에서 실행합니다."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(run_scenario, name, config).result()
+
+
+# 결과 저장 / 비교
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results: list, args, out_path: str = None):
+    revision = _git_revision()
+    if out_path is None:
+        os.makedirs("bench_results", exist_ok=True)
+        out_path = os.path.join("bench_results", f"{time.strftime('%Y%m%d-%H%M%S')}_{revision or 'norev'}.json")
+    payload = {
+        "meta": {
+            "revision": revision,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {key: value for key, value in vars(args).items() if key != "compare"},
+        },
+        "results": results,
+    }
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+    return out_path
+
+
+# 값이 클수록 좋은 항목(처리량)과 작을수록 좋은 항목(지연 시간, 메모리)
+_HIGHER_IS_BETTER = ("throughput", "recall_chroma", "recall_memmap")
+_LOWER_IS_BETTER = ("p50_ms", "p99_ms", "peak_rss_mb")
+
+
+def compare_results(baseline: dict, current: list, threshold: float = 0.1):
+    """
+    이전 결과 파일(baseline)과 비교해서 항목별 변화율을 출력합니다.
+
+    Returns:
+        list: threshold보다 나빠진 (시나리오, 행 수, 항목, 변화율) 리스트.
+    """
+    previous = {(r["scenario"], r["rows"]): r for r in baseline["results"]}
+    regressions = []
+    print(f"\n비교 기준: {baseline['meta'].get('revision')} ({baseline['meta'].get('created_at')})")
+    for result in current:
+        before = previous.get((result["scenario"], result["rows"]))
+        if before is None:
+            continue
+        for metric in _HIGHER_IS_BETTER + _LOWER_IS_BETTER:
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if metric in _HIGHER_IS_BETTER else change
+            flag = "  <-- 회귀" if worse > threshold else ""
+            print(f"  {result['scenario']:<16} {result['rows']:>9,}  {metric:<12} "
+                  f"{old:12.2f} -> {new:12.2f}  ({change:+.1%}){flag}")
+            if worse > threshold:
+                regressions.append((result["scenario"], result["rows"], metric, change))
+    return regressions
+
+
+def print_results(results: list):
+    print(f"\n{'scenario':<16} {'rows':>9}  {'seconds':>9}  {'throughput':>18}  "
+          f"{'p50 ms':>9}  {'p99 ms':>9}  {'peak MB':>8}")
+    for r in results:
+        p50 = f"{r['p50_ms']:9.2f}" if "p50_ms" in r else f"{'-':>9}"
+        p99 = f"{r['p99_ms']:9.2f}" if "p99_ms" in r else f"{'-':>9}"
+        print(f"{r['scenario']:<16} {r['rows']:>9,}  {r['seconds']:9.2f}  "
+              f"{r['throughput']:>8.1f} {r['unit']:<9}  {p50}  {p99}  {r['peak_rss_mb']:8.1f}")
+        if r["scenario"] == "recall":
+            print(f"{'':<16} recall@5  chroma={r['recall_chroma']:.3f}  memmap({r['memmap']})={r['recall_memmap']:.3f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="가짜 모델로 RAG 파이프라인 성능 측정")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000],
+                        help="합성 데이터 행 수 (예: 10000 100000 1000000)")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--queries", type=int, default=100, help="retrieval/end_to_end/batch_queries 검색어 수")
+    parser.add_argument("--repeat", type=int, default=5, help="load_db 반복 횟수")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="가짜 LLM 응답 지연(초)")
+    parser.add_argument("--memmap-dtype", choices=("float32", "float16", "int8"), default="float16",
+                        help="memmap_* 시나리오 저장 정밀도")
+    parser.add_argument("--nlist", type=int, default=0, help="memmap IVF 클러스터 수 (0이면 정확 검색)")
+    parser.add_argument("--nprobe", type=int, default=8, help="memmap IVF 검색 클러스터 수")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workdir", default="./cache/bench", help="합성 CSV와 벤치마크용 DB 경로")
+    parser.add_argument("--out", help="결과 JSON 경로 (기본: bench_results/<시각>_<git 리비전>.json)")
+    parser.add_argument("--compare", help="비교할 이전 결과 JSON")
+    parser.add_argument("--threshold", type=float, default=0.1, help="회귀로 볼 변화율 (기본 10%%)")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args(argv)
+
+    results = []
+    for n_rows in args.rows:
+        csv_path = generate_synthetic_csv(n_rows, out_dir=args.workdir, seed=args.seed)
+        config = {
+            "rows": n_rows,
+            "csv_path": csv_path,
+            "workdir": args.workdir,
+            "queries": make_queries(csv_path, args.queries, seed=args.seed),
+            "repeat": args.repeat,
+            "llm_latency": args.llm_latency,
+            "log_level": args.log_level,
+            "memmap_dtype": args.memmap_dtype,
+            "nlist": args.nlist,
+            "nprobe": args.nprobe,
+        }
+        for name in SCENARIOS:
+            if name in args.scenarios:
+                print(f"[{n_rows:,} rows] {name} ...", flush=True)
+                results.append(run_isolated(name, config))
+
+    print_results(results)
+    out_path = save_results(results, args, args.out)
+    print(f"\n결과 저장: {out_path}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare_results(json.load(f), results, args.threshold)
+        if regressions:
+            print(f"\n회귀 {len(regressions)}건 (threshold {args.threshold:.0%})")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""
+테스트/벤치마크용 가짜 백엔드 (모델 다운로드, API 키 없이 실행)
+
+benchmark.py, replay.py, materialize.py의 오프라인 실행(--fake 등)에서 사용합니다.
+앱(feelko_googleapi.py)은 이 모듈을 불러오지 않습니다.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+from typing import Any
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+from pydantic import PrivateAttr
+
+import rag_funcs
+
+
+class HashEmbeddings(Embeddings):
+    """
+    글자 n-gram 해시로 만드는 결정적(deterministic) 임베딩.
+    글자가 많이 겹치는 텍스트끼리 비슷한 벡터가 나오므로 검색 흐름을 흉내 낼 수 있습니다.
+    """
+
+    def __init__(self, size: int = 256, ngram: int = 2):
+        self.size = size
+        self.ngram = ngram
+
+    def _embed(self, text: str):
+        vector = np.zeros(self.size, dtype=np.float32)
+        text = " ".join(text.split())
+        for i in range(max(1, len(text) - self.ngram + 1)):
+            digest = hashlib.md5(text[i:i + self.ngram].encode("utf-8")).digest()
+            vector[int.from_bytes(digest[:4], "little") % self.size] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: list):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str):
+        return self._embed(text)
+
+
+class FakeLocationLLM(LLM):
+    """
+    프롬프트의 맥락에서 장소 행을 골라 LocationInfo JSON 배열을 돌려주는 가짜 LLM.
+    latency초 만큼 기다린 뒤 응답합니다. (비동기 호출은 asyncio.sleep)
+    LLMGuard 확인용으로 느린 응답과 오류를 섞을 수 있습니다.
+        slow_rate 확률로, 또는 처음 slow_first번은 무조건 slow_latency초를 더 기다림 (꼬리 지연)
+        error_rate 확률로, 또는 처음 fail_first번은 무조건 RuntimeError (지연 후 실패)
+    """
+
+    latency: float = 0.0
+    count: int = 2
+    slow_rate: float = 0.0
+    slow_latency: float = 0.0
+    slow_first: int = 0
+    error_rate: float = 0.0
+    fail_first: int = 0
+    _calls: int = PrivateAttr(default=0)
+    _calls_lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self):
+        return "fake-location"
+
+    def _next_call(self):
+        """(이번 호출 지연 시간, 실패 여부)"""
+        with self._calls_lock:
+            self._calls += 1
+            call = self._calls
+        slow = call <= self.slow_first or random.random() < self.slow_rate
+        delay = self.latency + (self.slow_latency if slow else 0.0)
+        return delay, call <= self.fail_first or random.random() < self.error_rate
+
+    @property
+    def calls(self):
+        return self._calls
+
+    def _answer(self, prompt: str):
+        # stuff 체인은 문서를 빈 줄로 구분해서 넣으므로 블록 하나를 한 행으로 봄
+        context = prompt.split("맥락:", 1)[-1].split("질문:", 1)[0]
+        docs = [Document(page_content=block, metadata={"row": i}) for i, block in enumerate(context.split("\n\n"))]
+        locations = rag_funcs.build_location_infos(docs, count=self.count)
+        return "```json\n" + json.dumps([location.model_dump() for location in locations],
+                                         ensure_ascii=False, indent=2) + "\n```"
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+        delay, fail = self._next_call()
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise RuntimeError("fake LLM error")
+        return self._answer(prompt)
+
+    async def _acall(self, prompt, stop=None, run_manager=None, **kwargs):
+        delay, fail = self._next_call()
+        if delay:
+            await asyncio.sleep(delay)
+        if fail:
+            raise RuntimeError("fake LLM error")
+        return self._answer(prompt)
@@ -2,85 +2,228 @@ import streamlit as st
 from streamlit_chat import message
 import base64
 import io
+import itertools
+import os
+import time
+from collections import deque, namedtuple
+
+_import_started = time.perf_counter()
 import rag_funcs
+RAG_FUNCS_IMPORT_SECONDS = time.perf_counter() - _import_started
+
 from streamlit_modal import Modal
 import streamlit.components.v1 as components
 
-# 1. 벡터 DB 객체 생성 (생성되어 있는 벡터 db 로딩)
-vector_db = rag_funcs.load_vector_db()
+DATA_FILE_PATH = 'data/test_data_small.csv'
 
-# 2. RAG 체인 구성
-rag_chain = rag_funcs.get_rag_chain_with_json_output(vector_db)
+# 콘솔 로그 (FEELKO_LOG_LEVEL=DEBUG면 검색된 맥락까지 출력)
+logger = rag_funcs.configure_logging()
+tracer = rag_funcs.get_tracer()
+# 검색 요청마다 검색어/경로/단계별 시간/토큰 수/결과를 logs/requests.jsonl에 한 줄씩 기록 (replay.py 입력)
+rag_funcs.enable_query_log()
+
+
+# Streamlit은 상호작용마다 스크립트를 다시 실행하므로,
+# 무거운 객체는 cache_resource + 공유 ResourceManager로 프로세스당 한 번만 만든다.
+@st.cache_resource(show_spinner="검색 엔진을 준비하고 있습니다...")
+def load_shared_resources():
+    manager = rag_funcs.get_resource_manager()
+    manager.timings["import_rag_funcs"] = RAG_FUNCS_IMPORT_SECONDS
+
+    # 1. 벡터 DB 객체 생성 (생성되어 있는 벡터 db 로딩)
+    vector_db = manager.vectorstore()
+
+    # 2. 제목 인덱스 구성 (제목 검색어는 벡터 검색 없이 바로 찾음)
+    row_documents = manager.get("row_documents", lambda: rag_funcs.load_csv_documents(DATA_FILE_PATH))
+    title_index = manager.get("title_index", lambda: rag_funcs.build_title_index(row_documents))
+
+    # 검색어에서 드라마/영화, 지역, 장소유형 조건을 뽑아 메타데이터 필터로 사용
+    filter_extractor = manager.get(
+        "filter_extractor",
+        lambda: rag_funcs.build_query_filter_extractor(row_documents, title_index=title_index)
+    )
+
+    # 3. 답변 캐시 (같은 검색어는 Gemini 호출 없이 바로 응답)
+    answer_cache = manager.get(
+        "answer_cache",
+        lambda: rag_funcs.AnswerCache(collection_version=rag_funcs.get_collection_version(vector_db))
+    )
+
+    # 4. 제목별 미리 만든 답변 (materialize.py로 생성, 제목 검색어는 Gemini 호출 없이 응답)
+    precomputed_answers = manager.get(
+        "precomputed_answers",
+        lambda: rag_funcs.PrecomputedAnswerStore(title_index=title_index)
+    )
+
+    # 5. 주변 촬영지 검색용 공간 인덱스
+    geo_index = manager.get("geo_index", lambda: rag_funcs.build_geo_index(DATA_FILE_PATH))
+
+    # 6. 워밍업 (첫 사용자가 모델 로딩 시간을 기다리지 않도록)
+    manager.warm_up()
+    return manager, vector_db, title_index, filter_extractor, answer_cache, precomputed_answers, geo_index
+
+
+(resource_manager, vector_db, title_index, filter_extractor, answer_cache, precomputed_answers,
+ geo_index) = load_shared_resources()
+
+
+# 결과 장소 주변(반경 2km)의 다른 촬영지 목록
+def nearby_spots_text(data, radius_km=2.0, limit=3):
+    try:
+        lat, lon = float(data.get('위도')), float(data.get('경도'))
+    except (TypeError, ValueError):
+        return ""
+    if not lat and not lon:
+        return ""
+    spots = [
+        spot for spot in geo_index.radius(lat, lon, radius_km, limit=limit + 1)
+        if spot['장소명'] != data.get('장소')
+    ][:limit]
+    return ", ".join(f"{spot['장소명']}({spot['제목명']}, {spot['distance_km']:.1f}km)" for spot in spots)
+
+
+# Gemini 호출별 입력/출력 토큰 수 기록 (맥락 압축 효과 확인용)
+def get_token_usage():
+    return resource_manager.get("token_usage", rag_funcs.TokenUsageCallbackHandler)
+
+
+# Gemini 호출 보호 정책 (마감 시간을 넘기거나 연속 실패하면 검색 결과로 바로 답변)
+# FEELKO_LLM_DEADLINE(초, 기본 8), FEELKO_LLM_HEDGE=1이면 느린 응답에 헤지 요청 (Gemini 호출 수가 늘어남)
+def get_llm_guard():
+    return resource_manager.get("llm_guard", lambda: rag_funcs.LLMGuard(
+        deadline=float(os.getenv("FEELKO_LLM_DEADLINE", "8")),
+        hedge=os.getenv("FEELKO_LLM_HEDGE") == "1",
+    ))
+
+
+# RAG 체인 구성 (답변 방식/개수/검색 방식별로 한 번만 만들어 공유)
+def get_rag_chain(answer_mode, answer_count, retrieval_mode="vector", ranking="retrieval"):
+    # 하이브리드 검색용 BM25 어휘 색인 (처음 선택될 때 한 번만 구성)
+    lexical_index = None
+    if retrieval_mode == "hybrid":
+        lexical_index = resource_manager.get("lexical_index", lambda: rag_funcs.build_lexical_index(vector_db))
+
+    if answer_mode == "llm":
+        # LLM 모드는 프롬프트에 장소 개수가 들어있어 개수와 무관하게 체인 하나를 공유
+        return resource_manager.get(
+            ("rag_chain", "llm", retrieval_mode),
+            lambda: rag_funcs.get_rag_chain_with_json_output(
+                vector_db, title_index=title_index, llm=resource_manager.llm(),
+                filter_extractor=filter_extractor, retrieval_mode=retrieval_mode, lexical_index=lexical_index,
+                token_usage=get_token_usage(), llm_guard=get_llm_guard()
+            )
+        )
+    return resource_manager.get(
+        ("rag_chain", answer_mode, answer_count, retrieval_mode, ranking),
+        lambda: rag_funcs.get_rag_chain_with_json_output(
+            vector_db, title_index=title_index, answer_mode=answer_mode, answer_count=answer_count,
+            filter_extractor=filter_extractor, retrieval_mode=retrieval_mode, lexical_index=lexical_index,
+            ranking=ranking
+        )
+    )
+
+# 대화 기록: 세션마다 최근 CHAT_HISTORY_LIMIT개 대화만 보관하고, 화면에는 최신 대화와
+# "이전 대화 더 보기"로 펼친 페이지만 그린다. (대화가 길어져도 재실행 시간이 늘지 않도록)
+# 답변은 완성된 문자열 대신 LocationInfo 필드 순서의 값 튜플로 저장하고, 그릴 때 문자열로 만든다.
+CHAT_HISTORY_LIMIT = int(os.getenv("FEELKO_CHAT_HISTORY_LIMIT", "30"))
+CHAT_HISTORY_PAGE_SIZE = 5
+LOCATION_FIELDS = tuple(rag_funcs.LocationInfo.model_fields)
+ChatTurn = namedtuple("ChatTurn", ["turn_id", "query", "locations", "note"])
+
+
+# 챗봇 응답을 대화 기록용 (장소 값 튜플들, 안내 문구)로 변환하는 함수
+def compact_chatbot_response(chatbot_response):
+    """챗봇 응답을 안전하게 파싱해서 (장소 튜플들, 안내 문구)로 반환"""
+
+    note = ""
+    if isinstance(chatbot_response, rag_funcs.FallbackAnswer):
+        # Gemini가 늦거나 실패해서 검색된 데이터로 바로 만든 답변임을 표시
+        note = "(AI 요약이 지연되어 검색된 촬영지 정보를 그대로 보여드립니다.)"
 
-# 웹에 출력한 데이터 추출 함수
-def format_chatbot_response(chatbot_response):
-    """챗봇 응답을 안전하게 포맷팅"""
-    
-    print_datas = ""
-    
     try:
-        # print(type(chatbot_response))
-        # print(chatbot_response)
-        # JSON 문자열인 경우 파싱
-    # 기존 코드에서 이 부분만 수정
         if isinstance(chatbot_response, str):
-            import re
-            # 마크다운 코드블록 제거 (이 2줄만 추가!)
-            pattern = r'```(?:json)?\s*(.*?)\s*```'
-            match = re.search(pattern, chatbot_response, re.DOTALL)
-            if match:
-                chatbot_response = match.group(1).strip()
-            import ast
-            chatbot_response =  ast.literal_eval(chatbot_response)
-        
+            # 코드블록/앞뒤 문장이 섞여 있어도 온전한 객체만 골라서 파싱
+            parsed = rag_funcs.parse_location_json(chatbot_response)
+            if not parsed:
+                raise ValueError("장소 정보를 찾을 수 없습니다.")
+            chatbot_response = parsed
+
         # 단일 객체인 경우 리스트로 변환
         elif isinstance(chatbot_response, dict):
             chatbot_response = [chatbot_response]
 
-        print(type(chatbot_response))
-        print(chatbot_response)
-        # 리스트 처리
-        if isinstance(chatbot_response, list):
-
-            # 모달 트리거를 위한 세션 상태 초기화
-            st.session_state.modal_data = None
-
-            for i, data in enumerate(chatbot_response, 1):
-                if isinstance(data, dict):
-                     # Google Maps URL 생성
-                    place = data.get('장소', 'N/A')
-                    address = data.get('주소', 'N/A')
-                    
-                    # URL 인코딩을 위해 place와 address를 URL 쿼리 문자열로 변환
-                    # '+' 대신 '%20'을 사용해도 되지만, Google Maps는 '+'를 잘 처리합니다.
-                    query = f"{place} {address}".replace(" ", "+")
-                    map_url = f"https://www.google.com/maps/search/?api=1&query={query}"
-
-                    # Markdown 형식의 링크 추가
-                    # `st.markdown`을 사용하기 위해 문자열을 구성합니다.
-                    print_datas += f"=== 결과 {i} ===\n"
-                    print_datas += f"장소: {data.get('장소', 'N/A')}\n"
-
-                    # 장소에 하이퍼링크를 추가합니다.
-                    #print_datas += f"장소: [{place}]({map_url})\n"# 장소 옆에 버튼 추가
-                    
-                    
-                    print_datas += f"주소: {data.get('주소', 'N/A')}\n"
-                    print_datas += f"장면설명: {data.get('장면_설명', 'N/A')}\n"
-                    print_datas += f"장소설명: {data.get('장소_설명', 'N/A')}\n"
-                    print_datas += "\n"
-
-                else:
-                    print_datas += f"결과 {i}: {data}\n\n"
-        else:
-            print_datas = f"예상하지 못한 응답 형식:\n{chatbot_response}"
-            
+        logger.debug("%s %s", type(chatbot_response), chatbot_response)
+        if not isinstance(chatbot_response, list):
+            return (), f"예상하지 못한 응답 형식:\n{str(chatbot_response)[:500]}"
+        locations = tuple(
+            tuple(data.get(field, 'N/A') for field in LOCATION_FIELDS)
+            for data in chatbot_response if isinstance(data, dict)
+        )
+        return locations, note
+
     except Exception as e:
-        print_datas = f"응답 처리 중 오류: {e}\n원본 응답: {chatbot_response}"
-    
+        return (), f"응답 처리 중 오류: {e}\n원본 응답: {str(chatbot_response)[:500]}"
+
+
+# 웹에 출력할 대화 한 건의 답변 문자열을 만드는 함수
+def format_chat_turn(turn):
+    print_datas = f"{turn.note}\n\n" if turn.note else ""
+
+    for i, values in enumerate(turn.locations, 1):
+        data = dict(zip(LOCATION_FIELDS, values))
+        # Google Maps URL 생성
+        place = data.get('장소', 'N/A')
+        address = data.get('주소', 'N/A')
+
+        # URL 인코딩을 위해 place와 address를 URL 쿼리 문자열로 변환
+        # '+' 대신 '%20'을 사용해도 되지만, Google Maps는 '+'를 잘 처리합니다.
+        query = f"{place} {address}".replace(" ", "+")
+        map_url = f"https://www.google.com/maps/search/?api=1&query={query}"
+
+        # Markdown 형식의 링크 추가
+        # `st.markdown`을 사용하기 위해 문자열을 구성합니다.
+        print_datas += f"=== 결과 {i} ===\n"
+        print_datas += f"장소: {data.get('장소', 'N/A')}\n"
+
+        # 장소에 하이퍼링크를 추가합니다.
+        #print_datas += f"장소: [{place}]({map_url})\n"# 장소 옆에 버튼 추가
+
+        print_datas += f"주소: {data.get('주소', 'N/A')}\n"
+        print_datas += f"장면설명: {data.get('장면_설명', 'N/A')}\n"
+        print_datas += f"장소설명: {data.get('장소_설명', 'N/A')}\n"
+        nearby = nearby_spots_text(data)
+        if nearby:
+            print_datas += f"주변 촬영지: {nearby}\n"
+        print_datas += "\n"
+
     return print_datas
 
 
+def render_chat_turn(turn):
+    message(turn.query, is_user=True, key=f"{turn.turn_id}_user")
+    message(format_chat_turn(turn), key=str(turn.turn_id))
+
+
+def show_more_history():
+    st.session_state['history_pages'] += 1
+
+
+def collapse_history():
+    st.session_state['history_pages'] = 0
+
+
+# 스트리밍 중 장소 카드 하나를 바로 그리는 함수
+def render_location_card(i, data):
+    with st.container(border=True):
+        st.markdown(f"**결과 {i}. {data.get('장소', 'N/A')}**")
+        st.caption(data.get('주소', 'N/A'))
+        st.write(f"장면설명: {data.get('장면_설명', 'N/A')}")
+        st.write(f"장소설명: {data.get('장소_설명', 'N/A')}")
+        nearby = nearby_spots_text(data)
+        if nearby:
+            st.caption(f"주변 촬영지: {nearby}")
+
+
 # Helper Function to Encode Image
 def get_img_as_base64(file_path):
     try:
@@ -240,13 +383,12 @@ def create_header():
 create_header()
 st.markdown("---")
 
-# 화면에 보여주기 위해 챗봇의 답변을 저장할 공간 할당
-if 'generated' not in st.session_state:
-    st.session_state['generated'] = []
-
-# 화면에 보여주기 위해 사용자의 질문을 저장할 공간 할당
-if 'past' not in st.session_state:
-    st.session_state['past'] = []
+# 화면에 보여주기 위해 사용자의 질문과 챗봇의 답변을 저장할 공간 할당 (최근 CHAT_HISTORY_LIMIT개)
+if 'history' not in st.session_state:
+    st.session_state['history'] = deque(maxlen=CHAT_HISTORY_LIMIT)
+    st.session_state['next_turn_id'] = 0
+    # 펼쳐 보고 있는 이전 대화 페이지 수 (0이면 최신 대화만)
+    st.session_state['history_pages'] = 0
 
 # 사용자의 입력이 들어오면 user_input에 저장하고 Send 버튼을 클릭하면
 # submitted의 값이 True로 변환.
@@ -254,6 +396,18 @@ if 'past' not in st.session_state:
 #     user_input = st.text_input('여행하고 싶은 드라마 명장면 여행지를 입력해 주세요.!', '', key='input')
 #     submitted = st.form_submit_button('Send')
 
+# 답변 방식 선택 (빠른 검색은 Gemini 호출 없이 CSV 데이터로 바로 응답)
+ANSWER_MODE_LABELS = {"AI 요약 (Gemini)": "llm", "빠른 검색": "retrieval"}
+# 하이브리드는 벡터 검색에 장소명/배우 이름 같은 글자 일치(BM25) 검색을 합친 방식
+RETRIEVAL_MODE_LABELS = {"벡터 검색": "vector", "하이브리드 (벡터 + 키워드)": "hybrid"}
+# 빠른 검색 결과 정렬 기준 (AI 요약은 Gemini가 장소를 고르므로 적용되지 않음)
+RANKING_LABELS = {"검색 관련도순": "retrieval", "최근 수정순": "recent", "장면 설명이 자세한 순": "detailed"}
+with st.sidebar:
+    answer_mode = ANSWER_MODE_LABELS[st.radio('답변 방식', options=list(ANSWER_MODE_LABELS))]
+    answer_count = st.slider('장소 개수', min_value=1, max_value=5, value=2, disabled=answer_mode == "llm")
+    retrieval_mode = RETRIEVAL_MODE_LABELS[st.radio('검색 방식', options=list(RETRIEVAL_MODE_LABELS))]
+    ranking = RANKING_LABELS[st.selectbox('정렬 기준', options=list(RANKING_LABELS), disabled=answer_mode == "llm")]
+
 st.text("여행하고 싶은 드라마 명장면 장소를 찾아줍니다.!")
 with st.form('form', clear_on_submit=True):
     col1, col2 = st.columns([5, 1])
@@ -272,20 +426,89 @@ with st.form('form', clear_on_submit=True):
 # submitted의 값이 True면 챗봇이 답변을 하기 시작
 if submitted and user_input:
     
-    # 생성한 프롬프트를 기반으로 챗봇 답변을 생성
-    chatbot_response = rag_funcs.run_rag_query(rag_chain, user_input)
-
-    # 웹에 출력한 데이터 추출 실행
-    print_datas = format_chatbot_response(chatbot_response)
-    print(print_datas)
-        
-
-    # 화면에 보여주기 위해 사용자의 질문과 챗봇의 답변을 각각 저장
-    st.session_state['past'].append(user_input)
-    st.session_state['generated'].append(print_datas)
-
-# 챗봇의 답변이 있으면 사용자의 질문과 챗봇의 답변을 가장 최근의 순서로 화면에 출력
-if st.session_state['generated']:
-    for i in reversed(range(len(st.session_state['generated']))):
-        message(st.session_state['past'][i], is_user=True, key=str(i) + '_user')
-        message(st.session_state['generated'][i], key=str(i))
\ No newline at end of file
+    # 요청 전체(검색 ~ 화면 출력)를 span 하나로 묶어 단계별 시간을 기록
+    with tracer.span("request", query=user_input, answer_mode=answer_mode, retrieval_mode=retrieval_mode):
+        # 생성한 프롬프트를 기반으로 챗봇 답변을 생성
+        query_started = time.perf_counter()
+        rag_chain = get_rag_chain(answer_mode, answer_count, retrieval_mode, ranking)
+
+        # 장소 객체가 완성되는 대로 카드로 보여주고, 끝나면 대화 기록으로 옮김
+        live_results = st.empty()
+        chatbot_response = None
+        with live_results.container():
+            with st.spinner("촬영지를 찾고 있습니다..."):
+                n_locations = 0
+                render_seconds = 0.0
+                # 빠른 검색은 이미 충분히 빠르므로 답변 캐시를 쓰지 않음
+                # (검색 방식 등 체인 구성은 캐시 키에 들어가서 벡터/하이브리드 답변이 섞이지 않음)
+                use_cache = answer_mode == "llm"
+                # 제목 검색어는 검색 방식과 상관없이 같은 행을 맥락으로 쓰므로 미리 만든 답변을 그대로 사용
+                for event in rag_funcs.run_rag_query_stream(
+                    rag_chain, user_input, cache=answer_cache if use_cache else None,
+                    precomputed=precomputed_answers if answer_mode == "llm" else None
+                ):
+                    if event["type"] == "location":
+                        n_locations += 1
+                        if n_locations == 1:
+                            logger.info(f"첫 결과까지: {time.perf_counter() - query_started:.2f}s")
+                        render_started = time.perf_counter()
+                        render_location_card(n_locations, event["data"])
+                        render_seconds += time.perf_counter() - render_started
+                    elif event["type"] == "done":
+                        chatbot_response = event["answer"]
+        live_results.empty()
+        tracer.record_span("render", render_seconds, locations=n_locations)
+        resource_manager.record_query_latency(time.perf_counter() - query_started)
+        logger.info(f"지연 시간: {resource_manager.latency_report()}")
+        if answer_mode == "llm":
+            logger.info(f"토큰 사용량: {get_token_usage().report()}")
+
+        # 모달 트리거를 위한 세션 상태 초기화
+        st.session_state.modal_data = None
+
+        # 화면에 보여주기 위해 사용자의 질문과 챗봇의 답변(장소 값 튜플)을 함께 저장
+        locations, note = compact_chatbot_response(chatbot_response)
+        st.session_state['history'].append(ChatTurn(st.session_state['next_turn_id'], user_input, locations, note))
+        st.session_state['next_turn_id'] += 1
+        # 새 질문을 하면 이전 대화는 다시 접어서 최신 대화만 그림
+        st.session_state['history_pages'] = 0
+
+# 챗봇의 답변이 있으면 최신 대화와 펼친 페이지만큼의 이전 대화를 가장 최근의 순서로 화면에 출력
+history = st.session_state['history']
+if history:
+    older = len(history) - 1
+    shown = min(older, st.session_state['history_pages'] * CHAT_HISTORY_PAGE_SIZE)
+    for turn in itertools.islice(reversed(history), shown + 1):
+        render_chat_turn(turn)
+    if shown < older:
+        st.button(f'이전 대화 더 보기 ({older - shown}개)', on_click=show_more_history)
+    elif shown:
+        st.button('이전 대화 접기', on_click=collapse_history)
+
+
+# 디버그 패널: 단계별 지연 시간 (p50/p95/p99), 마지막 요청의 span, Prometheus 형식
+with st.sidebar:
+    if st.checkbox('디버그 정보 보기'):
+        summary = rag_funcs.span_histogram.summary()
+        if summary:
+            st.caption('단계별 지연 시간 (ms)')
+            st.dataframe([
+                {"단계": name, "횟수": stats["count"],
+                 **{key: round(stats[key] * 1000, 1) for key in ("p50", "p95", "p99")}}
+                for name, stats in sorted(summary.items())
+            ], hide_index=True)
+
+            spans = rag_funcs.span_histogram.last_trace()
+            depth = {}
+            for span in spans:
+                depth[span["span_id"]] = depth.get(span["parent_id"], -1) + 1
+            st.caption('마지막 요청')
+            st.text("\n".join(
+                f"{'  ' * depth[span['span_id']]}{span['name']}  {span['duration'] * 1000:.1f}ms"
+                for span in spans
+            ))
+            st.caption(f"Gemini 호출 보호: {get_llm_guard().report()}")
+            with st.expander('Prometheus'):
+                st.code(rag_funcs.span_histogram.prometheus_text(), language="text")
+        else:
+            st.caption('아직 기록된 요청이 없습니다.')
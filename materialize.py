@@ -0,0 +1,95 @@
+"""
+제목별 답변 미리 만들기 (배치 작업)
+
+데이터의 제목명마다 앱과 같은 RAG 체인(get_rag_chain_with_json_output)을 한 번씩 실행하고,
+LocationInfo 형식으로 검증된 답변을 cache/precomputed_answers.sqlite3에 저장합니다.
+앱은 검색어가 제목을 가리키면 Gemini를 호출하지 않고 이 답변을 바로 보여줍니다.
+
+- 중간에 끊겨도 다시 실행하면 저장되지 않은 제목부터 이어서 진행합니다.
+- 제목의 행 내용이 바뀐 경우에만 다시 만들고, 프롬프트/모델이 바뀌면 전체를 새 버전으로 만듭니다.
+- 검증에 실패한 제목은 저장하지 않고 다음 실행에서 다시 시도합니다.
+
+사용 예:
+    python materialize.py
+    python materialize.py --titles "슬기로운 의사생활" "18 어게인" --force
+    python materialize.py --prune
+    python materialize.py --fake --store /tmp/precomputed.sqlite3
+"""
+import argparse
+import json
+import os
+import sys
+
+DATA_FILE_PATH = "data/test_data_small.csv"
+COLLECTION_NAME = "materialize"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="제목별 RAG 답변을 미리 만들어 저장")
+    parser.add_argument("--csv", default=DATA_FILE_PATH, help="제목 목록과 행 해시를 만들 CSV")
+    parser.add_argument("--store", default="./cache/precomputed_answers.sqlite3", help="답변 저장소 경로")
+    parser.add_argument("--titles", nargs="+", help="처리할 제목 (기본: 전체)")
+    parser.add_argument("--limit", type=int, help="이번 실행에서 처리할 최대 제목 수")
+    parser.add_argument("--force", action="store_true", help="저장된 답변이 있어도 다시 만듦")
+    parser.add_argument("--prune", action="store_true", help="데이터에 없는 제목과 이전 버전 답변 삭제")
+    parser.add_argument("--rpm", type=float, help="분당 LLM 호출 한도 (기본: Gemini 무료 등급 한도, --fake면 제한 없음)")
+    parser.add_argument("--fake", action="store_true", help="가짜 임베딩/가짜 LLM 사용 (API 키 불필요, 동작 확인용)")
+    parser.add_argument("--workdir", default="./cache/materialize", help="--fake 벡터 DB 경로")
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args(argv)
+
+    if args.fake:
+        os.environ.setdefault("GOOGLE_API_KEY", "materialize")
+    import rag_funcs
+    rag_funcs.configure_logging(args.log_level)
+
+    row_documents = rag_funcs.load_csv_documents(args.csv)
+    title_index = rag_funcs.build_title_index(row_documents)
+    filter_extractor = rag_funcs.build_query_filter_extractor(row_documents, title_index=title_index)
+    if args.fake:
+        import fakes
+
+        embeddings = fakes.HashEmbeddings()
+        db_path = os.path.join(args.workdir, "chroma_" + os.path.splitext(os.path.basename(args.csv))[0])
+        if not os.path.exists(os.path.join(db_path, "chroma.sqlite3")):
+            rag_funcs.create_vector_db_with_hf(rag_funcs.load_csv_and_split_documents(args.csv),
+                                               db_path=db_path, collection_name=COLLECTION_NAME,
+                                               embeddings=embeddings, embedding_cache_dir=None)
+        vector_db = rag_funcs.load_vector_db(db_path, COLLECTION_NAME, embeddings=embeddings)
+        llm = fakes.FakeLocationLLM()
+        rpm = args.rpm
+    else:
+        manager = rag_funcs.get_resource_manager()
+        vector_db = manager.vectorstore()
+        llm = manager.llm()
+        rpm = args.rpm or rag_funcs.GEMINI_REQUESTS_PER_MINUTE
+
+    # 앱의 LLM 모드와 같은 체인 (저장소 버전도 같은 설정으로 계산됨)
+    chain = rag_funcs.get_rag_chain_with_json_output(vector_db, title_index=title_index, llm=llm,
+                                                     filter_extractor=filter_extractor)
+    store = rag_funcs.PrecomputedAnswerStore(args.store, title_index=title_index)
+
+    titles = args.titles or title_index.titles
+    unknown = [title for title in titles if title not in title_index.rows_by_title]
+    if unknown:
+        raise SystemExit(f"데이터에 없는 제목: {unknown}")
+    if args.limit:
+        # 이미 최신인 제목은 건너뛰므로, limit은 다시 만들어야 하는 제목 기준으로 적용
+        stored = store.rows_hashes()
+        titles = [title for title in titles
+                  if args.force or stored.get(title) != rag_funcs.title_rows_hash(title_index.get_documents(title))
+                  ][:args.limit]
+
+    try:
+        summary = rag_funcs.materialize_title_answers(chain, title_index, store, titles=titles, force=args.force,
+                                                      requests_per_minute=rpm, prune=args.prune)
+    except KeyboardInterrupt:
+        print(f"\n중단됨. 저장된 답변 {store.stats()['size']}개는 유지되며 다시 실행하면 이어서 진행합니다.")
+        return 130
+
+    print(json.dumps({**summary, "store": store.stats()}, ensure_ascii=False, indent=2))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,249 +1,4354 @@
 import os
-from langchain_community.document_loaders import WebBaseLoader
-from langchain_google_genai import GoogleGenerativeAI, GoogleGenerativeAIEmbeddings
-from langchain_chroma import Chroma
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import contextlib
+import contextvars
+import logging
+# langchain_community / langchain_google_genai / langchain_chroma / langchain_huggingface 처럼
+# 무거운 백엔드는 실제로 쓰는 함수 안에서 import 합니다. (사용하지 않는 경로는 import 비용이 없음)
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.chains import create_retrieval_chain
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.runnables import Runnable
+from pydantic import BaseModel, Field
+
+import json
+import numpy as np
+import pandas as pd
+import ast
+import asyncio
+import csv
+import itertools
+import random
+import re
+import hashlib
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+from typing import Any
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dotenv import load_dotenv
+
+
+
+# 환경 변수 로드
+load_dotenv(override=True)
+
+# Google API 키 설정
+os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
+
+# 답변 캐시 키에 들어가는 버전 정보 (프롬프트/모델을 바꾸면 캐시가 자동으로 갈림)
+PROMPT_VERSION = "location-json-v2"
+LLM_MODEL_NAME = "models/gemini-2.5-flash"
+
+# 로깅 (FEELKO_LOG_LEVEL로 레벨, FEELKO_LOG_FORMAT=json이면 한 줄 JSON 형식)
+logger = logging.getLogger("feelko")
+
+
+class JsonLogFormatter(logging.Formatter):
+    """로그 한 건을 JSON 한 줄로 출력합니다. extra={"fields": {...}}로 넘긴 값도 함께 기록합니다."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging(level: str = None, fmt: str = None):
+    """
+    "feelko" 로거에 콘솔 핸들러를 한 번만 붙입니다. (여러 번 불러도 안전)
+
+    Args:
+        level (str): 로그 레벨. None이면 FEELKO_LOG_LEVEL 환경 변수 (기본 INFO).
+        fmt (str): "text" 또는 "json". None이면 FEELKO_LOG_FORMAT 환경 변수 (기본 text).
+    """
+    level = (level or os.getenv("FEELKO_LOG_LEVEL", "INFO")).upper()
+    fmt = fmt or os.getenv("FEELKO_LOG_FORMAT", "text")
+    logger.setLevel(level)
+    if not any(getattr(handler, "_feelko", False) for handler in logger.handlers):
+        handler = logging.StreamHandler()
+        handler._feelko = True
+        logger.addHandler(handler)
+        logger.propagate = False
+    for handler in logger.handlers:
+        if getattr(handler, "_feelko", False):
+            handler.setFormatter(JsonLogFormatter() if fmt == "json" else
+                                 logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    return logger
+
+
+# 단계별 지연 시간 추적 (span)
+# 현재 span은 contextvars로 전달되어서 LangChain이 체인 단계를 다른 스레드에서 실행해도 부모-자식 관계가 유지됩니다.
+_current_span = contextvars.ContextVar("feelko_current_span", default=None)
+
+
+class Span:
+    """한 단계의 실행 기록. (이름, 시작 시각, 걸린 시간, 부모 span, 속성)"""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "duration", "attributes", "status",
+                 "_started")
+
+    def __init__(self, name: str, parent=None, **attributes):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.start = time.time()
+        self.duration = None
+        self.attributes = attributes
+        self.status = "ok"
+        self._started = time.perf_counter()
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": round(self.start, 6),
+            "duration": self.duration,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class Tracer:
+    """
+    span을 만들고, 끝난 span을 등록된 exporter들(export(span) 메서드를 가진 객체)에 넘깁니다.
+    """
+
+    def __init__(self, exporters: list = None):
+        self.exporters = list(exporters or [])
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+        return exporter
+
+    def start_span(self, name: str, parent: Span = None, **attributes):
+        return Span(name, parent if parent is not None else _current_span.get(), **attributes)
+
+    def end_span(self, span: Span, error: BaseException = None):
+        if span.duration is None:
+            span.duration = time.perf_counter() - span._started
+        if error is not None:
+            span.status = "error"
+            span.attributes["error"] = f"{type(error).__name__}: {error}"
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception:
+                logger.exception("span exporter 실패: %s", type(exporter).__name__)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        """with tracer.span("단계명"): 블록 실행 시간을 span으로 기록합니다."""
+        span = self.start_span(name, **attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as error:
+            self.end_span(span, error)
+            raise
+        else:
+            self.end_span(span)
+        finally:
+            _current_span.reset(token)
+
+    def record_span(self, name: str, seconds: float, **attributes):
+        """
+        이미 잰 시간으로 span을 기록합니다. (스트리밍 중 여러 번 나눠 실행되는 JSON 파싱, 화면 렌더링 합계용)
+        """
+        span = self.start_span(name, **attributes)
+        span.start -= seconds
+        span.duration = seconds
+        self.end_span(span)
+        return span
+
+
+def _percentile(sorted_values: list, q: float):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+class JsonlSpanExporter:
+    """끝난 span을 JSONL 파일에 한 줄씩 추가합니다."""
+
+    def __init__(self, path: str = "./logs/spans.jsonl"):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+class HistogramSpanExporter:
+    """
+    프로세스 안에서 단계(span 이름)별 최근 지연 시간을 모아 p50/p95/p99를 계산합니다.
+    최근 span 기록(recent)은 디버그 화면에서 마지막 요청의 단계별 시간을 보여줄 때 씁니다.
+    """
+
+    def __init__(self, max_samples: int = 2000, max_recent: int = 500):
+        self.max_samples = max_samples
+        self._samples = defaultdict(lambda: deque(maxlen=self.max_samples))
+        self._totals = defaultdict(lambda: [0, 0.0])  # 이름 -> [전체 횟수, 전체 시간 합]
+        self.recent = deque(maxlen=max_recent)
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self._lock:
+            self._samples[span.name].append(span.duration)
+            totals = self._totals[span.name]
+            totals[0] += 1
+            totals[1] += span.duration
+            self.recent.append(span.to_dict())
+
+    def summary(self):
+        """단계별 {count, mean, p50, p95, p99} (초)"""
+        with self._lock:
+            samples = {name: sorted(values) for name, values in self._samples.items()}
+            totals = {name: list(values) for name, values in self._totals.items()}
+        return {
+            name: {
+                "count": totals[name][0],
+                "mean": totals[name][1] / totals[name][0],
+                "p50": _percentile(values, 0.50),
+                "p95": _percentile(values, 0.95),
+                "p99": _percentile(values, 0.99),
+            }
+            for name, values in samples.items()
+        }
+
+    def last_trace(self):
+        """가장 최근에 끝난 요청(trace)의 span 리스트 (시작 시각 순)"""
+        with self._lock:
+            recent = list(self.recent)
+        if not recent:
+            return []
+        trace_id = recent[-1]["trace_id"]
+        return sorted((span for span in recent if span["trace_id"] == trace_id), key=lambda s: s["start"])
+
+    def prometheus_text(self, metric: str = "feelko_stage_latency_seconds"):
+        """Prometheus 텍스트 형식(summary 타입)으로 변환합니다."""
+        lines = [f"# HELP {metric} RAG pipeline stage latency", f"# TYPE {metric} summary"]
+        for name, stats in sorted(self.summary().items()):
+            label = name.replace("\\", "\\\\").replace('"', '\\"')
+            for quantile in ("p50", "p95", "p99"):
+                lines.append(f'{metric}{{stage="{label}",quantile="0.{quantile[1:]}"}} {stats[quantile]:.6f}')
+            lines.append(f'{metric}_sum{{stage="{label}"}} {stats["mean"] * stats["count"]:.6f}')
+            lines.append(f'{metric}_count{{stage="{label}"}} {stats["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """
+    LangChain 콜백으로 검색기(retriever:클래스명)와 LLM 호출(llm) 구간을 span으로 기록합니다.
+    LLM 스트리밍이면 첫 토큰까지 걸린 시간도 attributes["first_token_seconds"]에 남기고,
+    LLM span에는 입력/출력 토큰 수(input_tokens, output_tokens)도 기록합니다.
+    """
+
+    def __init__(self, tracer: Tracer):
+        self.tracer = tracer
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    def _start(self, run_id, parent_run_id, name, **attributes):
+        with self._lock:
+            parent = self._spans.get(parent_run_id)
+        span = self.tracer.start_span(name, parent=parent, **attributes)
+        with self._lock:
+            self._spans[run_id] = span
+        # 이 구간 안에서 만들어지는 span(임베딩 등)의 부모가 되도록 현재 span으로 설정
+        _current_span.set(span)
+
+    def _end(self, run_id, error=None, **attributes):
+        with self._lock:
+            span = self._spans.pop(run_id, None)
+        if span is None:
+            return
+        span.attributes.update(attributes)
+        if _current_span.get() is span:
+            _current_span.set(self._parent_of(span))
+        self.tracer.end_span(span, error)
+
+    def _parent_of(self, span):
+        with self._lock:
+            for candidate in self._spans.values():
+                if candidate.span_id == span.parent_id:
+                    return candidate
+        return None
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs):
+        self._start(run_id, parent_run_id, f"retriever:{kwargs.get('name') or 'retriever'}")
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._end(run_id, documents=len(documents))
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+        self._start(run_id, parent_run_id, "llm", prompt_chars=sum(len(p) for p in prompts),
+                    input_tokens=sum(estimate_tokens(p) for p in prompts))
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        with self._lock:
+            span = self._spans.get(run_id)
+        if span is not None and "first_token_seconds" not in span.attributes:
+            span.attributes["first_token_seconds"] = time.perf_counter() - span._started
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        with self._lock:
+            span = self._spans.get(run_id)
+        estimated_input = span.attributes.get("input_tokens", 0) if span is not None else 0
+        self._end(run_id, **llm_result_usage(response, estimated_input))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+
+
+class TracedEmbeddings(Embeddings):
+    """임베딩 계산 구간을 span(embed_query / embed_documents)으로 기록하는 래퍼."""
+
+    def __init__(self, embedding: Embeddings, tracer: "Tracer" = None):
+        self.embedding = embedding
+        self.tracer = tracer
+
+    def embed_documents(self, texts: list):
+        with (self.tracer or get_tracer()).span("embed_documents", texts=len(texts)):
+            return self.embedding.embed_documents(texts)
+
+    def embed_query(self, text: str):
+        with (self.tracer or get_tracer()).span("embed_query"):
+            return self.embedding.embed_query(text)
+
+    def embed_queries(self, texts: list):
+        with (self.tracer or get_tracer()).span("embed_query", texts=len(texts)):
+            return embed_queries(self.embedding, texts)
+
+
+# 요청 로그 (검색어 1건 = JSONL 1줄, replay.py로 다시 재생해서 용량 산정에 사용)
+DEFAULT_QUERY_LOG_PATH = "./logs/requests.jsonl"
+
+
+class QueryLogExporter:
+    """
+    span exporter로 붙어서, rag_query span이 들어있는 요청(trace)이 끝나면 한 줄로 기록합니다.
+        {"ts", "query", "route", "stages", "input_tokens", "output_tokens", "locations", "outcome", ...}
+    route는 미리 만든 답변이면 "precomputed", 답변 캐시 적중이면 "cache",
+    아니면 실행된 검색기 이름을 실행 순서대로 ">"로 이은 값이고,
+    stages는 단계(span 이름)별 걸린 시간 합계(초)이고, outcome은 ok/empty/fallback(LLM 대체 답변)/error입니다.
+    요청의 가장 바깥 span(앱에서는 "request", 직접 호출하면 "rag_query")이 끝날 때 기록합니다.
+    """
+
+    def __init__(self, path: str = DEFAULT_QUERY_LOG_PATH, max_pending: int = 1000):
+        self.path = path
+        self.max_pending = max_pending
+        self._pending = {}  # trace_id -> 끝난 span 리스트 (삽입 순서 = 오래된 순)
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def export(self, span: Span):
+        with self._lock:
+            spans = self._pending.pop(span.trace_id, [])
+            spans.append(span)
+            if span.parent_id is not None:
+                self._pending[span.trace_id] = spans
+                # 끝나지 않은 요청(중간에 버려진 스트리밍 등)이 쌓이지 않도록 오래된 것부터 버림
+                while len(self._pending) > self.max_pending:
+                    self._pending.pop(next(iter(self._pending)))
+                return
+        record = self.build_record(spans)
+        if record is None:
+            return
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    @staticmethod
+    def build_record(spans: list):
+        """한 요청의 span 리스트로 로그 레코드를 만듭니다. (rag_query span이 없으면 None)"""
+        query_span = next((span for span in spans if span.name == "rag_query"), None)
+        if query_span is None:
+            return None
+        root = spans[-1]
+        stages = defaultdict(float)
+        for span in spans:
+            stages[span.name] += span.duration
+        llm_spans = [span for span in spans if span.name == "llm"]
+        retrievers = [span.name.split(":", 1)[1] for span in sorted(spans, key=lambda s: s.start)
+                      if span.name.startswith("retriever:")]
+        error = next((span.attributes["error"] for span in (root, query_span) if span.status == "error"), None)
+        locations = query_span.attributes.get("locations")
+        if error is not None:
+            outcome = "error"
+        elif query_span.attributes.get("fallback"):
+            outcome = "fallback"
+        elif not locations:
+            outcome = "empty"
+        else:
+            outcome = "ok"
+        return {
+            "ts": round(root.start, 3),
+            "trace_id": root.trace_id,
+            "query": query_span.attributes.get("query"),
+            "route": ("precomputed" if query_span.attributes.get("precomputed") else
+                      "cache" if query_span.attributes.get("cache_hit") else ">".join(retrievers)),
+            "stream": query_span.attributes.get("stream"),
+            # 앱에서 넘긴 답변 방식/검색 방식 등 (가장 바깥 span의 속성)
+            **{key: value for key, value in root.attributes.items()
+               if key not in ("query", "error", "cache_hit", "precomputed", "fallback", "stream", "locations")},
+            "seconds": round(root.duration, 6),
+            "stages": {name: round(seconds, 6) for name, seconds in stages.items()},
+            "llm_calls": len(llm_spans),
+            "input_tokens": sum(span.attributes.get("input_tokens", 0) for span in llm_spans),
+            "output_tokens": sum(span.attributes.get("output_tokens", 0) for span in llm_spans),
+            "locations": locations,
+            "llm_fallback": query_span.attributes.get("fallback"),
+            "outcome": outcome,
+            "error": error,
+        }
+
+
+def read_query_log(path: str = DEFAULT_QUERY_LOG_PATH):
+    """요청 로그를 읽어 레코드 리스트로 반환합니다. (깨진 줄은 건너뜀)"""
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and record.get("query"):
+                records.append(record)
+    return records
+
+
+# 프로세스 전체에서 쓰는 tracer (FEELKO_TRACE_FILE이 있으면 JSONL 파일로도 기록)
+span_histogram = HistogramSpanExporter()
+_tracer = Tracer([span_histogram])
+if os.getenv("FEELKO_TRACE_FILE"):
+    _tracer.add_exporter(JsonlSpanExporter(os.getenv("FEELKO_TRACE_FILE")))
+_tracing_callback = TracingCallbackHandler(_tracer)
+
+
+def get_tracer():
+    """프로세스 전체에서 공유하는 Tracer를 반환합니다."""
+    return _tracer
+
+
+def enable_query_log(path: str = None):
+    """
+    공유 tracer에 요청 로그(QueryLogExporter)를 붙입니다. (여러 번 불러도 하나만 붙음)
+
+    Args:
+        path (str): 로그 경로. None이면 FEELKO_QUERY_LOG 환경 변수, 없으면 ./logs/requests.jsonl.
+            저장소 루트의 requests.jsonl과 헷갈리지 않도록 기본 경로는 logs/ 아래입니다.
+    """
+    path = path or os.getenv("FEELKO_QUERY_LOG") or DEFAULT_QUERY_LOG_PATH
+    for exporter in _tracer.exporters:
+        if isinstance(exporter, QueryLogExporter) and exporter.path == path:
+            return exporter
+    return _tracer.add_exporter(QueryLogExporter(path))
+
+# 웹 문서 로더 (동시 다운로드 + 디스크 캐시)
+# raw/   - URL별 원본 응답(body)과 헤더(ETag, Last-Modified). 다시 받을 때 조건부 요청으로 재검증합니다.
+# text/  - 원본 body 해시별 추출 텍스트. 원본이 같으면(304 포함) HTML 파싱을 다시 하지 않습니다.
+HTML_TEXT_VERSION = "html-text-v1"
+_BLOCK_TAGS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "section", "article",
+               "table", "ul", "ol", "header", "footer", "blockquote", "pre", "dd", "dt"}
+
+
+class WebPageCache:
+    """URL별 원본 페이지와 추출 텍스트를 디스크에 저장하는 캐시."""
+
+    def __init__(self, cache_dir: str = "./cache/web"):
+        self.raw_dir = os.path.join(cache_dir, "raw")
+        self.text_dir = os.path.join(cache_dir, "text")
+        os.makedirs(self.raw_dir, exist_ok=True)
+        os.makedirs(self.text_dir, exist_ok=True)
+
+    def _raw_paths(self, url: str):
+        key = _text_hash(url)
+        return os.path.join(self.raw_dir, key + ".json"), os.path.join(self.raw_dir, key + ".body")
+
+    def get_raw(self, url: str):
+        """(헤더 dict, body bytes) 또는 캐시에 없으면 (None, None)"""
+        meta_path, body_path = self._raw_paths(url)
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            with open(body_path, "rb") as f:
+                return meta, f.read()
+        except (OSError, ValueError):
+            return None, None
+
+    def put_raw(self, url: str, meta: dict, body: bytes):
+        meta_path, body_path = self._raw_paths(url)
+        # body를 먼저 쓰고 헤더를 나중에 써서, 중간에 끊겨도 헤더만 남는 일이 없게 함
+        with open(body_path + ".tmp", "wb") as f:
+            f.write(body)
+        os.replace(body_path + ".tmp", body_path)
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def touch_raw(self, url: str, meta: dict):
+        meta_path, _ = self._raw_paths(url)
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def _text_path(self, body_sha1: str):
+        return os.path.join(self.text_dir, f"{body_sha1}.{HTML_TEXT_VERSION}.json")
+
+    def get_text(self, body_sha1: str):
+        try:
+            with open(self._text_path(body_sha1), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put_text(self, body_sha1: str, extracted: dict):
+        path = self._text_path(body_sha1)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(extracted, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+
+def _decode_html(body: bytes, content_type: str = ""):
+    """Content-Type 헤더 또는 <meta charset>의 인코딩으로 디코딩합니다. (없으면 UTF-8)"""
+    match = re.search(r"charset=[\"']?([\w-]+)", content_type or "", re.I) or \
+        re.search(rb"<meta[^>]+charset=[\"']?([\w-]+)", body[:4096], re.I)
+    encoding = match.group(1) if match else "utf-8"
+    if isinstance(encoding, bytes):
+        encoding = encoding.decode("ascii", "ignore")
+    try:
+        return body.decode(encoding, errors="replace")
+    except LookupError:
+        return body.decode("utf-8", errors="replace")
+
+
+def html_to_text(html: str):
+    """
+    HTML에서 제목과 본문 텍스트를 뽑습니다. bs4가 설치되어 있으면 bs4(WebBaseLoader와 같은 방식)를,
+    없으면 표준 라이브러리 html.parser를 사용합니다.
+
+    Returns:
+        dict: {"title": 제목, "text": 본문}
+    """
+    try:
+        from bs4 import BeautifulSoup
+    except ImportError:
+        BeautifulSoup = None
+
+    if BeautifulSoup is not None:
+        soup = BeautifulSoup(html, "html.parser")
+        for tag in soup(["script", "style", "noscript"]):
+            tag.decompose()
+        title = soup.title.get_text(strip=True) if soup.title else ""
+        text = soup.get_text("\n")
+    else:
+        from html.parser import HTMLParser
+
+        class _TextExtractor(HTMLParser):
+            def __init__(self):
+                super().__init__(convert_charrefs=True)
+                self.parts, self.title, self._skip, self._in_title = [], "", 0, False
+
+            def handle_starttag(self, tag, attrs):
+                if tag in ("script", "style", "noscript"):
+                    self._skip += 1
+                elif tag == "title":
+                    self._in_title = True
+                elif tag in _BLOCK_TAGS:
+                    self.parts.append("\n")
+
+            def handle_endtag(self, tag):
+                if tag in ("script", "style", "noscript"):
+                    self._skip = max(0, self._skip - 1)
+                elif tag == "title":
+                    self._in_title = False
+                elif tag in _BLOCK_TAGS:
+                    self.parts.append("\n")
+
+            def handle_data(self, data):
+                if self._in_title:
+                    self.title += data
+                elif not self._skip:
+                    self.parts.append(data)
+
+        parser = _TextExtractor()
+        parser.feed(html)
+        parser.close()
+        title, text = parser.title.strip(), "".join(parser.parts)
+
+    # 빈 줄/공백 정리
+    lines = (" ".join(line.split()) for line in text.splitlines())
+    return {"title": title, "text": "\n".join(line for line in lines if line)}
+
+
+FetchResult = namedtuple("FetchResult", ["url", "status", "body", "meta", "cache_status", "error"])
+
+
+def fetch_web_pages(urls: list,
+                    cache: WebPageCache = None,
+                    max_workers: int = 16,
+                    per_host_limit: int = 4,
+                    timeout: float = 10.0,
+                    max_age: float = 0.0,
+                    headers: dict = None):
+    """
+    여러 URL을 스레드 풀로 동시에 받습니다. (호스트별 동시 연결 수 제한)
+    캐시에 있는 페이지는 If-None-Match / If-Modified-Since로 재검증하고, 304면 캐시 본문을 씁니다.
+
+    Args:
+        urls (list): URL 리스트.
+        cache (WebPageCache): 원본 페이지 캐시. None이면 캐시 없이 매번 받습니다.
+        max_workers (int): 전체 동시 요청 수.
+        per_host_limit (int): 호스트 하나에 대한 동시 요청 수.
+        timeout (float): 요청 하나의 연결/읽기 제한 시간(초).
+        max_age (float): 캐시에 저장된 지 이 시간(초)이 안 됐으면 재검증 없이 바로 사용.
+        headers (dict): 추가 요청 헤더.
+
+    Returns:
+        list: URL 순서대로 FetchResult. cache_status는 "fresh"(재검증 생략), "revalidated"(304),
+            "miss"(새로 받음), "stale"(요청 실패, 이전 캐시 사용), "error" 중 하나.
+    """
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+    from urllib.parse import urlsplit
+
+    host_limits = defaultdict(lambda: threading.BoundedSemaphore(per_host_limit))
+    host_lock = threading.Lock()
+    local = threading.local()
+    base_headers = {"User-Agent": os.getenv("USER_AGENT", "feelko-loader/1.0")}
+    base_headers.update(headers or {})
+
+    def host_semaphore(url):
+        with host_lock:
+            return host_limits[urlsplit(url).netloc]
+
+    def fetch(url):
+        meta, body = cache.get_raw(url) if cache is not None else (None, None)
+        if meta is not None and max_age and time.time() - meta.get("checked_at", 0) < max_age:
+            return FetchResult(url, meta.get("status", 200), body, meta, "fresh", None)
+
+        request_headers = dict(base_headers)
+        if meta is not None:
+            if meta.get("etag"):
+                request_headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                request_headers["If-Modified-Since"] = meta["last_modified"]
+
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        try:
+            with host_semaphore(url):
+                response = local.session.get(url, headers=request_headers, timeout=timeout)
+        except requests.RequestException as error:
+            if meta is not None:
+                # 네트워크 오류면 이전에 받아 둔 본문이라도 사용
+                logger.warning(f"재검증 실패, 캐시 사용: {url} ({error})")
+                return FetchResult(url, meta.get("status", 200), body, meta, "stale", str(error))
+            return FetchResult(url, None, None, None, "error", str(error))
+
+        if response.status_code == 304 and meta is not None:
+            meta["checked_at"] = time.time()
+            if cache is not None:
+                cache.touch_raw(url, meta)
+            return FetchResult(url, meta.get("status", 200), body, meta, "revalidated", None)
+        if response.status_code >= 400:
+            return FetchResult(url, response.status_code, None, None, "error", f"HTTP {response.status_code}")
+
+        meta = {
+            "url": url,
+            "status": response.status_code,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "content_type": response.headers.get("Content-Type", ""),
+            "body_sha1": hashlib.sha1(response.content).hexdigest(),
+            "checked_at": time.time(),
+        }
+        if cache is not None:
+            cache.put_raw(url, meta, response.content)
+        return FetchResult(url, response.status_code, response.content, meta, "miss", None)
+
+    # 같은 URL은 한 번만 받음
+    unique_urls = list(dict.fromkeys(urls))
+    if not unique_urls:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(unique_urls))) as executor:
+        results = dict(zip(unique_urls, executor.map(fetch, unique_urls)))
+    return [results[url] for url in urls]
+
+
+def load_web_documents(urls: list,
+                       cache_dir: str = "./cache/web",
+                       max_workers: int = 16,
+                       per_host_limit: int = 4,
+                       timeout: float = 10.0,
+                       max_age: float = 0.0):
+    """
+    여러 URL을 동시에 받아 본문 텍스트 Document 리스트로 만듭니다. (실패한 URL은 건너뜀)
+    텍스트 추출 결과는 원본 body 해시별로 캐시되어, 바뀌지 않은 페이지는 다시 파싱하지 않습니다.
+
+    Args:
+        cache_dir (str): 캐시 디렉터리. None이면 캐시를 쓰지 않습니다.
+        나머지 인자는 fetch_web_pages 참고.
+
+    Returns:
+        list: Document 리스트 (metadata: source, title, cache_status).
+    """
+    cache = WebPageCache(cache_dir) if cache_dir else None
+    started = time.perf_counter()
+    results = fetch_web_pages(urls, cache=cache, max_workers=max_workers, per_host_limit=per_host_limit,
+                              timeout=timeout, max_age=max_age)
+
+    docs, stats = [], Counter()
+    for result in results:
+        stats[result.cache_status] += 1
+        if result.body is None:
+            logger.warning(f"페이지를 받지 못했습니다: {result.url} ({result.error})")
+            continue
+        body_sha1 = result.meta.get("body_sha1") or hashlib.sha1(result.body).hexdigest()
+        extracted = cache.get_text(body_sha1) if cache is not None else None
+        if extracted is None:
+            extracted = html_to_text(_decode_html(result.body, result.meta.get("content_type", "")))
+            if cache is not None:
+                cache.put_text(body_sha1, extracted)
+        else:
+            stats["text_cached"] += 1
+        docs.append(Document(page_content=extracted["text"],
+                             metadata={"source": result.url, "title": extracted["title"],
+                                       "cache_status": result.cache_status}))
+    logger.info(f"웹 문서 {len(docs)}/{len(urls)}개 로딩 ({time.perf_counter() - started:.2f}s): {dict(stats)}")
+    return docs
+
+
+def load_url_and_split_documents(urls: list,
+                                 cache_dir: str = "./cache/web",
+                                 max_workers: int = 16,
+                                 per_host_limit: int = 4,
+                                 timeout: float = 10.0):
+    """
+    여러 URL에서 문서를 로드하고 청크로 분할합니다.
+    URL은 동시에 받고, 바뀌지 않은 페이지는 캐시(ETag/Last-Modified 재검증)에서 가져옵니다.
+
+    Args:
+        urls (list): 데이터를 가져올 URL 리스트.
+        cache_dir (str): 웹 페이지 캐시 디렉터리. None이면 매번 새로 받습니다.
+        max_workers (int): 동시 요청 수.
+        per_host_limit (int): 호스트(사이트) 하나에 대한 동시 요청 수.
+        timeout (float): 요청 하나의 제한 시간(초).
+
+    Returns:
+        list: 분할된 문서 청크 리스트.
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    all_docs = load_web_documents(urls, cache_dir=cache_dir, max_workers=max_workers,
+                                  per_host_limit=per_host_limit, timeout=timeout)
+    
+    # chunk_size를 더 크게 설정
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=800, 
+        chunk_overlap=80)
+    splits = text_splitter.split_documents(all_docs)
+    return splits
+
+
+# csv 데이터 문서 로더 (행 단위, 분할 전)
+def load_csv_documents(file_path):
+    """
+    csv 파일 형태의 데이터를 행 단위 Document 리스트로 로딩함
+    (제목 인덱스처럼 행 전체가 필요한 곳에서 사용)
+    """
+    from langchain_community.document_loaders.csv_loader import CSVLoader
+
+    loader = CSVLoader(
+        file_path=file_path, 
+        source_column="제목명",
+        # metadata_columns=['일련번호','미디어유형','제목명','장소명','장소유형','관련장소설명','운영시간','휴식시간','휴무일안내내용','주소','위치위도','위치경도','전화번호','최종수정일자'],
+        encoding='utf-8',
+        # csv_args={
+        #     'encoding': 'utf-8',
+        #     'delimiter': ',',
+        #     'quotechar': '"',
+        #     'on_bad_lines': 'skip'
+        # }
+    )
+    all_docs = loader.load()
+    for doc in all_docs:
+        add_row_metadata(doc)
+
+    logger.info("파일이 로딩 됐습니다.")
+    return all_docs
+
+
+# 행 메타데이터 (Chroma where 필터용)
+# 시/도 정식 명칭 -> 짧은 이름 (메타데이터 "지역" 값)
+REGION_ALIASES = {
+    "서울특별시": "서울", "부산광역시": "부산", "대구광역시": "대구", "인천광역시": "인천",
+    "광주광역시": "광주", "대전광역시": "대전", "울산광역시": "울산", "세종특별자치시": "세종",
+    "경기도": "경기", "강원도": "강원", "강원특별자치도": "강원", "충청북도": "충북", "충청남도": "충남",
+    "전라북도": "전북", "전북특별자치도": "전북", "전라남도": "전남", "경상북도": "경북", "경상남도": "경남",
+    "제주특별자치도": "제주", "제주도": "제주",
+}
+
+
+def split_address_region(address: str):
+    """주소에서 (시/도 짧은 이름, 시/군/구) 를 꺼냅니다. 예: "강원도 강릉시 ..." -> ("강원", "강릉시")"""
+    parts = address.split()
+    if not parts:
+        return "", ""
+    region = REGION_ALIASES.get(parts[0], parts[0])
+    city = parts[1] if len(parts) > 1 and parts[1][-1:] in ("시", "군", "구") else ""
+    return region, city
+
+
+def add_row_metadata(doc):
+    """
+    행 문서에 필터용 메타데이터(제목명, 미디어유형, 장소유형, 지역, 시군구, 위경도)를 추가합니다.
+    page_content는 그대로 둡니다. 위경도 값이 없는 행은 위경도 키를 넣지 않습니다.
+    """
+    fields = parse_row_fields(doc.page_content)
+    region, city = split_address_region(fields.get("주소", ""))
+    doc.metadata.update({
+        "제목명": fields.get("제목명", ""),
+        "미디어유형": fields.get("미디어유형", ""),
+        "장소유형": fields.get("장소유형", ""),
+        "지역": region,
+        "시군구": city,
+    })
+    for column in ("위치위도", "위치경도"):
+        value = _to_float(fields.get(column))
+        if value is not None:
+            doc.metadata[column] = value
+    return doc
+
+
+# csv 데이터 문서 로더
+def load_csv_and_split_documents(file_path, embed_fields: list = None):
+    """
+    csv 파일 형태의 데이터를 로딩해서 데이터 스플릿함
+
+    embed_fields를 주면 행을 자르지 않고, 행마다 해당 컬럼만 모은 임베딩용 문서 1개를 만듦
+    (예: ["제목명", "장소명", "관련장소설명"]). 행 전체 내용은 metadata["row_text"]에 보관되고
+    검색 후 expand_row_documents로 다시 펼쳐짐.
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    all_docs = load_csv_documents(file_path)
+
+    if embed_fields:
+        seen_row_ids = defaultdict(int)
+        row_docs = []
+        for doc in all_docs:
+            doc.metadata["row_id"] = _make_row_id(doc.page_content, doc.metadata["source"],
+                                                  doc.metadata["row"], seen_row_ids)
+            row_docs.append(to_row_embedding_document(doc, embed_fields))
+        return row_docs
+
+    # chunk_size를 더 크게 설정
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=300, 
+        chunk_overlap=50,
+        add_start_index=True  # 맥락 압축 때 같은 행의 청크를 원래 순서로 합치기 위해 기록
+        )
+    splits = text_splitter.split_documents(all_docs)
+    return splits
+
+# 행 단위 임베딩 (행 하나 = 벡터 하나)
+# 메모(생각정리.txt)대로 제목 + 일부 컬럼만 임베딩하는 편이 빠르고 검색도 정확함.
+DEFAULT_EMBED_FIELDS = ("제목명", "장소명", "관련장소설명")
+
+
+def to_row_embedding_document(doc, embed_fields=DEFAULT_EMBED_FIELDS):
+    """
+    행 문서를 embed_fields 컬럼만 담은 임베딩용 문서로 바꿉니다.
+    원래 행 내용은 metadata["row_text"]에 넣어 둡니다.
+    """
+    fields = parse_row_fields(doc.page_content)
+    content = "\n".join(f"{field}: {fields[field]}" for field in embed_fields if fields.get(field))
+    metadata = dict(doc.metadata, row_text=doc.page_content)
+    return Document(page_content=content, metadata=metadata)
+
+
+def expand_row_documents(docs: list):
+    """
+    검색된 행 단위 임베딩 문서를 원래 행 내용으로 펼치고, 같은 행이 두 번 나오면 하나만 남깁니다.
+    (일반 청크 문서는 그대로 통과)
+    """
+    expanded, seen = [], set()
+    for doc in docs:
+        row_text = doc.metadata.get("row_text")
+        if row_text is None:
+            expanded.append(doc)
+            continue
+        key = doc.metadata.get("row_id", (doc.metadata.get("source"), doc.metadata.get("row")))
+        if key in seen:
+            continue
+        seen.add(key)
+        metadata = {k: v for k, v in doc.metadata.items() if k != "row_text"}
+        expanded.append(Document(page_content=row_text, metadata=metadata, id=doc.id))
+    return expanded
+
+
+# 임베딩 캐시 (모델별 memmap 파일)
+# 모델 디렉터리마다 vectors.bin(float32/float16 행렬), keys.txt(행 순서대로 텍스트 해시),
+# meta.json(차원, dtype)을 둡니다. 한 번 계산한 임베딩은 DB를 다시 만들 때 재사용됩니다.
+def _text_hash(text: str):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    (모델명, 텍스트 해시) -> 임베딩 벡터 캐시.
+    벡터는 파일 끝에 이어 붙이고 읽을 때는 np.memmap으로 필요한 행만 읽습니다.
+    한 프로세스에서만 쓰기를 한다고 가정합니다.
+    """
+
+    def __init__(self, cache_dir: str = "./cache/embeddings", model_name: str = "jhgan/ko-sbert-nli",
+                 dtype: str = "float32"):
+        self.model_name = model_name
+        self.dir = os.path.join(cache_dir, re.sub(r"[^0-9A-Za-z._-]+", "_", model_name))
+        self.vectors_path = os.path.join(self.dir, "vectors.bin")
+        self.keys_path = os.path.join(self.dir, "keys.txt")
+        self.meta_path = os.path.join(self.dir, "meta.json")
+        self._lock = threading.Lock()
+        self._vectors = None
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            self.dim = meta["dim"]
+            self.dtype = np.dtype(meta["dtype"])
+        else:
+            self.dim = None
+            self.dtype = np.dtype(dtype)
+
+        keys = []
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, encoding="utf-8") as f:
+                keys = f.read().split()
+        # 쓰다가 중단된 경우 벡터/키 중 짧은 쪽에 맞춤. 키 없이 남은 벡터 행은 잘라내야
+        # 다음에 추가하는 벡터가 키 순번과 같은 행에 기록됨 (meta.json만 쓰고 중단됐으면 벡터 파일이 없음)
+        if self.dim:
+            row_bytes = self.dim * self.dtype.itemsize
+            size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+            if len(keys) > size // row_bytes:
+                keys = keys[:size // row_bytes]
+                with open(self.keys_path, "w", encoding="utf-8") as f:
+                    f.write("".join(f"{key}\n" for key in keys))
+            if size != len(keys) * row_bytes:
+                with open(self.vectors_path, "ab") as f:
+                    f.truncate(len(keys) * row_bytes)
+        self._rows = {key: row for row, key in enumerate(keys)}
+        self.count = len(keys)
+
+    def __len__(self):
+        return self.count
+
+    def _matrix(self):
+        if self._vectors is None or self._vectors.shape[0] < self.count:
+            self._vectors = np.memmap(self.vectors_path, dtype=self.dtype, mode="r",
+                                      shape=(self.count, self.dim))
+        return self._vectors
+
+    def get_many(self, texts: list):
+        """텍스트별 캐시된 벡터(list[float])를 반환합니다. 없으면 None."""
+        with self._lock:
+            rows = [self._rows.get(_text_hash(text)) for text in texts]
+            found = [row for row in rows if row is not None]
+            self.hits += len(found)
+            self.misses += len(rows) - len(found)
+            if not found:
+                return [None] * len(texts)
+            matrix = self._matrix()
+            return [None if row is None else matrix[row].astype(np.float32).tolist() for row in rows]
+
+    def put_many(self, texts: list, vectors: list):
+        """새 벡터를 파일 끝에 추가합니다. 이미 있는 텍스트는 건너뜁니다."""
+        with self._lock:
+            new_vectors = {}
+            for text, vector in zip(texts, vectors):
+                key = _text_hash(text)
+                if key not in self._rows and key not in new_vectors:
+                    new_vectors[key] = vector
+            if not new_vectors:
+                return 0
+
+            new_keys = list(new_vectors)
+            matrix = np.asarray(list(new_vectors.values()), dtype=self.dtype)
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+                with open(self.meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"model_name": self.model_name, "dim": self.dim, "dtype": self.dtype.name}, f)
+
+            # 벡터를 먼저 쓰고 키를 나중에 써야 중단돼도 키가 없는 벡터만 남음 (다음에 열 때 잘라냄)
+            with open(self.vectors_path, "ab") as f:
+                f.write(matrix.tobytes())
+            with open(self.keys_path, "a", encoding="utf-8") as f:
+                f.write("".join(f"{key}\n" for key in new_keys))
+            for key in new_keys:
+                self._rows[key] = self.count
+                self.count += 1
+            return len(new_keys)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    임베딩 모델 앞에 EmbeddingCache를 두는 래퍼.
+    문서는 캐시에 없는 텍스트만 원래 모델로 한 번에 계산해서 파일 캐시에 저장합니다.
+    검색어는 요청마다 파일에 쌓이지 않도록 크기가 정해진 메모리 LRU(max_queries개)에만 둡니다.
+    """
+
+    def __init__(self, embedding: Embeddings, cache: EmbeddingCache, max_queries: int = 1024):
+        self.embedding = embedding
+        self.cache = cache
+        self.max_queries = max_queries
+        self._queries = OrderedDict()
+        self._query_lock = threading.Lock()
+
+    def embed_documents(self, texts: list):
+        vectors = self.cache.get_many(texts)
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            computed = dict(zip(missing, self.embedding.embed_documents(missing)))
+            self.cache.put_many(missing, [computed[text] for text in missing])
+            vectors = [computed[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+        return vectors
+
+    def embed_query(self, text: str):
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts: list):
+        # Google 임베딩처럼 검색어/문서 임베딩이 다른 모델이 있어서 문서 캐시와 따로 둠
+        with self._query_lock:
+            vectors = [self._queries.get(text) for text in texts]
+            for text, vector in zip(texts, vectors):
+                if vector is not None:
+                    self._queries.move_to_end(text)
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            computed = dict(zip(missing, embed_queries(self.embedding, missing)))
+            with self._query_lock:
+                self._queries.update(computed)
+                while len(self._queries) > self.max_queries:
+                    self._queries.popitem(last=False)
+            vectors = [computed[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+        return vectors
+
+
+def embed_queries(embedding: Embeddings, texts: list):
+    """
+    검색어 여러 개를 임베딩합니다. 래퍼(TracedEmbeddings, CachedEmbeddings)는 embed_queries로 한 번에 넘기고,
+    그 밖의 모델은 검색어마다 embed_query를 호출합니다.
+    (embed_documents를 쓰면 검색어가 문서 파일 캐시에 쌓이고, 검색어/문서 임베딩이 다른 모델에서는 벡터도 틀림)
+    """
+    if hasattr(embedding, "embed_queries"):
+        return embedding.embed_queries(texts)
+    return [embedding.embed_query(text) for text in texts]
+
+
+def with_embedding_cache(embedding: Embeddings, model_name: str, cache_dir: str = "./cache/embeddings"):
+    """cache_dir가 있으면 임베딩 모델을 CachedEmbeddings로 감싸서 반환합니다."""
+    if not cache_dir:
+        return embedding
+    return CachedEmbeddings(embedding, EmbeddingCache(cache_dir, model_name=model_name))
+
+
+def import_embedding_csv(csv_path: str,
+                         model_name: str,
+                         cache_dir: str = "./cache/embeddings",
+                         dtype: str = "float32",
+                         chunksize: int = 1000):
+    """
+    data/embedding.csv 처럼 (text, embedding 문자열) 컬럼을 가진 CSV를 임베딩 캐시로 옮깁니다.
+
+    Args:
+        csv_path (str): text, embedding 컬럼이 있는 CSV 경로.
+        model_name (str): 이 임베딩을 만든 모델명 (캐시 키로 사용).
+        cache_dir (str): 임베딩 캐시 디렉터리.
+        dtype (str): 저장 dtype ("float32" 또는 "float16").
+        chunksize (int): 한 번에 읽을 행 수.
+
+    Returns:
+        int: 새로 추가된 벡터 수.
+    """
+    cache = EmbeddingCache(cache_dir, model_name=model_name, dtype=dtype)
+    added = 0
+    for frame in pd.read_csv(csv_path, chunksize=chunksize):
+        vectors = [json.loads(value) for value in frame["embedding"]]
+        added += cache.put_many(frame["text"].tolist(), vectors)
+    logger.info(f"임베딩 {added}개를 캐시로 옮겼습니다: {cache.dir}")
+    return added
+
+
+# 벡터 DB 구성
+def create_vector_db_with_google(splits: list, embedding_cache_dir: str = "./cache/embeddings"):
+    """
+    분할된 문서 청크를 사용하여 ChromaDB 벡터 DB를 생성합니다.
+
+    Args:
+        splits (list): 분할된 문서 청크 리스트.
+        embedding_cache_dir (str): 임베딩 캐시 디렉터리. None이면 캐시를 쓰지 않습니다.
+
+    Returns:
+        Chroma: 생성된 Chroma 벡터 DB.
+    """
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+    from langchain_chroma import Chroma
+
+    logger.info("Creating vector database with Google AI Embeddings...")
+    model_name = "models/embedding-001"
+    embedding = with_embedding_cache(GoogleGenerativeAIEmbeddings(model=model_name), model_name, embedding_cache_dir)
+    vectorstore = Chroma.from_documents(documents=splits, embedding=embedding)
+    return vectorstore
+
+
+
+# 청크 ID 부여 (일련번호 + 행 내용 해시)
+_SERIAL_PATTERN = re.compile(r"^\ufeff?일련번호:\s*(\S+)", re.MULTILINE)
+
+
+def _make_row_id(row_text: str, source, row, seen_row_ids: dict):
+    match = _SERIAL_PATTERN.search(row_text)
+    row_id = match.group(1) if match else f"{source}#{row}"
+    # 원본 데이터에 일련번호가 중복된 행이 있어서, 두 번째부터는 순번을 붙임
+    seen_row_ids[row_id] += 1
+    if seen_row_ids[row_id] > 1:
+        row_id = f"{row_id}~{seen_row_ids[row_id] - 1}"
+    return row_id
+
+
+def assign_chunk_ids(splits: list):
+    """
+    분할된 청크마다 안정적인 ID를 부여합니다.
+    같은 행(metadata["row"])에서 나온 청크들을 묶어 일련번호와 행 내용 해시를 구하고,
+    ID는 "일련번호:행해시:청크순번" 형식이 됩니다.
+    metadata에도 row_id, row_hash를 기록합니다.
+
+    Args:
+        splits (list): load_csv_and_split_documents로 분할된 청크 리스트.
+
+    Returns:
+        list: splits와 같은 순서의 ID 리스트.
+    """
+    chunks_by_row = defaultdict(list)
+    for position, doc in enumerate(splits):
+        chunks_by_row[(doc.metadata.get("source"), doc.metadata.get("row"))].append(position)
+
+    ids = [None] * len(splits)
+    seen_row_ids = defaultdict(int)
+    for (source, row), positions in chunks_by_row.items():
+        row_text = "\n".join(splits[p].page_content for p in positions)
+        # 스트리밍 적재처럼 행 ID를 미리 정해 둔 경우에는 그대로 사용
+        row_id = splits[positions[0]].metadata.get("row_id")
+        if row_id is None:
+            row_id = _make_row_id(row_text, source, row, seen_row_ids)
+        # 메타데이터도 해시에 넣어서, 필터용 메타데이터가 바뀌면 행을 다시 적재함
+        metadata = {key: value for key, value in splits[positions[0]].metadata.items()
+                    if key not in ("row", "row_id", "row_hash", "start_index")}
+        row_key = row_text + json.dumps(metadata, ensure_ascii=False, sort_keys=True)
+        row_hash = hashlib.sha1(row_key.encode("utf-8")).hexdigest()[:16]
+        for chunk_no, position in enumerate(positions):
+            splits[position].metadata["row_id"] = row_id
+            splits[position].metadata["row_hash"] = row_hash
+            ids[position] = f"{row_id}:{row_hash}:{chunk_no}"
+    return ids
+
+
+def _batched(items: list, batch_size: int):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+_CHUNK_ID_PATTERN = re.compile(r"^(.+):([0-9a-f]{16}):(\d+)$")
+
+
+def _existing_row_chunks(vectorstore, page_size: int = 10_000):
+    """
+    컬렉션에 저장된 청크 ID를 행 ID별로 묶습니다.
+    행 ID/해시는 청크 ID("일련번호:행해시:청크순번", assign_chunk_ids)에서 읽으므로 메타데이터는 불러오지 않고,
+    ID만 page_size개씩 나눠 읽습니다. (컬렉션이 커져도 메모리에는 ID만 남음)
+
+    Returns:
+        tuple: (행 ID -> 청크 ID 리스트, 행 ID -> 행 해시, 규칙에 맞지 않는 예전 청크 ID 리스트)
+    """
+    collection = vectorstore._collection
+    old_rows = defaultdict(list)
+    old_hashes = {}
+    unkeyed_ids = []
+    offset = 0
+    while True:
+        ids = collection.get(include=[], limit=page_size, offset=offset)["ids"]
+        for chunk_id in ids:
+            match = _CHUNK_ID_PATTERN.match(chunk_id)
+            if match is None:
+                unkeyed_ids.append(chunk_id)
+                continue
+            old_rows[match.group(1)].append(chunk_id)
+            old_hashes[match.group(1)] = match.group(2)
+        if len(ids) < page_size:
+            break
+        offset += page_size
+    return old_rows, old_hashes, unkeyed_ids
+
+
+def upsert_documents_incremental(vectorstore, splits: list, batch_size: int = 1000):
+    """
+    기존 컬렉션과 비교해서 바뀐 행만 다시 임베딩합니다.
+    - 해시가 같은 행: 건너뜀
+    - 해시가 바뀐 행: 이전 청크 삭제 후 새 청크 추가
+    - 새 행: 추가
+    - CSV에서 사라진 행, ID 없이 들어간 예전 청크: 삭제
+
+    Args:
+        vectorstore (Chroma): 대상 Chroma 벡터 DB.
+        splits (list): 새로 읽은 청크 리스트.
+        batch_size (int): 한 번에 추가/삭제할 청크 수.
+
+    Returns:
+        dict: 행/청크 단위 변경 통계.
+    """
+    ids = assign_chunk_ids(splits)
+
+    new_rows = defaultdict(list)
+    for chunk_id, doc in zip(ids, splits):
+        new_rows[doc.metadata["row_id"]].append((chunk_id, doc))
+
+    old_rows, old_hashes, stale_ids = _existing_row_chunks(vectorstore)
+
+    stats = {"unchanged": 0, "updated": 0, "added": 0, "deleted": 0}
+    add_ids, add_docs = [], []
+    for row_id, chunks in new_rows.items():
+        row_hash = chunks[0][1].metadata["row_hash"]
+        if row_id in old_rows:
+            if old_hashes[row_id] == row_hash:
+                stats["unchanged"] += 1
+                continue
+            stale_ids.extend(old_rows[row_id])
+            stats["updated"] += 1
+        else:
+            stats["added"] += 1
+        for chunk_id, doc in chunks:
+            add_ids.append(chunk_id)
+            add_docs.append(doc)
+
+    for row_id, chunk_ids in old_rows.items():
+        if row_id not in new_rows:
+            stale_ids.extend(chunk_ids)
+            stats["deleted"] += 1
+
+    for batch in _batched(stale_ids, batch_size):
+        vectorstore.delete(ids=batch)
+    for start in range(0, len(add_docs), batch_size):
+        vectorstore.add_documents(add_docs[start:start + batch_size], ids=add_ids[start:start + batch_size])
+
+    stats["chunks_added"] = len(add_docs)
+    stats["chunks_deleted"] = len(stale_ids)
+    logger.info(f"증분 적재 완료: {stats}")
+    return stats
+
+
+# 스트리밍 적재 파이프라인 (대용량 CSV용)
+# 1) CSV를 정해진 행 수만큼씩 읽고 2) 프로세스 풀에서 분할+임베딩 3) Chroma에 배치로 기록.
+# 처리 중인 배치 수를 max_pending으로 묶어 두기 때문에 입력이 커져도 메모리 사용량이 일정합니다.
+def _csv_row_to_document(row: dict, row_no: int, source_column: str = "제목명"):
+    """CSVLoader와 같은 형식("컬럼: 값" 줄 나열)으로 한 행을 Document로 만듭니다."""
+    content = "\n".join(
+        f"{key.strip() if key is not None else key}: {value.strip() if isinstance(value, str) else value}"
+        for key, value in row.items()
+    )
+    return add_row_metadata(Document(page_content=content, metadata={"source": row[source_column], "row": row_no}))
+
+
+def iter_csv_document_batches(file_path, batch_rows: int = 1000, encoding: str = "utf-8"):
+    """
+    CSV 파일을 batch_rows 행씩 읽어 행 단위 Document 리스트를 차례로 돌려줍니다.
+    행 ID(일련번호)는 전체 파일 기준으로 여기서 미리 정합니다.
+    """
+    seen_row_ids = defaultdict(int)
+    row_no = 0
+    with open(file_path, newline="", encoding=encoding) as f:
+        reader = csv.DictReader(f)
+        while True:
+            rows = list(itertools.islice(reader, batch_rows))
+            if not rows:
+                break
+            docs = []
+            for row in rows:
+                doc = _csv_row_to_document(row, row_no)
+                doc.metadata["row_id"] = _make_row_id(doc.page_content, doc.metadata["source"], row_no, seen_row_ids)
+                docs.append(doc)
+                row_no += 1
+            yield docs
+
+
+def _hf_embedding_factory(model_name: str):
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    return HuggingFaceEmbeddings(model_name=model_name)
+
+
+_worker_embedding = None
+
+
+def _init_ingest_worker(embedding_factory, model_name: str):
+    # 워커 프로세스마다 임베딩 모델을 한 번만 로드
+    global _worker_embedding
+    _worker_embedding = embedding_factory(model_name)
+
+
+def _split_and_embed_batch(docs: list, chunk_size: int, chunk_overlap: int, embed_batch_size: int,
+                           embed_fields=None):
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    if embed_fields:
+        splits = [to_row_embedding_document(doc, embed_fields) for doc in docs]
+    else:
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                                       add_start_index=True)
+        splits = text_splitter.split_documents(docs)
+    ids = assign_chunk_ids(splits)
+    texts = [doc.page_content for doc in splits]
+    vectors = []
+    for batch in _batched(texts, embed_batch_size):
+        vectors.extend(_worker_embedding.embed_documents(batch))
+    return len(docs), ids, texts, [doc.metadata for doc in splits], vectors
+
+
+def stream_ingest_csv(file_path,
+                      db_path: str = "./chroma_db",
+                      collection_name: str = "documents",
+                      model_name: str = "jhgan/ko-sbert-nli",
+                      read_batch_rows: int = 1000,
+                      embed_batch_size: int = 64,
+                      write_batch_size: int = 2000,
+                      workers: int = None,
+                      max_pending: int = None,
+                      chunk_size: int = 300,
+                      chunk_overlap: int = 50,
+                      embed_fields: list = None,
+                      embedding_factory=_hf_embedding_factory):
+    """
+    대용량 CSV를 스트리밍으로 읽어 분할/임베딩 후 Chroma에 저장합니다.
+    청크 ID는 assign_chunk_ids와 같은 규칙이라 같은 행은 그대로 upsert 되고,
+    내용이 바뀐 행의 이전 청크와 CSV에서 사라진 행의 청크는 upsert_documents_incremental처럼 삭제합니다.
+
+    Args:
+        file_path (str): CSV 파일 경로.
+        db_path (str): 벡터 DB 저장 경로.
+        collection_name (str): 컬렉션 이름.
+        model_name (str): 임베딩 모델명.
+        read_batch_rows (int): 한 번에 읽어서 워커에 넘길 행 수.
+        embed_batch_size (int): 워커 안에서 한 번에 임베딩할 청크 수.
+        write_batch_size (int): Chroma에 한 번에 기록할 청크 수.
+        workers (int): 프로세스 수. 0이면 현재 프로세스에서 바로 처리합니다.
+            (워커마다 임베딩 모델을 따로 올리므로 메모리를 보고 정하세요.)
+        max_pending (int): 동시에 처리 중일 수 있는 배치 수 (백프레셔). 기본값은 workers * 2.
+        embed_fields (list): 주면 청크 분할 대신 행마다 해당 컬럼만 임베딩합니다.
+            (load_csv_and_split_documents의 embed_fields와 같음)
+        embedding_factory: model_name을 받아 임베딩 객체를 만드는 모듈 수준 함수.
+
+    Returns:
+        dict: 처리한 행/청크 수, 삭제한 행/청크 수, 소요 시간, 처리량.
+    """
+    from langchain_chroma import Chroma
+
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 2) - 1)
+    if max_pending is None:
+        max_pending = max(1, workers * 2)
+
+    if not os.path.exists(db_path):
+        os.makedirs(db_path)
+    vectorstore = Chroma(persist_directory=db_path, collection_name=collection_name)
+    collection = vectorstore._collection
+
+    # 이번 CSV와 비교할 기존 청크 ID (행 ID별). 스트림에서 다시 나온 행은 여기서 빠지고,
+    # 끝까지 남은 행은 CSV에서 사라진 행이므로 마지막에 삭제함
+    old_rows, _, unkeyed_ids = _existing_row_chunks(vectorstore)
+    stale_ids = list(unkeyed_ids)
+
+    stats = {"rows": 0, "chunks": 0, "rows_deleted": 0, "chunks_deleted": 0}
+    write_buffer = {"ids": [], "documents": [], "metadatas": [], "embeddings": []}
+    started = time.perf_counter()
+
+    def delete_stale():
+        for batch in _batched(stale_ids, write_batch_size):
+            collection.delete(ids=batch)
+        stats["chunks_deleted"] += len(stale_ids)
+        stale_ids.clear()
+
+    def flush():
+        if write_buffer["ids"]:
+            collection.upsert(**write_buffer)
+            for values in write_buffer.values():
+                values.clear()
+        # 새 청크를 기록한 다음에 이전 청크를 지워서, 적재 중에도 검색 결과가 비지 않게 함
+        delete_stale()
+
+    def collect(result):
+        n_rows, ids, texts, metadatas, vectors = result
+        new_ids = set(ids)
+        for row_id in {metadata["row_id"] for metadata in metadatas}:
+            stale_ids.extend(chunk_id for chunk_id in old_rows.pop(row_id, ()) if chunk_id not in new_ids)
+        write_buffer["ids"].extend(ids)
+        write_buffer["documents"].extend(texts)
+        write_buffer["metadatas"].extend(metadatas)
+        write_buffer["embeddings"].extend(vectors)
+        if len(write_buffer["ids"]) >= write_batch_size:
+            flush()
+        stats["rows"] += n_rows
+        stats["chunks"] += len(ids)
+        elapsed = time.perf_counter() - started
+        logger.info(f"[ingest] rows={stats['rows']} chunks={stats['chunks']} "
+                    f"{stats['rows'] / elapsed:.1f} rows/s {stats['chunks'] / elapsed:.1f} chunks/s")
+
+    batches = iter_csv_document_batches(file_path, batch_rows=read_batch_rows)
+    task_args = (chunk_size, chunk_overlap, embed_batch_size, embed_fields)
+    if workers == 0:
+        _init_ingest_worker(embedding_factory, model_name)
+        for docs in batches:
+            collect(_split_and_embed_batch(docs, *task_args))
+    else:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_ingest_worker,
+                                 initargs=(embedding_factory, model_name)) as executor:
+            pending = set()
+            for docs in batches:
+                # 처리 중인 배치가 가득 차면 하나가 끝날 때까지 CSV 읽기를 멈춤
+                while len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(future.result())
+                pending.add(executor.submit(_split_and_embed_batch, docs, *task_args))
+            done, _ = wait(pending)
+            for future in done:
+                collect(future.result())
+    for chunk_ids in old_rows.values():
+        stale_ids.extend(chunk_ids)
+    stats["rows_deleted"] = len(old_rows)
+    flush()
+
+    stats["seconds"] = time.perf_counter() - started
+    stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["seconds"] else 0.0
+    stats["chunks_per_second"] = stats["chunks"] / stats["seconds"] if stats["seconds"] else 0.0
+    logger.info(f"스트리밍 적재 완료: {stats}")
+    return stats
+
+
+# 하드디스크 저장
+def create_vector_db_with_hf(splits: list, 
+                             db_path: str = "./chroma_db",
+                             collection_name: str = "documents",
+                             incremental: bool = False,
+                             embedding_cache_dir: str = "./cache/embeddings",
+                             embeddings: Embeddings = None,
+                             shard_by: str = None,
+                             n_hash_shards: int = 8,
+                             only_shards: list = None,
+                             ):
+    """
+    분할된 문서 청크를 사용하여 ChromaDB 벡터 DB를 생성하고 파일로 저장합니다.
+    Hugging Face의 한국어 임베딩 모델을 사용합니다.
+
+    Args:
+        splits (list): 분할된 문서 청크 리스트.
+            load_csv_and_split_documents(embed_fields=...)로 만든 행 단위 문서도 그대로 넣으면
+            행 하나당 벡터 하나로 저장됩니다.
+        db_path (str): 벡터 DB 파일이 저장될 디렉터리 경로.
+        collection_name (str): 컬렉션 이름.
+        incremental (bool): True면 기존 컬렉션과 비교해 바뀐 행만 반영합니다.
+            (일련번호 + 내용 해시 기반, upsert_documents_incremental 참고)
+        embedding_cache_dir (str): 임베딩 캐시 디렉터리. None이면 캐시를 쓰지 않습니다.
+        embeddings (Embeddings): 이미 만들어 둔 임베딩 객체 (벤치마크의 가짜 임베딩 등).
+            주면 Hugging Face 모델을 로드하지 않고 그대로 사용합니다.
+        shard_by (str): "media"(미디어유형), "region"(지역), "hash"(행 ID 해시) 중 하나를 주면
+            샤드별 컬렉션("{collection_name}__{샤드}")으로 나눠 저장하고 shards.json에 기록합니다.
+        n_hash_shards (int): shard_by="hash"일 때 샤드 수.
+        only_shards (list): 주어진 샤드 값(예: ["movie"])만 다시 만들고 나머지 샤드는 그대로 둡니다.
+
+    Returns:
+        Chroma: 생성된 Chroma 벡터 DB. (샤딩하면 ShardedVectorStore)
+    """
+    from langchain_chroma import Chroma
+
+    logger.info("Creating vector database with Hugging Face Embeddings (Sentence-Transformers)...")
+    
+    # 'jhgan/ko-sbert-nli' 모델 로드
+    model_name = "jhgan/ko-sbert-nli"
+    if embeddings is not None:
+        embedding = embeddings
+    else:
+        embedding = with_embedding_cache(_hf_embedding_factory(model_name), model_name, embedding_cache_dir)
+    
+    # DB 파일 저장 경로 확인 및 생성
+    if not os.path.exists(db_path):
+        os.makedirs(db_path)
+
+    if shard_by is not None:
+        return _create_sharded_vector_db(splits, db_path, collection_name, embedding, shard_by=shard_by,
+                                         n_hash_shards=n_hash_shards, only_shards=only_shards,
+                                         incremental=incremental)
+    
+    if incremental:
+        vectorstore = Chroma(
+            persist_directory=db_path,
+            embedding_function=embedding,
+            collection_name=collection_name
+        )
+        upsert_documents_incremental(vectorstore, splits)
+        logger.info(f"Vector DB successfully updated at: {db_path}")
+        return vectorstore
+
+    # persist_directory를 사용하여 DB를 파일로 저장
+    # (안정적인 ID로 저장해서 다시 실행해도 같은 청크가 중복 추가되지 않음)
+    vectorstore = Chroma.from_documents(
+        documents=splits,
+        embedding=embedding,
+        ids=assign_chunk_ids(splits),
+        persist_directory=db_path,
+        collection_name=collection_name
+    )
+    
+    # DB 저장
+    logger.info(f"Vector DB successfully created and saved at: {db_path}")
+
+    return vectorstore
+
+# Chroma DB 로드 (한국어 SBERT 모델 사용)
+def load_vector_db(persist_directory: str = "./chroma_db", 
+                   collection_name: str = "documents",
+                   model_name: str = "jhgan/ko-sbert-nli",
+                   embedding_cache_dir: str = "./cache/embeddings",
+                   embeddings: Embeddings = None):
+    """
+    기존 Chroma DB 로드
+    
+    Args:
+        persist_directory: Chroma DB 저장 경로
+        collection_name: 컬렉션 이름
+        model_name: HuggingFace 임베딩 모델명
+        embedding_cache_dir: 검색어 임베딩 캐시 디렉터리 (None이면 사용 안 함)
+        embeddings: 이미 만들어 둔 임베딩 객체 (공유 리소스 재사용용, 주면 model_name은 무시)
+    
+    Returns:
+        Chroma vectorstore 객체
+    """
+    from langchain_chroma import Chroma
+
+    # 한국어 SBERT 모델 초기화 (저장할 때와 동일한 모델 사용)
+    if embeddings is None:
+        embeddings = with_embedding_cache(_hf_embedding_factory(model_name), model_name, embedding_cache_dir)
+    
+    # 샤딩해서 만든 컬렉션이면 샤드 전체를 묶어서 로드
+    manifest = read_shard_manifest(persist_directory).get(collection_name)
+    if manifest is not None:
+        with get_tracer().span("load_vector_db", collection=collection_name, shards=len(manifest["shards"])):
+            vectorstore = ShardedVectorStore(persist_directory, collection_name, TracedEmbeddings(embeddings),
+                                             manifest)
+        logger.info(f"크로마DB 로딩 완료. (샤드 {len(manifest['shards'])}개)")
+        return vectorstore
+
+    # Chroma DB 로드 (검색어 임베딩 시간은 embed_query span으로 기록)
+    with get_tracer().span("load_vector_db", collection=collection_name):
+        vectorstore = Chroma(
+            persist_directory=persist_directory,
+            embedding_function=TracedEmbeddings(embeddings),
+            collection_name=collection_name
+        )
+    logger.info("크로마DB 로딩 완료.")
+    
+    return vectorstore
+
+# 샤딩 (미디어유형 / 지역 / 해시별 컬렉션)
+# 컬렉션 "{이름}__{샤드}"마다 따로 저장하고, 어떤 샤드가 있는지는 persist 디렉터리의 shards.json에 기록합니다.
+# 검색어에서 미디어유형/지역 조건을 찾으면 해당 샤드만, 아니면 모든 샤드를 동시에 검색해서 거리순으로 합칩니다.
+SHARD_FIELDS = {"media": "미디어유형", "region": "지역", "hash": None}
+SHARD_MANIFEST_FILE = "shards.json"
+
+
+def shard_value(metadata: dict, shard_by: str, n_hash_shards: int = 8):
+    """청크 메타데이터가 들어갈 샤드 값 (같은 행의 청크는 항상 같은 샤드)"""
+    if shard_by not in SHARD_FIELDS:
+        raise ValueError(f"shard_by는 {tuple(SHARD_FIELDS)} 중 하나여야 합니다: {shard_by}")
+    if shard_by == "hash":
+        key = str(metadata.get("row_id", (metadata.get("source"), metadata.get("row"))))
+        return f"h{int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % n_hash_shards}"
+    return metadata.get(SHARD_FIELDS[shard_by]) or "unknown"
+
+
+def shard_collection_name(collection_name: str, value: str):
+    """샤드 컬렉션 이름. Chroma 이름 규칙(영문/숫자/_-.)에 맞지 않는 값(한글 지역명 등)은 해시로 바꿈"""
+    slug = value if re.fullmatch(r"[A-Za-z0-9_-]+", value) else "x" + hashlib.sha1(value.encode("utf-8")).hexdigest()[:10]
+    return f"{collection_name}__{slug}"
+
+
+def read_shard_manifest(persist_directory: str):
+    """shards.json 내용 ({컬렉션 이름: {"shard_by", "field", "shards": {값: {"collection", "count"}}}})"""
+    try:
+        with open(os.path.join(persist_directory, SHARD_MANIFEST_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_shard_manifest(persist_directory: str, collection_name: str, entry: dict):
+    manifest = read_shard_manifest(persist_directory)
+    manifest[collection_name] = entry
+    path = os.path.join(persist_directory, SHARD_MANIFEST_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def _create_sharded_vector_db(splits: list, db_path: str, collection_name: str, embedding: Embeddings,
+                              shard_by: str, n_hash_shards: int = 8, only_shards: list = None,
+                              incremental: bool = False):
+    """create_vector_db_with_hf(shard_by=...)의 실제 구현. 샤드마다 컬렉션 하나씩 만듭니다."""
+    # 해시 샤딩이 행 단위가 되도록 row_id를 먼저 정함
+    assign_chunk_ids(splits)
+    grouped = defaultdict(list)
+    for doc in splits:
+        grouped[shard_value(doc.metadata, shard_by, n_hash_shards)].append(doc)
+
+    previous = read_shard_manifest(db_path).get(collection_name)
+    shards = dict(previous["shards"]) if previous and previous["shard_by"] == shard_by and only_shards else {}
+    for value, shard_splits in sorted(grouped.items()):
+        if only_shards is not None and value not in only_shards:
+            continue
+        name = shard_collection_name(collection_name, value)
+        create_vector_db_with_hf(shard_splits, db_path=db_path, collection_name=name, incremental=incremental,
+                                 embeddings=embedding)
+        shards[value] = {"collection": name, "count": len(shard_splits)}
+        logger.info(f"샤드 적재: {value} -> {name} ({len(shard_splits)}개 청크)")
+
+    # 일부 샤드만 다시 만들 때, 미디어유형/지역이 바뀌어 다시 만든 샤드로 옮겨 온 행은
+    # 다시 만들지 않은 이전 샤드에도 남아 있으므로 그 청크를 지움
+    if only_shards is not None:
+        from langchain_chroma import Chroma
+
+        rebuilt_row_ids = {doc.metadata["row_id"] for value in only_shards for doc in grouped.get(value, ())}
+        for value, info in list(shards.items()):
+            if value in only_shards:
+                continue
+            store = Chroma(persist_directory=db_path, collection_name=info["collection"])
+            old_rows, _, _ = _existing_row_chunks(store)
+            moved_ids = [chunk_id for row_id in rebuilt_row_ids & old_rows.keys() for chunk_id in old_rows[row_id]]
+            for batch in _batched(moved_ids, 1000):
+                store._collection.delete(ids=batch)
+            if moved_ids:
+                shards[value] = {**info, "count": max(0, info.get("count", 0) - len(moved_ids))}
+                logger.info(f"샤드 이동: {value}에서 다른 샤드로 옮겨 간 청크 {len(moved_ids)}개 삭제")
+
+    manifest = {"shard_by": shard_by, "field": SHARD_FIELDS[shard_by], "n_hash_shards": n_hash_shards,
+                "shards": shards}
+    _write_shard_manifest(db_path, collection_name, manifest)
+    return ShardedVectorStore(db_path, collection_name, embedding, manifest)
+
+
+def _where_conditions(where: dict):
+    """Chroma where({"키": 값} 또는 {"$and": [...]})에서 단순 일치 조건만 dict로 뽑습니다."""
+    if not where:
+        return {}
+    if "$and" in where:
+        conditions = {}
+        for clause in where["$and"]:
+            conditions.update(_where_conditions(clause))
+        return conditions
+    return {key: value for key, value in where.items()
+            if not key.startswith("$") and not isinstance(value, dict)}
+
+
+def _drop_condition(where: dict, key: str):
+    """where에서 key에 대한 단순 일치 조건을 뺍니다. (남는 조건이 없으면 None)"""
+    if not where:
+        return None
+    if "$and" in where:
+        clauses = [clause for clause in where["$and"] if set(clause) != {key}]
+        return clauses[0] if len(clauses) == 1 else ({"$and": clauses} if clauses else None)
+    return None if set(where) == {key} else where
+
+
+class ShardedVectorStore(VectorStore):
+    """
+    샤드 컬렉션 여러 개를 하나의 벡터 저장소처럼 쓰는 래퍼.
+    검색은 샤드별로 실행해서 거리(작을수록 가까움) 기준 top-k로 합칩니다.
+    검색할 샤드의 청크 수 합이 parallel_min_chunks 이상이면 스레드 풀에서 동시에, 그보다 작으면 차례로 실행합니다.
+    """
+
+    def __init__(self, persist_directory: str, collection_name: str, embedding: Embeddings, manifest: dict,
+                 max_workers: int = 8, parallel_min_chunks: int = 50_000):
+        from concurrent.futures import ThreadPoolExecutor
+        from langchain_chroma import Chroma
+
+        self.persist_directory = persist_directory
+        self.collection_name = collection_name
+        self._embedding = embedding
+        self.manifest = manifest
+        self.parallel_min_chunks = parallel_min_chunks
+        self.field = manifest.get("field")
+        self.shards = {
+            value: Chroma(persist_directory=persist_directory, embedding_function=embedding,
+                          collection_name=info["collection"])
+            for value, info in manifest["shards"].items()
+        }
+        self._executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(self.shards))),
+                                            thread_name_prefix="shard")
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    def route(self, conditions: dict):
+        """
+        조건에 샤드 필드(미디어유형/지역) 값이 있으면 그 샤드만, 없으면 전체 샤드 값 리스트.
+        값에 해당하는 샤드가 없으면 빈 리스트.
+        """
+        if self.field and self.field in conditions:
+            value = conditions[self.field]
+            return [value] if value in self.shards else []
+        return list(self.shards)
+
+    def _fan_out(self, shard_values: list, search):
+        """
+        search(Chroma)를 샤드별로 실행해서 결과 리스트를 돌려줍니다.
+        검색할 샤드의 청크 수 합이 parallel_min_chunks 이상일 때만 스레드 풀로 동시에 실행합니다.
+        (작은 샤드는 Chroma 질의 고정 비용이 대부분이라 스레드로 나누면 오히려 느림: 2만 행 기준 9ms -> 18ms)
+        """
+        total = sum(self.manifest["shards"][value].get("count", 0) for value in shard_values)
+        if len(shard_values) == 1 or total < self.parallel_min_chunks:
+            return [search(self.shards[value]) for value in shard_values]
+        context = contextvars.copy_context()
+        futures = [self._executor.submit(context.copy().run, search, self.shards[value]) for value in shard_values]
+        return [future.result() for future in futures]
+
+    def similarity_search_by_vectors_with_score(self, embeddings: list, k: int = 4, filter: dict = None,
+                                                shards: list = None):
+        """
+        여러 검색어 벡터를 샤드별 Chroma 질의 한 번씩으로 검색합니다.
+
+        Returns:
+            list: 검색어마다 (Document, 거리) 리스트.
+        """
+        shard_values = shards if shards is not None else self.route(_where_conditions(filter))
+        # 샤드 안의 문서는 모두 샤드 필드 조건을 만족하므로 그 조건은 빼고 질의 (Chroma where 필터는 느림)
+        where = _drop_condition(filter, self.field) if self.field else filter
+
+        def search(store):
+            result = store._collection.query(query_embeddings=embeddings, n_results=k, where=where or None,
+                                             include=["documents", "metadatas", "distances"])
+            return [
+                [(Document(page_content=text, metadata=metadata or {}, id=doc_id), distance)
+                 for doc_id, text, metadata, distance in zip(ids, texts, metadatas, distances)]
+                for ids, texts, metadatas, distances in zip(result["ids"], result["documents"],
+                                                             result["metadatas"], result["distances"])
+            ]
+
+        with get_tracer().span("shard_search", shards=len(shard_values)):
+            per_shard = self._fan_out(shard_values, search) if shard_values else []
+        merged = []
+        for i in range(len(embeddings)):
+            candidates = [pair for shard_results in per_shard for pair in shard_results[i]]
+            merged.append(sorted(candidates, key=lambda pair: pair[1])[:k])
+        return merged
+
+    def similarity_search_by_vector_with_score(self, embedding: list, k: int = 4, filter: dict = None,
+                                               shards: list = None, **kwargs):
+        return self.similarity_search_by_vectors_with_score([embedding], k=k, filter=filter, shards=shards)[0]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: dict = None, shards: list = None,
+                                     **kwargs):
+        return self.similarity_search_by_vector_with_score(self._embedding.embed_query(query), k=k, filter=filter,
+                                                           shards=shards)
+
+    def similarity_search_by_vector(self, embedding: list, k: int = 4, filter: dict = None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k=k, filter=filter,
+                                                                              **kwargs)]
+
+    def similarity_search(self, query: str, k: int = 4, filter: dict = None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, filter=filter, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        return self._euclidean_relevance_score_fn
+
+    @classmethod
+    def from_texts(cls, texts: list, embedding: Embeddings, metadatas: list = None, ids: list = None,
+                   persist_directory: str = "./chroma_db", collection_name: str = "documents",
+                   shard_by: str = "hash", n_hash_shards: int = 8, **kwargs):
+        """
+        텍스트를 샤드별 컬렉션에 저장하고 불러온 저장소를 반환합니다. (_create_sharded_vector_db와 같음)
+        청크 ID는 assign_chunk_ids 규칙으로 정하므로 ids는 쓰지 않습니다.
+        (metadata에 row가 없으면 텍스트 하나를 한 행으로 봄)
+        """
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        splits = [Document(page_content=text, metadata={"row": i, **metadata})
+                  for i, (text, metadata) in enumerate(zip(texts, metadatas))]
+        os.makedirs(persist_directory, exist_ok=True)
+        return _create_sharded_vector_db(splits, persist_directory, collection_name, embedding, shard_by=shard_by,
+                                         n_hash_shards=n_hash_shards, **kwargs)
+
+    def get(self, include: list = None, **kwargs):
+        """모든 샤드의 get() 결과를 합칩니다. (build_lexical_index 등에서 사용)"""
+        merged = {"ids": [], "documents": [], "metadatas": []}
+        for store in self.shards.values():
+            stored = store.get(include=include or ["documents", "metadatas"], **kwargs)
+            for key in merged:
+                merged[key].extend(stored.get(key) or [])
+        return merged
+
+    def collection_version(self):
+        """답변 캐시 키용 버전 문자열 (샤드 전체의 청크 ID 해시)"""
+        ids = sorted(doc_id for store in self.shards.values() for doc_id in store._collection.get(include=[])["ids"])
+        digest = hashlib.sha1("\n".join(ids).encode("utf-8")).hexdigest()[:12]
+        return f"{self.collection_name}:{len(ids)}:{digest}:shards={len(self.shards)}"
+
+
+class ShardedRetriever(BaseRetriever):
+    """
+    검색어 조건(QueryFilterExtractor)으로 필요한 샤드만 골라 동시에 검색하는 검색기.
+    조건에 맞는 문서가 없으면 모든 샤드를 필터 없이 다시 검색합니다.
+    """
+
+    vectorstore: Any
+    filter_extractor: Any = None
+    k: int = 5
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        conditions = self.filter_extractor.extract(query) if self.filter_extractor is not None else {}
+        where = self.filter_extractor.to_where(query) if conditions else None
+        shards = self.vectorstore.route(conditions)
+        docs = []
+        if shards:
+            logger.debug(f"샤드 라우팅: {shards} (조건: {conditions})")
+            docs = self.vectorstore.similarity_search(query, k=self.k, filter=where, shards=shards)
+        if not docs:
+            docs = self.vectorstore.similarity_search(query, k=self.k, shards=list(self.vectorstore.shards))
+        return docs
+
+
+# 메모리 매핑 양자화 벡터 저장소 (읽기 위주 촬영지 카탈로그용 Chroma 대안)
+# 디렉터리 구성:
+#   vectors.bin  - (행 수, 차원) float16/int8 행렬 (np.memmap으로 필요한 부분만 읽음)
+#   scales.npy   - int8일 때 행별 스케일 (값 = int8 * scale)
+#   norms.npy    - 양자화된 벡터의 제곱 노름 (L2 거리 계산용)
+#   docs.jsonl   - 메타데이터 사이드카 (행마다 {"id", "text", "metadata"}), docs_offsets.npy로 필요한 줄만 읽음
+#   ivf.npz      - (선택) IVF 중심점과 클러스터별 행 범위. 행은 클러스터 순서로 저장됩니다.
+#   meta.json    - 차원, dtype, 행 수, 클러스터 수
+MEMMAP_DTYPES = ("float32", "float16", "int8")
+
+
+def _nearest_centroids(vectors: np.ndarray, centroids: np.ndarray, n: int = 1):
+    """각 벡터에서 가까운 중심점 n개의 번호 (가까운 순)"""
+    distances = (centroids ** 2).sum(axis=1)[None, :] - 2 * vectors @ centroids.T
+    n = min(n, len(centroids))
+    nearest = np.argpartition(distances, n - 1, axis=1)[:, :n]
+    order = np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1)
+    return np.take_along_axis(nearest, order, axis=1)
+
+
+def _kmeans(vectors: np.ndarray, n_clusters: int, n_iter: int = 20, sample_size: int = 50_000, seed: int = 0):
+    """IVF 중심점용 k-means (표본으로 학습)"""
+    rng = np.random.default_rng(seed)
+    sample = vectors[np.sort(rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False))]
+    sample = np.asarray(sample, dtype=np.float32)
+    n_clusters = min(n_clusters, len(sample))
+    centroids = sample[rng.choice(len(sample), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = _nearest_centroids(sample, centroids)[:, 0]
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=n_clusters)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+class MemmapVectorStore(VectorStore):
+    """
+    양자화(float16/int8) 임베딩을 메모리 매핑 파일 하나에 두고 NumPy 행렬 곱으로 정확한 top-k를 찾는 벡터 저장소.
+    거리는 Chroma 기본값과 같은 L2 제곱 거리입니다. nlist > 0으로 만들면 IVF로 가까운 클러스터(nprobe개)만 검색합니다.
+
+    읽기 위주 용도라 문서 추가/삭제는 지원하지 않습니다. 데이터가 바뀌면 from_documents로 다시 만듭니다.
+    """
+
+    def __init__(self, persist_directory: str, embedding: Embeddings, nprobe: int = 8, batch_rows: int = 65536):
+        self.persist_directory = persist_directory
+        self._embedding = embedding
+        self.nprobe = nprobe
+        self.batch_rows = batch_rows
+
+        with open(os.path.join(persist_directory, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.dim = self.meta["dim"]
+        self.dtype = self.meta["dtype"]
+        self.count = self.meta["count"]
+        self._vectors = np.memmap(os.path.join(persist_directory, "vectors.bin"), dtype=self.dtype, mode="r",
+                                  shape=(self.count, self.dim)) if self.count else np.zeros((0, self.dim))
+        self._norms = np.load(os.path.join(persist_directory, "norms.npy"))
+        self._scales = np.load(os.path.join(persist_directory, "scales.npy")) if self.dtype == "int8" else None
+        self._docs = np.memmap(os.path.join(persist_directory, "docs.jsonl"), dtype=np.uint8, mode="r") \
+            if self.count else np.zeros(0, dtype=np.uint8)
+        self._doc_offsets = np.load(os.path.join(persist_directory, "docs_offsets.npy"))
+        self._centroids = self._list_offsets = None
+        if self.meta.get("nlist"):
+            ivf = np.load(os.path.join(persist_directory, "ivf.npz"))
+            self._centroids, self._list_offsets = ivf["centroids"], ivf["offsets"]
+        self._columns = {}
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    def __len__(self):
+        return self.count
+
+    # 저장
+    @classmethod
+    def from_texts(cls, texts: list, embedding: Embeddings, metadatas: list = None, ids: list = None,
+                   persist_directory: str = "./memmap_db", dtype: str = "float16", nlist: int = 0,
+                   embed_batch_size: int = 1024, **kwargs):
+        """
+        텍스트를 임베딩해서 persist_directory에 저장하고 불러온 저장소를 반환합니다. (기존 파일은 덮어씀)
+
+        Args:
+            dtype (str): "float32", "float16" 또는 "int8" (행별 스케일 양자화).
+            nlist (int): IVF 클러스터 수. 0이면 IVF 없이 전체를 정확히 검색합니다.
+                (대략 sqrt(행 수) 정도가 적당하며, 수십만 행 이상일 때 효과가 큼)
+        """
+        if dtype not in MEMMAP_DTYPES:
+            raise ValueError(f"dtype은 {MEMMAP_DTYPES} 중 하나여야 합니다: {dtype}")
+        os.makedirs(persist_directory, exist_ok=True)
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [_text_hash(text) for text in texts]
+        count = len(texts)
+
+        # 1) 임베딩을 배치로 계산하면서 바로 양자화해서 파일에 씀 (전체 float32 행렬을 메모리에 두지 않음)
+        vectors_path = os.path.join(persist_directory, "vectors.bin")
+        vectors = norms = scales = None
+        for start, batch in zip(itertools.count(0, embed_batch_size), _batched(texts, embed_batch_size)):
+            block = np.asarray(embedding.embed_documents(batch), dtype=np.float32)
+            if vectors is None:
+                dim = block.shape[1]
+                vectors = np.memmap(vectors_path, dtype=dtype, mode="w+", shape=(count, dim))
+                norms = np.zeros(count, dtype=np.float32)
+                scales = np.ones(count, dtype=np.float32)
+            end = start + len(block)
+            if dtype == "int8":
+                block_scales = np.abs(block).max(axis=1) / 127.0
+                block_scales[block_scales == 0] = 1.0
+                quantized = np.round(block / block_scales[:, None]).astype(np.int8)
+                scales[start:end] = block_scales
+                restored = quantized.astype(np.float32) * block_scales[:, None]
+            else:
+                quantized = block.astype(dtype)
+                restored = quantized.astype(np.float32)
+            vectors[start:end] = quantized
+            norms[start:end] = (restored ** 2).sum(axis=1)
+        if vectors is None:
+            dim = len(embedding.embed_query("dimension"))
+            norms = scales = np.zeros(0, dtype=np.float32)
+            open(vectors_path, "wb").close()
+        else:
+            vectors.flush()
+
+        # 2) IVF: 중심점을 학습하고 행을 클러스터 순서로 다시 씀
+        order = np.arange(count)
+        ivf = None
+        if nlist and count:
+            def restore(rows):
+                block = np.asarray(vectors[rows], dtype=np.float32)
+                return block * scales[rows, None] if dtype == "int8" else block
+
+            sample_rows = np.sort(np.random.default_rng(0).choice(count, min(50_000, count), replace=False))
+            centroids = _kmeans(restore(sample_rows), nlist)
+            assign = np.concatenate([
+                _nearest_centroids(restore(np.arange(start, min(start + 65536, count))), centroids)[:, 0]
+                for start in range(0, count, 65536)
+            ])
+            order = np.argsort(assign, kind="stable")
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=len(centroids)))])
+            ivf = {"centroids": centroids.astype(np.float32), "offsets": offsets.astype(np.int64)}
+
+            reordered = np.memmap(vectors_path + ".tmp", dtype=dtype, mode="w+", shape=(count, dim))
+            for start in range(0, count, 65536):
+                reordered[start:start + 65536] = vectors[order[start:start + 65536]]
+            reordered.flush()
+            del vectors, reordered
+            os.replace(vectors_path + ".tmp", vectors_path)
+            norms, scales = norms[order], scales[order]
+        else:
+            del vectors
+
+        # 3) 사이드카와 메타 정보
+        offsets = np.zeros(count + 1, dtype=np.int64)
+        with open(os.path.join(persist_directory, "docs.jsonl"), "wb") as f:
+            for position, row in enumerate(order):
+                line = json.dumps({"id": ids[row], "text": texts[row], "metadata": metadatas[row] or {}},
+                                  ensure_ascii=False).encode("utf-8") + b"\n"
+                f.write(line)
+                offsets[position + 1] = offsets[position] + len(line)
+        np.save(os.path.join(persist_directory, "docs_offsets.npy"), offsets)
+        np.save(os.path.join(persist_directory, "norms.npy"), norms)
+        if dtype == "int8":
+            np.save(os.path.join(persist_directory, "scales.npy"), scales)
+        ivf_path = os.path.join(persist_directory, "ivf.npz")
+        if ivf is not None:
+            np.savez(ivf_path, **ivf)
+        elif os.path.exists(ivf_path):
+            os.remove(ivf_path)
+        with open(os.path.join(persist_directory, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"dim": dim, "dtype": dtype, "count": count, "nlist": len(ivf["centroids"]) if ivf else 0},
+                      f)
+        return cls(persist_directory, embedding, **kwargs)
+
+    # 사이드카 읽기
+    def _record(self, position: int):
+        start, end = self._doc_offsets[position], self._doc_offsets[position + 1]
+        return json.loads(self._docs[start:end].tobytes())
+
+    def _document(self, position: int):
+        record = self._record(position)
+        return Document(page_content=record["text"], metadata=record["metadata"], id=record["id"])
+
+    def get(self, ids: list = None, include: list = None, **kwargs):
+        """Chroma의 get()과 같은 모양의 dict를 반환합니다. (build_lexical_index 등에서 사용)"""
+        wanted = set(ids) if ids is not None else None
+        result = {"ids": [], "documents": [], "metadatas": []}
+        for position in range(self.count):
+            record = self._record(position)
+            if wanted is not None and record["id"] not in wanted:
+                continue
+            result["ids"].append(record["id"])
+            result["documents"].append(record["text"])
+            result["metadatas"].append(record["metadata"])
+        return result
+
+    def get_by_ids(self, ids, /):
+        stored = self.get(ids=list(ids))
+        return [Document(page_content=text, metadata=metadata, id=doc_id)
+                for doc_id, text, metadata in zip(stored["ids"], stored["documents"], stored["metadatas"])]
+
+    def collection_version(self):
+        """답변 캐시 키용 버전 문자열 (get_collection_version 참고)"""
+        ids = sorted(self.get()["ids"])
+        digest = hashlib.sha1("\n".join(ids).encode("utf-8")).hexdigest()[:12]
+        return f"memmap:{os.path.basename(os.path.normpath(self.persist_directory))}:{len(ids)}:{digest}"
+
+    # 메타데이터 필터 (Chroma where 형식: {"키": 값}, {"$and": [...]}, {"$or": [...]}, $eq/$ne/$in/$nin/$gt...)
+    def _column(self, key: str):
+        if key not in self._columns:
+            values = np.empty(self.count, dtype=object)
+            for position in range(self.count):
+                values[position] = self._record(position)["metadata"].get(key)
+            self._columns[key] = values
+        return self._columns[key]
+
+    def _where_mask(self, where: dict):
+        mask = np.ones(self.count, dtype=bool)
+        for key, condition in where.items():
+            if key in ("$and", "$or"):
+                masks = [self._where_mask(clause) for clause in condition]
+                combined = np.logical_and.reduce(masks) if key == "$and" else np.logical_or.reduce(masks)
+                mask &= combined
+                continue
+            column = self._column(key)
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            for op, value in condition.items():
+                if op == "$eq":
+                    mask &= column == value
+                elif op == "$ne":
+                    mask &= column != value
+                elif op in ("$in", "$nin"):
+                    hit = np.isin(column, list(value))
+                    mask &= hit if op == "$in" else ~hit
+                elif op in ("$gt", "$gte", "$lt", "$lte"):
+                    numbers = np.array([v if isinstance(v, (int, float)) else np.nan for v in column], dtype=float)
+                    with np.errstate(invalid="ignore"):
+                        mask &= {"$gt": numbers > value, "$gte": numbers >= value,
+                                 "$lt": numbers < value, "$lte": numbers <= value}[op]
+                else:
+                    raise ValueError(f"지원하지 않는 where 연산자: {op}")
+        return mask
+
+    # 검색
+    def _distances(self, queries: np.ndarray, rows):
+        """queries(n, 차원)와 rows(슬라이스 또는 행 번호 배열) 사이의 L2 제곱 거리 (n, 행 수)"""
+        block = np.asarray(self._vectors[rows], dtype=np.float32)
+        dots = queries @ block.T
+        if self._scales is not None:
+            dots *= self._scales[rows][None, :]
+        return (queries ** 2).sum(axis=1)[:, None] + self._norms[rows][None, :] - 2 * dots
+
+    def _exact_top_k(self, queries: np.ndarray, k: int, candidates: np.ndarray = None):
+        """후보 행(None이면 전체) 중 배치 단위로 거리를 계산하며 top-k를 유지합니다."""
+        n_rows = self.count if candidates is None else len(candidates)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        best_distances = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, n_rows, self.batch_rows):
+            end = min(start + self.batch_rows, n_rows)
+            rows = np.arange(start, end) if candidates is None else candidates[start:end]
+            distances = self._distances(queries, slice(start, end) if candidates is None else rows)
+            best_distances = np.concatenate([best_distances, distances], axis=1)
+            best_rows = np.concatenate([best_rows, np.broadcast_to(rows, distances.shape)], axis=1)
+            if best_distances.shape[1] > k:
+                keep = np.argpartition(best_distances, k - 1, axis=1)[:, :k]
+                best_distances = np.take_along_axis(best_distances, keep, axis=1)
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+        order = np.argsort(best_distances, axis=1, kind="stable")
+        return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_distances, order, axis=1)
+
+    def similarity_search_by_vectors_with_score(self, embeddings: list, k: int = 4, filter: dict = None):
+        """
+        여러 검색어 벡터를 한 번에 검색합니다.
+
+        Returns:
+            list: 검색어마다 (Document, L2 제곱 거리) 리스트.
+        """
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        if self.count == 0 or k <= 0:
+            return [[] for _ in queries]
+        mask = self._where_mask(filter) if filter else None
+
+        if self._centroids is None:
+            candidates = np.flatnonzero(mask) if mask is not None else None
+            pairs = list(zip(*self._exact_top_k(queries, k, candidates)))
+        else:
+            # IVF: 검색어마다 가까운 클러스터 nprobe개의 행만 후보로 사용
+            pairs = []
+            probes = _nearest_centroids(queries, self._centroids, self.nprobe)
+            for query, clusters in zip(queries, probes):
+                candidates = np.concatenate([
+                    np.arange(self._list_offsets[c], self._list_offsets[c + 1]) for c in clusters
+                ])
+                if mask is not None:
+                    candidates = candidates[mask[candidates]]
+                rows, distances = self._exact_top_k(query[None, :], k, np.sort(candidates))
+                pairs.append((rows[0], distances[0]))
+
+        return [
+            [(self._document(int(row)), float(distance)) for row, distance in zip(rows, distances)]
+            for rows, distances in pairs
+        ]
+
+    def similarity_search_by_vector_with_score(self, embedding: list, k: int = 4, filter: dict = None, **kwargs):
+        return self.similarity_search_by_vectors_with_score([embedding], k=k, filter=filter)[0]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: dict = None, **kwargs):
+        return self.similarity_search_by_vector_with_score(self._embedding.embed_query(query), k=k, filter=filter)
+
+    def similarity_search_by_vector(self, embedding: list, k: int = 4, filter: dict = None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k=k, filter=filter)]
+
+    def similarity_search(self, query: str, k: int = 4, filter: dict = None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, filter=filter)]
+
+    def _select_relevance_score_fn(self):
+        return self._euclidean_relevance_score_fn
+
+
+def create_memmap_vector_db(splits: list,
+                            db_path: str = "./memmap_db",
+                            dtype: str = "float16",
+                            nlist: int = 0,
+                            embedding_cache_dir: str = "./cache/embeddings",
+                            embeddings: Embeddings = None):
+    """
+    분할된 문서 청크로 MemmapVectorStore를 만들어 저장합니다. (create_vector_db_with_hf의 memmap 버전)
+
+    Args:
+        splits (list): 분할된 문서 청크 리스트.
+        db_path (str): 저장 디렉터리.
+        dtype (str): 저장 정밀도 ("float16" 기본, "int8"이면 메모리 1/4).
+        nlist (int): IVF 클러스터 수 (0이면 전체 정확 검색).
+        embedding_cache_dir (str): 임베딩 캐시 디렉터리. None이면 캐시를 쓰지 않습니다.
+        embeddings (Embeddings): 이미 만들어 둔 임베딩 객체. 주면 Hugging Face 모델을 로드하지 않습니다.
+
+    Returns:
+        MemmapVectorStore: 생성된 벡터 저장소.
+    """
+    model_name = "jhgan/ko-sbert-nli"
+    if embeddings is None:
+        embeddings = with_embedding_cache(_hf_embedding_factory(model_name), model_name, embedding_cache_dir)
+    vectorstore = MemmapVectorStore.from_texts(
+        [doc.page_content for doc in splits], embeddings,
+        metadatas=[doc.metadata for doc in splits], ids=assign_chunk_ids(splits),
+        persist_directory=db_path, dtype=dtype, nlist=nlist
+    )
+    logger.info(f"Memmap vector DB created at: {db_path} ({len(vectorstore)}개, {dtype}, nlist={nlist})")
+    return vectorstore
+
+
+def load_memmap_vector_db(persist_directory: str = "./memmap_db",
+                          model_name: str = "jhgan/ko-sbert-nli",
+                          embedding_cache_dir: str = "./cache/embeddings",
+                          embeddings: Embeddings = None,
+                          nprobe: int = 8):
+    """
+    저장된 MemmapVectorStore를 불러옵니다. (load_vector_db의 memmap 버전)
+    벡터는 메모리 매핑으로 열기 때문에 로딩이 거의 즉시 끝나고, 검색할 때 필요한 부분만 읽습니다.
+    """
+    if embeddings is None:
+        embeddings = with_embedding_cache(_hf_embedding_factory(model_name), model_name, embedding_cache_dir)
+    with get_tracer().span("load_vector_db", backend="memmap"):
+        vectorstore = MemmapVectorStore(persist_directory, TracedEmbeddings(embeddings), nprobe=nprobe)
+    logger.info(f"memmap 벡터 DB 로딩 완료. ({len(vectorstore)}개)")
+    return vectorstore
+
+
+# 제목 인덱스 (벡터 검색 전에 드라마/영화 제목으로 바로 찾기)
+# 검색어 대부분이 제목 그 자체이므로, 제목이 맞으면 임베딩/ANN 검색을 건너뛴다.
+TitleMatch = namedtuple("TitleMatch", ["title", "match_type", "score"])
+
+_PAREN_PATTERN = re.compile(r"[\(\[\{（【][^\)\]\}）】]*[\)\]\}）】]")
+_NON_WORD_PATTERN = re.compile(r"[\W_]+")
+
+
+def normalize_title(text: str, drop_parenthesized: bool = True):
+    """
+    제목/검색어 비교용 정규화 문자열을 만듭니다.
+    (유니코드 NFKC, 소문자, 괄호 속 부제 제거, 공백/문장부호 제거)
+
+    Args:
+        text (str): 원본 제목 또는 검색어.
+        drop_parenthesized (bool): "(아는 건 별로 없지만)" 같은 괄호 부분을 통째로 뺄지 여부.
+            False면 괄호 기호만 지우고 안의 글자는 남깁니다.
+
+    Returns:
+        str: 정규화된 문자열.
+    """
+    text = unicodedata.normalize("NFKC", str(text)).lower()
+    if drop_parenthesized:
+        text = _PAREN_PATTERN.sub(" ", text)
+    return _NON_WORD_PATTERN.sub("", text)
+
+
+def decompose_jamo(text: str):
+    """
+    한글 음절을 초성/중성/종성 자모로 분해합니다. (오타에 강한 n-gram 비교용)
+    한글 음절이 아닌 문자는 그대로 둡니다.
+    """
+    jamo = []
+    for ch in text:
+        code = ord(ch) - 0xAC00
+        if 0 <= code < 11172:
+            jamo.append(chr(0x1100 + code // 588))
+            jamo.append(chr(0x1161 + (code % 588) // 28))
+            if code % 28:
+                jamo.append(chr(0x11A7 + code % 28))
+        else:
+            jamo.append(ch)
+    return "".join(jamo)
+
+
+def _jamo_ngrams(text: str, n: int = 3):
+    jamo = decompose_jamo(text)
+    if len(jamo) <= n:
+        return {jamo} if jamo else set()
+    return {jamo[i:i + n] for i in range(len(jamo) - n + 1)}
+
+
+class TitleIndex:
+    """
+    제목명 -> 행(Document) 인메모리 인덱스.
+    정확 일치, 정규화 일치, 제목 포함, 자모 n-gram 유사도 순으로 찾습니다.
+    """
+
+    def __init__(self, documents: list, fuzzy_threshold: float = 0.6, ngram: int = 3):
+        self.fuzzy_threshold = fuzzy_threshold
+        self.ngram = ngram
+        self.rows_by_title = defaultdict(list)
+        for doc in documents:
+            title = doc.metadata.get("source")
+            if title:
+                self.rows_by_title[title].append(doc)
+
+        self.titles = list(self.rows_by_title)
+        self._normalized = {}
+        self._ngrams = []
+        self._postings = defaultdict(set)
+        for title_id, title in enumerate(self.titles):
+            for key in (normalize_title(title), normalize_title(title, drop_parenthesized=False)):
+                if key:
+                    self._normalized.setdefault(key, title)
+            grams = _jamo_ngrams(normalize_title(title, drop_parenthesized=False), ngram)
+            self._ngrams.append(grams)
+            for gram in grams:
+                self._postings[gram].add(title_id)
+
+        # 제목 포함 검색은 긴 제목부터 (예: "18 어게인"보다 긴 제목이 먼저 잡히도록)
+        self._contains_keys = sorted(
+            (key for key in self._normalized if len(key) >= 2), key=len, reverse=True
+        )
+
+    def __len__(self):
+        return len(self.titles)
+
+    def lookup(self, query: str):
+        """
+        검색어에 해당하는 제목을 찾습니다.
+
+        Returns:
+            TitleMatch | None: (제목, 일치 방식, 점수). 못 찾으면 None.
+        """
+        query = query.strip()
+        if query in self.rows_by_title:
+            return TitleMatch(query, "exact", 1.0)
+
+        normalized = normalize_title(query)
+        for key in (normalized, normalize_title(query, drop_parenthesized=False)):
+            if key in self._normalized:
+                return TitleMatch(self._normalized[key], "normalized", 1.0)
+
+        # "슬기로운 의사생활 촬영지 알려줘"처럼 제목이 검색어에 들어있는 경우
+        for key in self._contains_keys:
+            if key in normalized:
+                return TitleMatch(self._normalized[key], "contains", len(key) / len(normalized))
+
+        # 자모 n-gram Dice 유사도 (오타, 띄어쓰기 차이)
+        query_grams = _jamo_ngrams(normalize_title(query, drop_parenthesized=False), self.ngram)
+        if not query_grams:
+            return None
+        overlaps = defaultdict(int)
+        for gram in query_grams:
+            for title_id in self._postings.get(gram, ()):
+                overlaps[title_id] += 1
+        best = None
+        for title_id, overlap in overlaps.items():
+            score = 2 * overlap / (len(query_grams) + len(self._ngrams[title_id]))
+            if score >= self.fuzzy_threshold and (best is None or score > best.score):
+                best = TitleMatch(self.titles[title_id], "fuzzy", score)
+        return best
+
+    def get_documents(self, title: str, k: int = None):
+        """제목에 해당하는 행 Document 리스트를 반환합니다."""
+        docs = self.rows_by_title.get(title, [])
+        return docs[:k] if k else list(docs)
+
+
+def build_title_index(documents: list, fuzzy_threshold: float = 0.6):
+    """
+    행 단위 Document 리스트(load_csv_documents 결과)로 제목 인덱스를 만듭니다.
+
+    Args:
+        documents (list): metadata["source"]에 제목명이 들어있는 Document 리스트.
+        fuzzy_threshold (float): 자모 n-gram 유사도 최소 점수.
+
+    Returns:
+        TitleIndex: 제목 인덱스.
+    """
+    title_index = TitleIndex(documents, fuzzy_threshold=fuzzy_threshold)
+    logger.info(f"제목 인덱스 구성 완료: {len(title_index)}개 제목")
+    return title_index
+
+
+class TitleFirstRetriever(BaseRetriever):
+    """
+    제목 인덱스에서 먼저 찾고, 없을 때만 벡터 검색기를 사용하는 검색기.
+    """
+
+    title_index: TitleIndex
+    base_retriever: BaseRetriever
+    k: int = 5
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        match = self.title_index.lookup(query)
+        if match is not None:
+            logger.debug(f"제목 인덱스 적중: {match.title} ({match.match_type}, {match.score:.2f})")
+            return self.title_index.get_documents(match.title, k=self.k)
+        return self.base_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+
+
+def create_gemini_llm(model_name: str = LLM_MODEL_NAME):
+    """Gemini LLM 객체를 만듭니다."""
+    from langchain_google_genai import GoogleGenerativeAI
+
+    return GoogleGenerativeAI(model=model_name)
+
+
+# 주변 촬영지 검색용 공간 인덱스
+# 위경도를 cell_km 크기의 격자로 나누고 격자 키 순으로 정렬해 두면,
+# 반경 안의 격자들은 위도 줄마다 연속 구간이 되어 searchsorted로 바로 잘라낼 수 있습니다.
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat, lon, lats, lons):
+    """한 점(lat, lon)과 여러 점(lats, lons) 사이의 거리(km)를 NumPy로 한 번에 계산합니다."""
+    lat1, lon1 = np.radians(lat), np.radians(lon)
+    lat2, lon2 = np.radians(lats), np.radians(lons)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class GeoIndex:
+    """
+    촬영지 위경도 격자 인덱스. 반경 검색과 k-최근접 검색을 지원합니다.
+    장소유형/미디어유형으로 거를 수 있습니다.
+    """
+
+    _LON_OFFSET = 1 << 20
+    _ROW_STRIDE = 1 << 22
+
+    def __init__(self, frame: pd.DataFrame, cell_km: float = 2.0):
+        frame = frame.copy()
+        frame["위치위도"] = pd.to_numeric(frame["위치위도"], errors="coerce")
+        frame["위치경도"] = pd.to_numeric(frame["위치경도"], errors="coerce")
+        frame = frame.dropna(subset=["위치위도", "위치경도"])
+
+        self.cell_km = cell_km
+        self.cell_deg = cell_km / 111.0
+        lat = frame["위치위도"].to_numpy(dtype=np.float64)
+        lon = frame["위치경도"].to_numpy(dtype=np.float64)
+        keys = self._cell_key(np.floor(lat / self.cell_deg), np.floor(lon / self.cell_deg))
+        order = np.argsort(keys, kind="stable")
+
+        self.keys = keys[order]
+        self.lat = lat[order]
+        self.lon = lon[order]
+        # 결과 dict를 빨리 만들 수 있도록 컬럼을 배열로 꺼내 둠 (DataFrame 행 접근은 느림)
+        self.columns = {
+            column: frame[column].to_numpy()[order]
+            for column in ("장소명", "제목명", "주소", "장소유형", "미디어유형")
+        }
+        self.place_types = self.columns["장소유형"]
+        self.media_types = self.columns["미디어유형"]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _cell_key(self, lat_cell, lon_cell):
+        return ((lat_cell + self._ROW_STRIDE // 2).astype(np.int64) * self._ROW_STRIDE
+                + (lon_cell + self._LON_OFFSET).astype(np.int64))
+
+    def _candidates(self, lat: float, lon: float, radius_km: float):
+        dlat = radius_km / 111.0
+        dlon = radius_km / (111.0 * max(np.cos(np.radians(lat)), 1e-6))
+        lat_cells = np.arange(np.floor((lat - dlat) / self.cell_deg), np.floor((lat + dlat) / self.cell_deg) + 1)
+        lon_lo = np.full(lat_cells.shape, np.floor((lon - dlon) / self.cell_deg))
+        lon_hi = np.full(lat_cells.shape, np.floor((lon + dlon) / self.cell_deg))
+        starts = np.searchsorted(self.keys, self._cell_key(lat_cells, lon_lo), side="left")
+        ends = np.searchsorted(self.keys, self._cell_key(lat_cells, lon_hi), side="right")
+        spans = [np.arange(start, end) for start, end in zip(starts, ends) if end > start]
+        return np.concatenate(spans) if spans else np.empty(0, dtype=np.int64)
+
+    def _filter(self, idx, place_type=None, media_type=None):
+        if place_type is not None:
+            idx = idx[np.isin(self.place_types[idx], np.atleast_1d(place_type))]
+        if media_type is not None:
+            idx = idx[np.isin(self.media_types[idx], np.atleast_1d(media_type))]
+        return idx
+
+    def _to_results(self, idx, distances):
+        results = []
+        for i, distance in zip(idx.tolist(), distances.tolist()):
+            result = {column: values[i] for column, values in self.columns.items()}
+            result.update({"위도": float(self.lat[i]), "경도": float(self.lon[i]), "distance_km": distance})
+            results.append(result)
+        return results
+
+    def _radius_indices(self, lat, lon, radius_km, place_type=None, media_type=None):
+        idx = self._filter(self._candidates(lat, lon, radius_km), place_type, media_type)
+        distances = haversine_km(lat, lon, self.lat[idx], self.lon[idx])
+        inside = distances <= radius_km
+        idx, distances = idx[inside], distances[inside]
+        order = np.argsort(distances, kind="stable")
+        return idx[order], distances[order]
+
+    def radius(self, lat: float, lon: float, radius_km: float = 2.0,
+               place_type=None, media_type=None, limit: int = 20):
+        """
+        (lat, lon)에서 radius_km 안의 촬영지를 가까운 순으로 반환합니다.
+
+        Args:
+            place_type: 장소유형 (문자열 또는 리스트, 예: "cafe").
+            media_type: 미디어유형 (문자열 또는 리스트, 예: "drama").
+            limit (int): 최대 결과 수. None이면 전부.
+
+        Returns:
+            list: 장소 정보 + distance_km dict 리스트.
+        """
+        idx, distances = self._radius_indices(lat, lon, radius_km, place_type, media_type)
+        if limit is not None:
+            idx, distances = idx[:limit], distances[:limit]
+        return self._to_results(idx, distances)
+
+    def nearest(self, lat: float, lon: float, k: int = 5,
+                place_type=None, media_type=None, max_radius_km: float = 200.0):
+        """
+        (lat, lon)에서 가장 가까운 촬영지 k개를 반환합니다.
+        격자 한 칸 반경부터 두 배씩 넓혀 가며, k개가 모이면 멈춥니다.
+        """
+        radius_km = self.cell_km
+        while True:
+            idx, distances = self._radius_indices(lat, lon, radius_km, place_type, media_type)
+            if len(idx) >= k or radius_km >= max_radius_km:
+                return self._to_results(idx[:k], distances[:k])
+            radius_km = min(radius_km * 2, max_radius_km)
+
+
+def build_geo_index(file_path, cell_km: float = 2.0):
+    """
+    촬영지 CSV로 GeoIndex를 만듭니다.
+
+    Args:
+        file_path (str): 위치위도/위치경도 컬럼이 있는 CSV 경로.
+        cell_km (float): 격자 한 칸 크기(km). 자주 쓰는 검색 반경과 비슷하게 잡으면 좋습니다.
+
+    Returns:
+        GeoIndex: 공간 인덱스.
+    """
+    frame = pd.read_csv(file_path, encoding="utf-8-sig", dtype=str, keep_default_na=False)
+    geo_index = GeoIndex(frame, cell_km=cell_km)
+    logger.info(f"공간 인덱스 구성 완료: {len(geo_index)}개 장소")
+    return geo_index
+
+
+# 검색어에서 메타데이터 필터 추출 (제목, 드라마/영화, 지역, 장소유형)
+MEDIA_TYPE_KEYWORDS = {"드라마": "drama", "영화": "movie"}
+PLACE_TYPE_KEYWORDS = {
+    "카페": "cafe", "커피": "cafe", "식당": "restaurant", "맛집": "restaurant", "음식점": "restaurant",
+    "숙소": "stay", "호텔": "stay", "펜션": "stay", "역": "station", "상점": "store", "가게": "store",
+}
+
+
+class QueryFilterExtractor:
+    """
+    검색어에서 Chroma where 조건을 뽑아냅니다.
+    제목은 TitleIndex로, 지역/시군구는 데이터에 실제로 있는 값으로만 찾습니다.
+    """
+
+    def __init__(self, documents: list, title_index: TitleIndex = None):
+        self.title_index = title_index
+        self.regions = {}
+        self.cities = {}
+        for doc in documents:
+            region, city = doc.metadata.get("지역"), doc.metadata.get("시군구")
+            if region:
+                self.regions[region] = region
+            if city:
+                self.cities[city] = city
+                # "강릉시" -> "강릉" 처럼 시/군/구를 뗀 이름도 인식 (한 글자가 되면 제외)
+                if len(city) > 2:
+                    self.cities.setdefault(city[:-1], city)
+        for full_name, short_name in REGION_ALIASES.items():
+            if short_name in self.regions:
+                self.regions[full_name] = short_name
+
+    def extract(self, query: str):
+        """
+        Returns:
+            dict: 메타데이터 키 -> 값. 찾은 조건이 없으면 빈 dict.
+        """
+        conditions = {}
+        if self.title_index is not None:
+            match = self.title_index.lookup(query)
+            if match is not None:
+                conditions["제목명"] = match.title
+        tokens = query.split()
+        for keyword, media_type in MEDIA_TYPE_KEYWORDS.items():
+            if keyword in query:
+                conditions["미디어유형"] = media_type
+                break
+        for token in tokens:
+            if token in PLACE_TYPE_KEYWORDS:
+                conditions["장소유형"] = PLACE_TYPE_KEYWORDS[token]
+            elif token in self.cities:
+                conditions["시군구"] = self.cities[token]
+            elif token in self.regions:
+                conditions["지역"] = self.regions[token]
+        return conditions
+
+    def to_where(self, query: str):
+        """extract 결과를 Chroma where 형식으로 바꿉니다. 조건이 없으면 None."""
+        conditions = self.extract(query)
+        if not conditions:
+            return None
+        clauses = [{key: value} for key, value in conditions.items()]
+        return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def build_query_filter_extractor(documents: list, title_index: TitleIndex = None):
+    """행 Document 리스트(load_csv_documents 결과)로 QueryFilterExtractor를 만듭니다."""
+    return QueryFilterExtractor(documents, title_index=title_index)
+
+
+class MetadataFilteredRetriever(BaseRetriever):
+    """
+    검색어에서 뽑은 메타데이터 조건으로 먼저 후보를 줄인 뒤 벡터 검색하는 검색기.
+    조건에 맞는 문서가 없으면 필터 없이 다시 검색합니다.
+    """
+
+    vectorstore: Any
+    filter_extractor: QueryFilterExtractor
+    k: int = 5
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        where = self.filter_extractor.to_where(query)
+        if where is not None:
+            docs = self.vectorstore.similarity_search(query, k=self.k, filter=where)
+            if docs:
+                logger.debug(f"메타데이터 필터 적용: {where}")
+                return docs
+        return self.vectorstore.similarity_search(query, k=self.k)
+
+
+class RowExpandingRetriever(BaseRetriever):
+    """
+    행 단위 임베딩 문서(metadata["row_text"])를 원래 행 내용으로 펼치고 행 기준으로 중복을 없애는 검색기.
+    """
+
+    base_retriever: BaseRetriever
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        docs = self.base_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        return expand_row_documents(docs)
+
+
+# 어휘(lexical) 검색: 한국어용 글자 2/3-gram BM25 역색인
+# 고유명사(장소명, 괄호 속 배우 이름 등)는 임베딩 유사도보다 글자 일치가 더 잘 맞습니다.
+def char_ngram_tokens(text: str, ngram_sizes=(2, 3)):
+    """단어별 글자 2-gram/3-gram 토큰 리스트 (한 글자 단어는 그 글자 자체)"""
+    tokens = []
+    for word in _NON_WORD_PATTERN.sub(" ", unicodedata.normalize("NFKC", text).lower()).split():
+        if len(word) == 1:
+            tokens.append(word)
+            continue
+        for n in ngram_sizes:
+            tokens.extend(word[i:i + n] for i in range(len(word) - n + 1))
+    return tokens
+
+
+class LexicalIndex:
+    """
+    BM25 역색인. 포스팅은 CSR 형태의 NumPy 배열(offsets, doc_ids, tfs)로 저장합니다.
+    """
+
+    def __init__(self, documents: list, k1: float = 1.2, b: float = 0.75):
+        self.documents = documents
+        self.k1 = k1
+        self.b = b
+        self.vocab = {}
+        term_ids, doc_ids, tfs = [], [], []
+        doc_lengths = np.zeros(len(documents), dtype=np.float32)
+        for doc_id, doc in enumerate(documents):
+            # 행 단위 임베딩 문서는 임베딩용 요약 대신 행 전체 내용으로 색인
+            tokens = char_ngram_tokens(doc.metadata.get("row_text") or doc.page_content)
+            doc_lengths[doc_id] = len(tokens)
+            for token, count in Counter(tokens).items():
+                term_ids.append(self.vocab.setdefault(token, len(self.vocab)))
+                doc_ids.append(doc_id)
+                tfs.append(count)
+
+        term_ids = np.asarray(term_ids, dtype=np.int32)
+        order = np.argsort(term_ids, kind="stable")
+        self.doc_ids = np.asarray(doc_ids, dtype=np.int32)[order]
+        self.tfs = np.asarray(tfs, dtype=np.float32)[order]
+        df = np.bincount(term_ids, minlength=len(self.vocab))
+        self.offsets = np.concatenate([[0], np.cumsum(df)]).astype(np.int64)
+        n_docs = max(len(documents), 1)
+        self.idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avg_length = doc_lengths.mean() if len(documents) else 1.0
+        self.length_norm = self.k1 * (1 - self.b + self.b * doc_lengths / max(avg_length, 1e-6))
+
+    def __len__(self):
+        return len(self.documents)
+
+    def search(self, query: str, k: int = 5):
+        """
+        BM25 점수 상위 k개 문서를 반환합니다.
+
+        Returns:
+            list: (Document, 점수) 튜플 리스트.
+        """
+        scores = np.zeros(len(self.documents), dtype=np.float32)
+        for token in set(char_ngram_tokens(query)):
+            term_id = self.vocab.get(token)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            ids, tfs = self.doc_ids[start:end], self.tfs[start:end]
+            scores[ids] += self.idf[term_id] * tfs * (self.k1 + 1) / (tfs + self.length_norm[ids])
+
+        k = min(k, int(np.count_nonzero(scores)))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self.documents[i], float(scores[i])) for i in top]
+
+
+def build_lexical_index(vectorstore):
+    """
+    벡터 DB에 적재된 청크 전체로 LexicalIndex를 만듭니다. (벡터 검색과 같은 문서 ID 사용)
+    """
+    stored = vectorstore.get(include=["documents", "metadatas"])
+    documents = [
+        Document(page_content=text, metadata=metadata or {}, id=doc_id)
+        for doc_id, text, metadata in zip(stored["ids"], stored["documents"], stored["metadatas"])
+    ]
+    lexical_index = LexicalIndex(documents)
+    logger.info(f"어휘 색인 구성 완료: {len(lexical_index)}개 문서, {len(lexical_index.vocab)}개 토큰")
+    return lexical_index
+
+
+def _document_key(doc):
+    return doc.id or hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()
+
+
+def reciprocal_rank_fusion(result_lists: list, k: int = 5, rrf_k: int = 60):
+    """
+    여러 검색 결과 순위를 RRF(1 / (rrf_k + 순위))로 합칩니다.
+
+    Args:
+        result_lists (list): Document 리스트들의 리스트 (각각 순위 순).
+
+    Returns:
+        list: 합친 점수 상위 k개 Document.
+    """
+    scores, docs = defaultdict(float), {}
+    for results in result_lists:
+        for rank, doc in enumerate(results, 1):
+            key = _document_key(doc)
+            scores[key] += 1.0 / (rrf_k + rank)
+            docs.setdefault(key, doc)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [docs[key] for key in ranked]
+
+
+def _matches_conditions(metadata: dict, conditions: dict):
+    return all(metadata.get(key) == value for key, value in conditions.items())
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    BM25 어휘 검색과 벡터 검색 결과를 RRF로 합치는 검색기.
+    filter_extractor가 있으면 두 검색 모두 같은 메타데이터 조건을 적용합니다.
+    """
+
+    vectorstore: Any
+    lexical_index: LexicalIndex
+    filter_extractor: Any = None
+    k: int = 5
+    candidate_k: int = 20
+    rrf_k: int = 60
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        conditions = self.filter_extractor.extract(query) if self.filter_extractor is not None else {}
+        where = self.filter_extractor.to_where(query) if conditions else None
+
+        vector_docs = self.vectorstore.similarity_search(query, k=self.candidate_k, filter=where)
+        lexical_docs = [
+            doc for doc, _ in self.lexical_index.search(query, k=self.candidate_k * (4 if conditions else 1))
+            if _matches_conditions(doc.metadata, conditions)
+        ][:self.candidate_k]
+        if conditions and not vector_docs and not lexical_docs:
+            # 조건에 맞는 문서가 없으면 필터 없이 다시 검색
+            vector_docs = self.vectorstore.similarity_search(query, k=self.candidate_k)
+            lexical_docs = [doc for doc, _ in self.lexical_index.search(query, k=self.candidate_k)]
+        return reciprocal_rank_fusion([lexical_docs, vector_docs], k=self.k, rrf_k=self.rrf_k)
+
+
+# 1. 원하는 JSON 구조를 정의하는 Pydantic 모델
+class LocationInfo(BaseModel):
+    장소: str = Field(description="영화/드라마 촬영 장소의 이름")
+    주소: str = Field(description="영화/드라마 촬영 장소의 주소")
+    장면_설명: str = Field(description="해당 장소에서 촬영된 영화/드라마 장면의 상세 설명")
+    장소_설명: str = Field(description="촬영 장소 상세 설명")
+    위도: float | None = Field(default=None, description="위도 (맥락에 없으면 null)")
+    경도: float | None = Field(default=None, description="경도 (맥락에 없으면 null)")
+
+# LLM 없이 검색된 행의 메타데이터로 LocationInfo 만들기
+# 장소유형 코드 -> 화면 표시용 한글
+PLACE_TYPE_LABELS = {
+    "cafe": "카페",
+    "restaurant": "식당",
+    "playground": "명소",
+    "stay": "숙박",
+    "station": "역",
+    "store": "상점",
+}
+
+LOCATION_RANKINGS = ("retrieval", "recent", "detailed")
+# 검색된 청크 본문에 빠져 있을 수 있어서 행 메타데이터(add_row_metadata)에서 가져오는 컬럼
+ROW_METADATA_FIELDS = ("장소유형", "위치위도", "위치경도")
+
+
+def parse_row_fields(text: str):
+    """CSV 행 문서("컬럼: 값" 줄 나열)를 dict로 바꿉니다."""
+    fields = {}
+    for line in text.splitlines():
+        key, sep, value = line.partition(": ")
+        if sep:
+            fields[key.lstrip("\ufeff").strip()] = value.strip()
+    return fields
+
+
+def group_row_fields(docs: list):
+    """
+    검색된 청크를 원본 행 단위로 합칩니다. (검색 순서 유지)
+    같은 컬럼이 여러 청크에 나오면 더 긴 값을 사용합니다. (청크 경계에서 잘린 값 보정)
+    ROW_METADATA_FIELDS는 행 전체에서 뽑아 둔 메타데이터 값을 우선합니다.
+
+    Returns:
+        list: 행별 필드 dict 리스트.
+    """
+    rows = {}
+    for doc in docs:
+        key = (doc.metadata.get("source"), doc.metadata.get("row_id", doc.metadata.get("row")))
+        fields = rows.setdefault(key, {})
+        for column, value in parse_row_fields(doc.page_content).items():
+            if len(value) > len(fields.get(column, "")):
+                fields[column] = value
+        for column in ROW_METADATA_FIELDS:
+            value = doc.metadata.get(column)
+            if value is not None and value != "":
+                fields[column] = str(value)
+    return list(rows.values())
+
+
+def _to_float(value):
+    """숫자로 바꿀 수 없는 값(빈 값, "정보없음" 등)은 None."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def row_to_location_info(fields: dict):
+    """CSV 행 필드를 LocationInfo로 변환합니다."""
+    place_type = fields.get("장소유형", "")
+    return LocationInfo(
+        장소=fields.get("장소명", ""),
+        주소=fields.get("주소", ""),
+        장면_설명=fields.get("관련장소설명", ""),
+        장소_설명=PLACE_TYPE_LABELS.get(place_type, place_type),
+        위도=_to_float(fields.get("위치위도")),
+        경도=_to_float(fields.get("위치경도")),
+    )
+
+
+def build_location_infos(docs: list, count: int = 2, ranking: str = "retrieval"):
+    """
+    검색된 문서에서 LLM 호출 없이 LocationInfo 리스트를 만듭니다.
+
+    Args:
+        docs (list): 검색기가 돌려준 Document 리스트.
+        count (int): 반환할 장소 수.
+        ranking (str): 정렬 기준.
+            "retrieval" - 검색 순서 그대로
+            "recent"    - 최종수정일자 최신순
+            "detailed"  - 장면 설명이 긴(정보가 많은) 순
+
+    Returns:
+        list: LocationInfo 리스트 (같은 장소/주소는 한 번만).
+    """
+    if ranking not in LOCATION_RANKINGS:
+        raise ValueError(f"ranking은 {LOCATION_RANKINGS} 중 하나여야 합니다: {ranking}")
+
+    rows = [fields for fields in group_row_fields(docs) if fields.get("장소명")]
+    if ranking == "recent":
+        rows.sort(key=lambda fields: fields.get("최종수정일자", ""), reverse=True)
+    elif ranking == "detailed":
+        rows.sort(key=lambda fields: len(fields.get("관련장소설명", "")), reverse=True)
+
+    locations, seen = [], set()
+    for fields in rows:
+        key = (fields.get("장소명"), fields.get("주소"))
+        if key in seen:
+            continue
+        seen.add(key)
+        locations.append(row_to_location_info(fields))
+        if len(locations) >= count:
+            break
+    return locations
+
+
+# 맥락 압축 (검색 결과 -> LLM 프롬프트)
+# 같은 행의 청크를 하나로 합치고(청크 overlap 제거), 값이 없는 필드를 빼고, 토큰 예산 안으로 자릅니다.
+EMPTY_FIELD_VALUES = {"", "정보없음", "없음", "-", "nan", "None"}
+DEFAULT_CONTEXT_TOKEN_BUDGET = 1200
+
+
+def estimate_tokens(text: str):
+    """
+    토큰 수 추정치. (한글 등 비ASCII 문자는 글자당 1토큰, ASCII는 4글자당 1토큰으로 계산)
+    실제 사용량은 LLM 응답의 usage_metadata를 우선 사용합니다.
+    """
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return non_ascii + (len(text) - non_ascii + 3) // 4
+
+
+def merge_overlapping_text(merged: str, chunk: str, min_overlap: int = 5):
+    """
+    두 청크를 겹치는 부분을 한 번만 넣어 이어 붙입니다.
+    chunk가 이미 포함되어 있으면 그대로, 앞쪽 청크면 앞에 붙입니다.
+    """
+    if chunk in merged:
+        return merged
+    if merged in chunk:
+        return chunk
+    for left, right in ((merged, chunk), (chunk, merged)):
+        for size in range(min(len(left), len(right)) - 1, min_overlap - 1, -1):
+            if left.endswith(right[:size]):
+                return left + right[size:]
+    return merged + "\n" + chunk
+
+
+def drop_empty_fields(text: str):
+    """"컬럼: 값" 줄 중 값이 비어 있거나 "정보없음"인 줄을 뺍니다."""
+    lines = []
+    for line in text.splitlines():
+        _, sep, value = line.partition(": ")
+        if sep and value.strip() in EMPTY_FIELD_VALUES:
+            continue
+        if not sep and line.endswith(":"):
+            # 값 없이 "컬럼:"으로 끝나는 줄
+            continue
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def compact_context(docs: list, max_tokens: int = DEFAULT_CONTEXT_TOKEN_BUDGET):
+    """
+    검색된 청크를 행 단위로 합치고 토큰 예산 안으로 줄인 Document 리스트를 만듭니다. (검색 순서 유지)
+
+    Args:
+        docs (list): 검색기가 돌려준 Document 리스트.
+        max_tokens (int): 맥락 전체의 토큰 예산 (estimate_tokens 기준). None이면 자르지 않음.
+
+    Returns:
+        list: 행 하나당 Document 하나. metadata["merged_chunks"]에 합친 청크 수를 기록합니다.
+    """
+    rows = {}
+    for doc in docs:
+        key = (doc.metadata.get("source"), doc.metadata.get("row_id", doc.metadata.get("row")))
+        rows.setdefault(key, []).append(doc)
+
+    compacted, used = [], 0
+    for chunks in rows.values():
+        # 청크 시작 위치(start_index)가 있으면 원래 순서대로 이어 붙임
+        text = ""
+        for chunk in sorted(chunks, key=lambda d: d.metadata.get("start_index", 0)):
+            text = merge_overlapping_text(text, chunk.page_content) if text else chunk.page_content
+        text = drop_empty_fields(text)
+        tokens = estimate_tokens(text)
+        if max_tokens is not None and used + tokens > max_tokens:
+            if compacted:
+                break
+            # 첫 행 하나만으로 예산을 넘으면 예산만큼 앞부분을 남김
+            while text and estimate_tokens(text) > max_tokens:
+                text = text[:int(len(text) * max_tokens / estimate_tokens(text))]
+            tokens = estimate_tokens(text)
+        used += tokens
+        metadata = {k: v for k, v in chunks[0].metadata.items() if k != "start_index"}
+        metadata["merged_chunks"] = len(chunks)
+        compacted.append(Document(page_content=text, metadata=metadata, id=chunks[0].id))
+    return compacted
+
+
+class CompactingRetriever(BaseRetriever):
+    """
+    검색 결과를 compact_context로 압축해서 돌려주는 검색기. (LLM 프롬프트 길이 절감용)
+    """
+
+    base_retriever: BaseRetriever
+    max_tokens: int = DEFAULT_CONTEXT_TOKEN_BUDGET
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        docs = self.base_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        return compact_context(docs, max_tokens=self.max_tokens)
+
+
+def llm_result_usage(response, estimated_input: int = 0):
+    """
+    LLMResult에서 {"input_tokens", "output_tokens", "estimated"}를 뽑습니다.
+    usage_metadata(Gemini)나 token_usage가 없으면 estimate_tokens 추정치를 쓰고 estimated=True로 표시합니다.
+    """
+    usage = {}
+    text = ""
+    for generations in response.generations:
+        for generation in generations:
+            text += generation.text
+            message = getattr(generation, "message", None)
+            if getattr(message, "usage_metadata", None):
+                usage = message.usage_metadata
+    if not usage and response.llm_output:
+        usage = response.llm_output.get("usage_metadata") or response.llm_output.get("token_usage") or {}
+    return {
+        "input_tokens": usage.get("input_tokens", usage.get("prompt_tokens", estimated_input)),
+        "output_tokens": usage.get("output_tokens", usage.get("completion_tokens", estimate_tokens(text))),
+        "estimated": not usage,
+    }
+
+
+class TokenUsageCallbackHandler(BaseCallbackHandler):
+    """
+    LLM 호출별 입력/출력 토큰 수와 지연 시간을 기록하는 콜백.
+    응답에 usage_metadata(Gemini)가 있으면 그 값을, 없으면 estimate_tokens 추정치를 씁니다.
+    """
+
+    def __init__(self, max_records: int = 1000):
+        self.records = deque(maxlen=max_records)
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        with self._lock:
+            self._started[run_id] = (time.perf_counter(), sum(estimate_tokens(p) for p in prompts))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        with self._lock:
+            started, estimated_input = self._started.pop(run_id, (None, 0))
+        record = llm_result_usage(response, estimated_input)
+        record["latency"] = time.perf_counter() - started if started is not None else None
+        with self._lock:
+            self.records.append(record)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self._lock:
+            self._started.pop(run_id, None)
+
+    def report(self):
+        """호출 수, 평균 입력/출력 토큰, 평균 지연 시간 요약"""
+        with self._lock:
+            records = list(self.records)
+        if not records:
+            return {"calls": 0}
+        latencies = [r["latency"] for r in records if r["latency"] is not None]
+        return {
+            "calls": len(records),
+            "avg_input_tokens": round(sum(r["input_tokens"] for r in records) / len(records), 1),
+            "avg_output_tokens": round(sum(r["output_tokens"] for r in records) / len(records), 1),
+            "avg_latency": round(sum(latencies) / len(latencies), 3) if latencies else None,
+            "last": records[-1],
+        }
+
+
+# LLM 호출 보호 (마감 시간, 지터 재시도, 헤지 요청, 회로 차단기, 검색 결과 기반 대체 답변)
+# Gemini가 느리거나 실패해도 요청 전체 시간이 deadline을 넘지 않도록, 넘으면 검색된 행으로 답변을 만듭니다.
+# 이미 보낸 동기 HTTP 호출은 취소할 수 없으므로 버려진 호출은 작업자 스레드에서 끝날 때까지 돌고,
+# 스트리밍 호출은 다음 조각을 받을 때 멈춥니다.
+NON_RETRYABLE_ERRORS = {"InvalidArgument", "PermissionDenied", "Unauthenticated", "NotFound",
+                        "ValueError", "TypeError", "KeyError"}
+
+
+class FallbackAnswer(list):
+    """
+    LLM 대신 검색된 행으로 만든 답변 (LocationInfo dict 리스트).
+    reason은 "deadline"(마감 시간 초과), "circuit_open"(차단기 열림), "error"(재시도 후에도 실패).
+    답변 캐시/미리 만든 답변에는 저장하지 않습니다.
+    """
+
+    def __init__(self, locations=(), reason: str = "error"):
+        super().__init__(locations)
+        self.reason = reason
+
+
+class CircuitBreaker:
+    """
+    연속 실패가 failure_threshold번이면 열려서(open) reset_timeout초 동안 호출을 막고,
+    그 뒤 시험 호출 하나만 보내서(half_open) 성공하면 닫고 실패하면 다시 엽니다.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """지금 호출을 보내도 되는지 (half_open이면 시험 호출 하나만 허용)"""
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = "half_open"
+                self._trial_running = False
+            if self.state == "half_open":
+                if self._trial_running:
+                    return False
+                self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info("LLM 회로 차단기 닫힘")
+            self.state = "closed"
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logger.warning(f"LLM 회로 차단기 열림 (연속 실패 {self.failures}회, {self.reset_timeout:.0f}초)")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class LLMGuard:
+    """
+    LLM 문서 체인 호출 정책. 차단기와 지연 시간 기록은 여러 체인/요청이 공유해야 하므로
+    ResourceManager 등에 하나 만들어 두고 get_rag_chain_with_json_output(llm_guard=...)로 넘깁니다.
+
+    Args:
+        deadline (float): 요청 하나의 LLM 단계 마감 시간(초). 넘으면 대체 답변.
+        max_retries (int): 실패 시 재시도 횟수. (지터 지수 백오프, 남은 마감 시간 안에서만)
+        backoff_base (float): 백오프 기본 간격(초). n번째 재시도는 0 ~ base * 2^n 사이에서 무작위로 기다림.
+        backoff_max (float): 백오프 최대 간격(초).
+        hedge (bool): True면 첫 응답이 최근 응답 시간의 hedge_quantile(기본 p95)보다 늦을 때
+            같은 요청을 하나 더 보내고 먼저 오는 응답을 씁니다. (호출 수가 늘어나므로 요청 한도에 주의)
+        hedge_quantile (float): 헤지 지연 기준 분위수.
+        hedge_min_samples (int): 이만큼 응답 시간이 쌓이기 전에는 헤지하지 않음.
+        breaker (CircuitBreaker): 회로 차단기. None이면 기본값으로 새로 만듦.
+        max_workers (int): LLM 호출 작업자 스레드 수. (버려진 느린 호출도 스레드를 차지함)
+    """
+
+    def __init__(self,
+                 deadline: float = 8.0,
+                 max_retries: int = 2,
+                 backoff_base: float = 0.3,
+                 backoff_max: float = 2.0,
+                 hedge: bool = False,
+                 hedge_quantile: float = 0.95,
+                 hedge_min_samples: int = 20,
+                 breaker: CircuitBreaker = None,
+                 max_workers: int = 16):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker or CircuitBreaker()
+        self.latencies = deque(maxlen=500)  # 성공한 호출의 첫 응답(조각)까지 걸린 시간
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-guard")
+
+    def hedge_delay(self):
+        """헤지 요청을 보낼 때까지 기다릴 시간(초). 헤지를 안 하면 None."""
+        if not self.hedge:
+            return None
+        with self._lock:
+            values = sorted(self.latencies)
+        if len(values) < self.hedge_min_samples:
+            return None
+        return _percentile(values, self.hedge_quantile)
+
+    def backoff(self, retry: int):
+        """retry번째 재시도 전 대기 시간 (full jitter)"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** retry))
+
+    @staticmethod
+    def is_retryable(error: BaseException):
+        return not any(cls.__name__ in NON_RETRYABLE_ERRORS for cls in type(error).__mro__)
+
+    def record_latency(self, seconds: float):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def count(self, key: str):
+        with self._lock:
+            self.counters[key] += 1
+
+    def report(self):
+        """호출 결과별 횟수, 차단기 상태, 최근 첫 응답 시간 p50/p95"""
+        with self._lock:
+            values = sorted(self.latencies)
+            counters = dict(self.counters)
+        return {"breaker": self.breaker.state, **counters,
+                "p50": _percentile(values, 0.50), "p95": _percentile(values, 0.95)}
+
+    def wrap(self, document_chain, fallback):
+        """document_chain을 이 정책으로 감싼 Runnable을 반환합니다. fallback(inputs) -> 대체 답변 리스트"""
+        return ResilientDocumentChain(document_chain, fallback, self)
+
+
+class ResilientDocumentChain(Runnable):
+    """
+    LLMGuard 정책으로 문서 체인(create_stuff_documents_chain)을 실행하는 Runnable.
+    invoke와 stream을 모두 지원하며, 스트리밍이면 첫 조각이 온 호출을 채택하고 나머지는 버립니다.
+    첫 조각 이후 실패하거나 마감 시간을 넘으면 그때까지 나온 조각 뒤에 FallbackAnswer를 이어서 냅니다.
+    """
+
+    def __init__(self, document_chain, fallback, guard: LLMGuard):
+        self.document_chain = document_chain
+        self.fallback = fallback
+        self.guard = guard
+
+    def invoke(self, input, config=None, **kwargs):
+        return self._call_with_config(self._invoke, input, config, **kwargs)
+
+    def _invoke(self, inputs, run_manager, config):
+        # invoke 모드는 답변(또는 대체 답변) 하나만 나옴
+        return list(self._run(inputs, config, stream=False))[-1]
+
+    def stream(self, input, config=None, **kwargs):
+        yield from self.transform(iter([input]), config, **kwargs)
+
+    def transform(self, input, config=None, **kwargs):
+        yield from self._transform_stream_with_config(input, self._transform, config, **kwargs)
+
+    def _transform(self, input_iterator, run_manager, config):
+        inputs = None
+        for chunk in input_iterator:
+            inputs = chunk if inputs is None else {**inputs, **chunk}
+        yield from self._run(inputs, config, stream=True)
+
+    def _worker(self, attempt_id, inputs, config, stream, events, stop):
+        try:
+            if stream:
+                for chunk in self.document_chain.stream(inputs, config):
+                    if stop.is_set():
+                        return
+                    events.put((attempt_id, "chunk", chunk))
+            else:
+                events.put((attempt_id, "chunk", self.document_chain.invoke(inputs, config)))
+            events.put((attempt_id, "end", None))
+        except Exception as error:
+            events.put((attempt_id, "error", error))
+
+    def _fallback(self, span, inputs, reason, error=None):
+        span.attributes["fallback"] = reason
+        if error is not None:
+            span.attributes["last_error"] = f"{type(error).__name__}: {error}"
+        self.guard.count(f"fallback_{reason}")
+        logger.warning(f"LLM 대체 답변 사용 ({reason}){f': {error}' if error is not None else ''}")
+        return FallbackAnswer(self.fallback(inputs), reason=reason)
+
+    def _run(self, inputs, config, stream):
+        import queue
+
+        guard = self.guard
+        with get_tracer().span("llm_guard", stream=stream) as span:
+            if not guard.breaker.allow():
+                yield self._fallback(span, inputs, "circuit_open")
+                return
+
+            started = time.perf_counter()
+            deadline_at = started + guard.deadline
+            events = queue.Queue()
+            stops = {}
+            launched_at = {}
+
+            def launch():
+                attempt_id = len(stops)
+                stops[attempt_id] = threading.Event()
+                launched_at[attempt_id] = time.perf_counter()
+                guard._executor.submit(contextvars.copy_context().run, self._worker, attempt_id, inputs, config,
+                                       stream, events, stops[attempt_id])
+                return attempt_id
+
+            live = {launch()}
+            retries = hedges = 0
+            winner = retry_at = last_error = None
+            delay = guard.hedge_delay()
+            hedge_at = started + delay if delay is not None else None
+            try:
+                while True:
+                    now = time.perf_counter()
+                    if now >= deadline_at:
+                        if winner is None and live:
+                            guard.breaker.record_failure()
+                        yield self._fallback(span, inputs, "deadline", last_error)
+                        return
+                    timers = [deadline_at] + [t for t in (retry_at, hedge_at if winner is None else None)
+                                              if t is not None]
+                    try:
+                        attempt_id, kind, payload = events.get(timeout=max(0.0, min(timers) - now))
+                    except queue.Empty:
+                        now = time.perf_counter()
+                        if retry_at is not None and now >= retry_at:
+                            retry_at = None
+                            live.add(launch())
+                        if winner is None and hedge_at is not None and now >= hedge_at:
+                            hedge_at = None
+                            hedges += 1
+                            live.add(launch())
+                        continue
+
+                    if winner is not None and attempt_id != winner:
+                        continue
+                    if kind == "chunk":
+                        if winner is None:
+                            winner = attempt_id
+                            guard.record_latency(time.perf_counter() - launched_at[attempt_id])
+                            for other, stop in stops.items():
+                                if other != winner:
+                                    stop.set()
+                        yield payload
+                    elif kind == "end":
+                        guard.breaker.record_success()
+                        guard.count("ok")
+                        return
+                    else:
+                        live.discard(attempt_id)
+                        last_error = payload
+                        guard.breaker.record_failure()
+                        if winner is not None:
+                            yield self._fallback(span, inputs, "error", payload)
+                            return
+                        if live or retry_at is not None:
+                            continue  # 헤지한 다른 호출이 아직 진행 중
+                        if retries < guard.max_retries and guard.is_retryable(payload) and guard.breaker.allow():
+                            retry_at = time.perf_counter() + guard.backoff(retries)
+                            retries += 1
+                            if retry_at >= deadline_at:
+                                retry_at = None
+                                yield self._fallback(span, inputs, "deadline", payload)
+                                return
+                            continue
+                        yield self._fallback(span, inputs, "error", payload)
+                        return
+            finally:
+                for stop in stops.values():
+                    stop.set()
+                span.attributes.update(attempts=len(stops), retries=retries, hedges=hedges,
+                                       breaker=guard.breaker.state)
+
+
+ANSWER_MODES = ("llm", "retrieval")
+RETRIEVAL_MODES = ("vector", "hybrid")
+
+
+def build_location_prompt():
+    """
+    촬영장소 JSON 답변용 프롬프트를 만듭니다. (JSON 출력 형식 지시사항 포함)
+    프롬프트 문구를 바꾸면 PROMPT_VERSION도 올려야 답변 캐시가 갈립니다.
+    """
+    # 4. JSON 출력 파서 초기화
+    json_parser = JsonOutputParser(pydantic_object=LocationInfo)
+    
+    # 5. 프롬프트 템플릿 정의
+    prompt = ChatPromptTemplate.from_template("""
+    주어진 맥락을 사용하여 질문에 답변하세요.
+    사용자가 입력한 드라마 제목에서 촬영장소 2개를 출력해주세요.                                        
+    맥락에 없는 내용은 답변하지 마세요.
+
+    {format_instructions}
+
+    맥락:
+    {context}
+
+    질문: {input}
+    """)
+    
+    # 프롬프트에 JSON 출력 형식 지시사항을 추가
+    return prompt.partial(format_instructions=json_parser.get_format_instructions())
+
+
+# vector DB 검색, 검색 형식 json
+def get_rag_chain_with_json_output(vectorstore,
+                                   title_index: TitleIndex = None,
+                                   llm=None,
+                                   answer_mode: str = "llm",
+                                   answer_count: int = 2,
+                                   ranking: str = "retrieval",
+                                   filter_extractor: QueryFilterExtractor = None,
+                                   retrieval_mode: str = "vector",
+                                   lexical_index: LexicalIndex = None,
+                                   k: int = 5,
+                                   context_token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET,
+                                   token_usage: TokenUsageCallbackHandler = None,
+                                   llm_guard: LLMGuard = None):
+    """
+    RAG 파이프라인을 구성하고, LLM 답변을 JSON 형식으로 반환합니다.
 
-# from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_huggingface import HuggingFaceEmbeddings
+    Args:
+        vectorstore (Chroma): Chroma 벡터 DB.
+        title_index (TitleIndex): 제목 인덱스. 주어지면 제목이 맞는 검색어는
+            벡터 검색 없이 해당 제목의 행을 바로 맥락으로 사용합니다.
+        llm: 사용할 LLM 객체. None이면 Gemini(LLM_MODEL_NAME)를 새로 만듭니다.
+        answer_mode (str): "llm"이면 Gemini가 답변(JSON 문자열)을 만들고,
+            "retrieval"이면 LLM 없이 검색된 행으로 LocationInfo dict 리스트를 바로 만듭니다.
+        answer_count (int): retrieval 모드에서 반환할 장소 수. (llm 모드는 대체 답변의 장소 수)
+        ranking (str): retrieval 모드 정렬 기준 (build_location_infos 참고).
+        filter_extractor (QueryFilterExtractor): 주어지면 검색어에서 제목/미디어유형/지역 등을
+            찾아 Chroma where 필터로 후보를 줄인 뒤 검색합니다.
+        retrieval_mode (str): "vector"는 벡터 검색만, "hybrid"는 BM25 어휘 검색과 벡터 검색을 RRF로 합칩니다.
+        lexical_index (LexicalIndex): hybrid 모드용 어휘 색인. None이면 벡터 DB로 새로 만듭니다.
+        k (int): 검색 문서 수.
+        context_token_budget (int): llm 모드에서 프롬프트 맥락의 토큰 예산.
+            검색된 청크를 행 단위로 합치고 빈 필드를 뺀 뒤 예산 안으로 자릅니다. None이면 압축하지 않음.
+        token_usage (TokenUsageCallbackHandler): 주어지면 LLM 호출별 입력/출력 토큰 수를 기록합니다.
+        llm_guard (LLMGuard): 주어지면 llm 모드의 LLM 호출에 마감 시간/재시도/헤지/회로 차단기를 적용하고,
+            실패하면 검색된 행으로 answer_count개 장소를 만든 FallbackAnswer를 돌려줍니다.
 
-from langchain_core.documents import Document
-from langchain_community.document_loaders.csv_loader import CSVLoader
+    Returns:
+        Runnable: JSON 출력 파서가 적용된 RAG 체인. (답변 캐시용 구성은 rag_chain_config로 확인)
+    """
+    if answer_mode not in ANSWER_MODES:
+        raise ValueError(f"answer_mode는 {ANSWER_MODES} 중 하나여야 합니다: {answer_mode}")
 
-from langchain_core.output_parsers import JsonOutputParser
-from pydantic import BaseModel, Field
+    # 같은 검색어라도 검색/답변 구성이 다르면 답변이 달라지므로 답변 캐시 키에 넣음 (rag_chain_config)
+    rag_config = {"answer_mode": answer_mode, "retrieval_mode": retrieval_mode, "k": max(k, answer_count),
+                  "filter": filter_extractor is not None}
+    if answer_mode == "retrieval":
+        rag_config.update(answer_count=answer_count, ranking=ranking)
+    else:
+        rag_config.update(context_token_budget=context_token_budget)
 
-import json
-import pandas as pd
-import ast
-from dotenv import load_dotenv
+    # 2. 검색기 설정 (llm 모드는 중복 청크/빈 필드를 뺀 맥락만 프롬프트에 넣음)
+    retriever = build_rag_retriever(vectorstore, title_index=title_index, filter_extractor=filter_extractor,
+                                    retrieval_mode=retrieval_mode, lexical_index=lexical_index,
+                                    k=max(k, answer_count),
+                                    context_token_budget=context_token_budget if answer_mode == "llm" else None)
 
+    from langchain.chains import create_retrieval_chain
+    from langchain_core.runnables import RunnableLambda
 
+    if answer_mode == "retrieval":
+        logger.info("Creating retrieval-only chain (no LLM)...")
+        answer_builder = RunnableLambda(
+            lambda inputs: [
+                location.model_dump()
+                for location in build_location_infos(inputs["context"], count=answer_count, ranking=ranking)
+            ]
+        )
+        return create_retrieval_chain(retriever, answer_builder).with_config(metadata={"rag_config": rag_config})
 
-# 환경 변수 로드
-load_dotenv(override=True)
+    logger.info("Creating RAG chain with Gemini and JSON output...")
+    document_chain = build_location_document_chain(llm, answer_count=answer_count, token_usage=token_usage,
+                                                   llm_guard=llm_guard)
+    retrieval_chain = create_retrieval_chain(retriever, document_chain)
+    
+    return retrieval_chain.with_config(metadata={"rag_config": rag_config})
 
-# Google API 키 설정
-os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
 
-# 웹 문서 로더
-def load_url_and_split_documents(urls: list):
-    """
-    여러 URL에서 문서를 로드하고 청크로 분할합니다.
+def rag_chain_config(chain):
+    """get_rag_chain_with_json_output이 체인에 붙여 둔 구성 dict (답변 캐시 키용). 없으면 빈 dict."""
+    config = getattr(chain, "config", None) or {}
+    return (config.get("metadata") or {}).get("rag_config", {})
 
-    Args:
-        urls (list): 데이터를 가져올 URL 리스트.
+
+def build_rag_retriever(vectorstore,
+                        title_index: TitleIndex = None,
+                        filter_extractor: QueryFilterExtractor = None,
+                        retrieval_mode: str = "vector",
+                        lexical_index: LexicalIndex = None,
+                        k: int = 5,
+                        context_token_budget: int = None):
+    """
+    RAG 검색기를 구성합니다. (get_rag_chain_with_json_output과 arun_rag_queries가 같은 구성을 씀)
+    인자는 get_rag_chain_with_json_output과 같고, context_token_budget이 None이면 맥락을 압축하지 않습니다.
 
     Returns:
-        list: 분할된 문서 청크 리스트.
+        BaseRetriever: 제목 인덱스 -> (필터/하이브리드/샤드) 검색 -> 행 펼치기 -> 맥락 압축 순서의 검색기.
     """
-    all_docs = []
-    for url in urls:
-        print(f"Loading data from: {url}")
-        loader = WebBaseLoader(url)
-        docs = loader.load()
-        all_docs.extend(docs)
-    
-    # chunk_size를 더 크게 설정
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=800, 
-        chunk_overlap=80)
-    splits = text_splitter.split_documents(all_docs)
-    return splits
+    if retrieval_mode not in RETRIEVAL_MODES:
+        raise ValueError(f"retrieval_mode는 {RETRIEVAL_MODES} 중 하나여야 합니다: {retrieval_mode}")
 
+    if retrieval_mode == "hybrid":
+        if lexical_index is None:
+            lexical_index = build_lexical_index(vectorstore)
+        retriever = HybridRetriever(vectorstore=vectorstore, lexical_index=lexical_index,
+                                    filter_extractor=filter_extractor, k=k)
+    elif isinstance(vectorstore, ShardedVectorStore):
+        retriever = ShardedRetriever(vectorstore=vectorstore, filter_extractor=filter_extractor, k=k)
+    elif filter_extractor is not None:
+        retriever = MetadataFilteredRetriever(vectorstore=vectorstore, filter_extractor=filter_extractor, k=k)
+    else:
+        retriever = vectorstore.as_retriever(search_kwargs={"k": k})
+    # 행 단위 임베딩으로 적재한 경우 검색 결과를 원래 행 내용으로 펼침
+    retriever = RowExpandingRetriever(base_retriever=retriever)
+    if title_index is not None:
+        retriever = TitleFirstRetriever(title_index=title_index, base_retriever=retriever, k=k)
+    if context_token_budget is not None:
+        retriever = CompactingRetriever(base_retriever=retriever, max_tokens=context_token_budget)
+    return retriever
 
-# csv 데이터 문서 로더
-def load_csv_and_split_documents(file_path):
+
+def build_location_document_chain(llm=None,
+                                  answer_count: int = 2,
+                                  token_usage: TokenUsageCallbackHandler = None,
+                                  llm_guard: LLMGuard = None):
     """
-    csv 파일 형태의 데이터를 로딩해서 데이터 스플릿함
+    맥락 문서와 검색어({"input", "context"})로 LLM 답변을 만드는 체인을 구성합니다.
+    (get_rag_chain_with_json_output과 arun_rag_queries가 같은 구성을 씀, 인자 설명은 그쪽 참고)
     """
+    from langchain.chains.combine_documents import create_stuff_documents_chain
 
-    loader = CSVLoader(
-        file_path=file_path, 
-        source_column="제목명",
-        # metadata_columns=['일련번호','미디어유형','제목명','장소명','장소유형','관련장소설명','운영시간','휴식시간','휴무일안내내용','주소','위치위도','위치경도','전화번호','최종수정일자'],
-        encoding='utf-8',
-        # csv_args={
-        #     'encoding': 'utf-8',
-        #     'delimiter': ',',
-        #     'quotechar': '"',
-        #     'on_bad_lines': 'skip'
-        # }
-    )
-    all_docs = loader.load()
+    # 3. LLM 설정
+    if llm is None:
+        llm = create_gemini_llm()
+    
+    if token_usage is not None:
+        llm = llm.with_config(callbacks=[token_usage])
 
-    print("파일이 로딩 됐습니다.")
-    # chunk_size를 더 크게 설정
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=300, 
-        chunk_overlap=50
+    # 4~5. JSON 출력 형식 지시사항이 들어간 프롬프트
+    prompt = build_location_prompt()
+    
+    # 6. 체인 구성
+    document_chain = create_stuff_documents_chain(llm, prompt)
+    if llm_guard is not None:
+        document_chain = llm_guard.wrap(
+            document_chain,
+            lambda inputs: [location.model_dump()
+                            for location in build_location_infos(inputs["context"], count=answer_count)]
         )
-    splits = text_splitter.split_documents(all_docs)
-    return splits
+    return document_chain
 
-# 벡터 DB 구성
-def create_vector_db_with_google(splits: list):
+
+# 답변 캐시 (SQLite 파일, Streamlit 재시작 후에도 유지)
+def normalize_query(query: str):
+    """캐시 키용 검색어 정규화 (NFKC, 소문자, 연속 공백 정리)"""
+    query = unicodedata.normalize("NFKC", query).lower()
+    return " ".join(query.split())
+
+
+def get_collection_version(vectorstore):
     """
-    분할된 문서 청크를 사용하여 ChromaDB 벡터 DB를 생성합니다.
+    벡터 DB 컬렉션 버전 문자열을 만듭니다. (컬렉션 이름 + 청크 ID 해시)
+    청크 ID에 행 내용 해시가 들어있으므로, 데이터가 바뀌면 캐시 키도 달라집니다.
+    """
+    if isinstance(vectorstore, (MemmapVectorStore, ShardedVectorStore)):
+        return vectorstore.collection_version()
+    collection = vectorstore._collection
+    ids = sorted(collection.get(include=[])["ids"])
+    digest = hashlib.sha1("\n".join(ids).encode("utf-8")).hexdigest()[:12]
+    return f"{collection.name}:{len(ids)}:{digest}"
 
-    Args:
-        splits (list): 분할된 문서 청크 리스트.
 
-    Returns:
-        Chroma: 생성된 Chroma 벡터 DB.
+class AnswerCache:
+    """
+    run_rag_query 답변 캐시.
+    키는 (정규화된 검색어, 프롬프트 버전, 모델명, 컬렉션 버전, 체인 구성)이고,
+    TTL이 지난 항목은 버리며 max_entries를 넘으면 가장 오래 안 쓴 항목부터 지웁니다.
+    장소를 하나도 검증하지 못한 답변은 저장하지 않습니다. (is_cacheable_answer)
     """
-    print("Creating vector database with Google AI Embeddings...")
-    embedding = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
-    vectorstore = Chroma.from_documents(documents=splits, embedding=embedding)
-    return vectorstore
 
+    def __init__(self,
+                 path: str = "./cache/answer_cache.sqlite3",
+                 max_entries: int = 1000,
+                 ttl_seconds: float = 7 * 24 * 3600,
+                 prompt_version: str = PROMPT_VERSION,
+                 model_name: str = LLM_MODEL_NAME,
+                 collection_version: str = ""):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.namespace = f"{prompt_version}|{model_name}|{collection_version}"
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
 
+        cache_dir = os.path.dirname(path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                key TEXT PRIMARY KEY,
+                query TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                hit_count INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS answers_accessed_at ON answers (accessed_at)")
+        self._conn.commit()
 
-# 하드디스크 저장
-def create_vector_db_with_hf(splits: list, 
-                             db_path: str = "./chroma_db",
-                             collection_name: str = "documents",
-                             ):
+    def make_key(self, query: str, chain_config: dict = None):
+        config = json.dumps(chain_config or {}, ensure_ascii=False, sort_keys=True)
+        raw = f"{self.namespace}|{config}|{normalize_query(query)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, query: str, chain_config: dict = None):
+        """캐시된 답변을 반환합니다. 없거나 만료됐으면 None. chain_config는 rag_chain_config(chain)."""
+        key = self.make_key(query, chain_config)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT answer, created_at FROM answers WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                if row is not None:
+                    self._conn.execute("DELETE FROM answers WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE answers SET accessed_at = ?, hit_count = hit_count + 1 WHERE key = ?",
+                (now, key),
+            )
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, query: str, answer, chain_config: dict = None):
+        """답변을 저장하고, 만료 항목 정리 및 LRU 크기 제한을 적용합니다."""
+        key = self.make_key(query, chain_config)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answers (key, query, answer, created_at, accessed_at, hit_count) "
+                "VALUES (?, ?, ?, ?, ?, 0)",
+                (key, normalize_query(query), json.dumps(answer, ensure_ascii=False), now, now),
+            )
+            self._conn.execute("DELETE FROM answers WHERE created_at < ?", (now - self.ttl_seconds,))
+            overflow = self._size() - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM answers WHERE key IN "
+                    "(SELECT key FROM answers ORDER BY accessed_at ASC LIMIT ?)",
+                    (overflow,),
+                )
+            self._conn.commit()
+
+    def _size(self):
+        return self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM answers")
+            self._conn.commit()
+
+    def stats(self):
+        """히트/미스 카운터와 현재 항목 수"""
+        with self._lock:
+            size = self._size()
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": size,
+            "max_entries": self.max_entries,
+        }
+
+
+# 제목별 미리 만든 답변 (materialize.py가 채우고, 앱은 제목 검색어에 LLM 호출 없이 바로 응답)
+# 버전은 (프롬프트 버전, 모델명, 검색 문서 수, 맥락 토큰 예산) 해시이고,
+# 데이터 버전은 제목마다 그 제목 행들의 내용 해시로 따로 관리해서 바뀐 제목만 다시 만듭니다.
+# 제목이 포함만 된 검색어("슬기로운 의사생활 카페")는 질문 의도가 달라질 수 있어 미리 만든 답변을 쓰지 않습니다.
+PRECOMPUTED_MATCH_TYPES = ("exact", "normalized", "fuzzy")
+
+
+def title_rows_hash(docs: list):
+    """제목 하나에 속한 행 Document들의 내용 해시 (행 순서와 무관)"""
+    return _text_hash("\x1e".join(sorted(doc.page_content for doc in docs)))[:16]
+
+
+def validate_locations(answer):
     """
-    분할된 문서 청크를 사용하여 ChromaDB 벡터 DB를 생성하고 파일로 저장합니다.
-    Hugging Face의 한국어 임베딩 모델을 사용합니다.
+    답변(JSON 문자열 또는 dict 리스트)을 LocationInfo로 검증해서 dict 리스트로 반환합니다.
 
-    Args:
-        splits (list): 분할된 문서 청크 리스트.
-        db_path (str): 벡터 DB 파일이 저장될 디렉터리 경로.
+    Raises:
+        ValueError: 형식이 맞지 않는 장소가 있거나 장소가 하나도 없을 때. (pydantic ValidationError 포함)
+    """
+    locations = [LocationInfo.model_validate(item).model_dump() for item in _answer_to_locations(answer)]
+    if not locations:
+        raise ValueError("답변에서 장소 정보를 찾을 수 없습니다.")
+    return locations
 
-    Returns:
-        Chroma: 생성된 Chroma 벡터 DB.
+
+def is_cacheable_answer(answer):
+    """답변 캐시에 넣어도 되는 답변인지 (LLM 대체 답변이 아니고, 장소가 모두 LocationInfo로 검증됨)"""
+    if not answer or isinstance(answer, FallbackAnswer):
+        return False
+    try:
+        validate_locations(answer)
+    except ValueError:
+        return False
+    return True
+
+
+class PrecomputedAnswerStore:
+    """
+    제목 -> 검증된 LocationInfo dict 리스트 저장소. (SQLite, 답변은 zlib으로 압축한 JSON)
+    title_index를 주면 lookup(검색어)로 검색어가 가리키는 제목의 답변을 바로 찾을 수 있습니다.
     """
-    print("Creating vector database with Hugging Face Embeddings (Sentence-Transformers)...")
-    
-    # 'jhgan/ko-sbert-nli' 모델 로드
-    model_name = "jhgan/ko-sbert-nli"
-    embedding = HuggingFaceEmbeddings(model_name=model_name)
-    
-    # DB 파일 저장 경로 확인 및 생성
-    if not os.path.exists(db_path):
-        os.makedirs(db_path)
-    
-    # persist_directory를 사용하여 DB를 파일로 저장
-    vectorstore = Chroma.from_documents(
-        documents=splits,
-        embedding=embedding,
-        persist_directory=db_path,
-        collection_name=collection_name
-    )
-    
-    # DB 저장
-    print(f"\nVector DB successfully created and saved at: {db_path}")
 
-    return vectorstore
+    def __init__(self,
+                 path: str = "./cache/precomputed_answers.sqlite3",
+                 title_index: TitleIndex = None,
+                 prompt_version: str = PROMPT_VERSION,
+                 model_name: str = LLM_MODEL_NAME,
+                 k: int = 5,
+                 context_token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET):
+        self.path = path
+        self.title_index = title_index
+        self.version = _text_hash(f"{prompt_version}|{model_name}|k={k}|budget={context_token_budget}")[:12]
+        self.hits = 0
+        self.misses = 0
+        self._current_hashes = {}
+        self._lock = threading.Lock()
 
-# Chroma DB 로드 (한국어 SBERT 모델 사용)
-def load_vector_db(persist_directory: str = "./chroma_db", 
-                   collection_name: str = "documents",
-                   model_name: str = "jhgan/ko-sbert-nli"):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                version TEXT NOT NULL,
+                title TEXT NOT NULL,
+                rows_hash TEXT NOT NULL,
+                answer BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (version, title)
+            ) WITHOUT ROWID
+        """)
+        self._conn.commit()
+
+    def get(self, title: str, rows_hash: str = None):
+        """저장된 답변을 반환합니다. 없거나 rows_hash가 다르면(데이터가 바뀜) None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT rows_hash, answer FROM answers WHERE version = ? AND title = ?", (self.version, title)
+            ).fetchone()
+        if row is None or (rows_hash is not None and row[0] != rows_hash):
+            return None
+        return json.loads(zlib.decompress(row[1]).decode("utf-8"))
+
+    def put(self, title: str, rows_hash: str, locations: list):
+        """검증된 답변을 저장합니다. (한 건씩 커밋하므로 작업이 중간에 끊겨도 저장된 제목은 유지)"""
+        blob = zlib.compress(json.dumps(locations, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 9)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answers (version, title, rows_hash, answer, created_at) VALUES (?, ?, ?, ?, ?)",
+                (self.version, title, rows_hash, blob, time.time()),
+            )
+            self._conn.commit()
+
+    def rows_hashes(self):
+        """현재 버전에 저장된 {제목: rows_hash}"""
+        with self._lock:
+            return dict(self._conn.execute("SELECT title, rows_hash FROM answers WHERE version = ?", (self.version,)))
+
+    def prune(self, titles):
+        """데이터에 없는 제목과 다른 버전(이전 프롬프트/모델)의 답변을 지우고 지운 수를 반환합니다."""
+        titles = set(titles)
+        with self._lock:
+            stale = [(self.version, title) for (title,) in
+                     self._conn.execute("SELECT title FROM answers WHERE version = ?", (self.version,))
+                     if title not in titles]
+            self._conn.executemany("DELETE FROM answers WHERE version = ? AND title = ?", stale)
+            other = self._conn.execute("DELETE FROM answers WHERE version != ?", (self.version,)).rowcount
+            self._conn.commit()
+        return len(stale) + other
+
+    def lookup(self, query: str):
+        """
+        검색어가 가리키는 제목의 미리 만든 답변을 찾습니다.
+
+        Returns:
+            tuple | None: (제목, LocationInfo dict 리스트). 제목이 아니거나, 답변이 없거나, 데이터가 바뀌었으면 None.
+        """
+        match = self.title_index.lookup(query) if self.title_index is not None else None
+        if match is None or match.match_type not in PRECOMPUTED_MATCH_TYPES:
+            self.misses += 1
+            return None
+        rows_hash = self._current_hashes.get(match.title)
+        if rows_hash is None:
+            rows_hash = self._current_hashes[match.title] = title_rows_hash(
+                self.title_index.get_documents(match.title))
+        locations = self.get(match.title, rows_hash)
+        if locations is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return match.title, locations
+
+    def stats(self):
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM answers WHERE version = ?", (self.version,)).fetchone()[0]
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                "size": size, "version": self.version}
+
+
+def materialize_title_answers(chain,
+                              title_index: TitleIndex,
+                              store: PrecomputedAnswerStore,
+                              titles: list = None,
+                              force: bool = False,
+                              requests_per_minute: float = None,
+                              prune: bool = False):
     """
-    기존 Chroma DB 로드
-    
+    제목마다 RAG 체인을 한 번씩 실행해서, LocationInfo로 검증한 답변을 store에 저장합니다.
+    이미 저장된 제목은 행 내용 해시가 같으면 건너뛰므로, 중간에 끊겨도 다시 실행하면 이어서 진행하고
+    데이터가 바뀐 제목만 다시 만듭니다. 실패한 제목은 저장하지 않으므로 다음 실행에서 다시 시도합니다.
+
     Args:
-        persist_directory: Chroma DB 저장 경로
-        collection_name: 컬렉션 이름
-        model_name: HuggingFace 임베딩 모델명
-    
+        chain: get_rag_chain_with_json_output(answer_mode="llm")으로 만든 체인.
+        title_index (TitleIndex): 제목 인덱스 (제목 목록과 행 해시 계산용).
+        store (PrecomputedAnswerStore): 답변 저장소.
+        titles (list): 처리할 제목 목록. None이면 전체 제목.
+        force (bool): True면 저장된 답변이 있어도 다시 만듭니다.
+        requests_per_minute (float): 분당 LLM 호출 한도. None이면 제한 없음.
+        prune (bool): True면 데이터에 없는 제목과 이전 버전 답변을 지웁니다.
+
     Returns:
-        Chroma vectorstore 객체
+        dict: {"total", "skipped", "done", "failed", "pruned", "errors"} 요약.
     """
-    # 한국어 SBERT 모델 초기화 (저장할 때와 동일한 모델 사용)
-    embeddings = HuggingFaceEmbeddings(model_name=model_name)
-    
-    # Chroma DB 로드
-    vectorstore = Chroma(
-        persist_directory=persist_directory,
-        embedding_function=embeddings,
-        collection_name=collection_name
-    )
-    print("크로마DB 로딩 완료.")
-    
-    return vectorstore
+    titles = list(title_index.titles if titles is None else titles)
+    stored = store.rows_hashes()
+    summary = {"total": len(titles), "skipped": 0, "done": 0, "failed": 0, "pruned": 0, "errors": {}}
+    interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+    last_call = None
+    for i, title in enumerate(titles, 1):
+        rows_hash = title_rows_hash(title_index.get_documents(title))
+        if not force and stored.get(title) == rows_hash:
+            summary["skipped"] += 1
+            continue
+        if last_call is not None and interval:
+            time.sleep(max(0.0, last_call + interval - time.perf_counter()))
+        last_call = time.perf_counter()
+        try:
+            answer = run_rag_query(chain, title)
+            if isinstance(answer, FallbackAnswer):
+                raise RuntimeError(f"LLM 대체 답변 ({answer.reason})")
+            locations = validate_locations(answer)
+        except Exception as e:
+            summary["failed"] += 1
+            # pydantic 검증 오류는 여러 줄이라 첫 줄(오류 개수)만 남김
+            summary["errors"][title] = f"{type(e).__name__}: {str(e).splitlines()[0] if str(e) else ''}"
+            logger.warning(f"[{i}/{len(titles)}] {title} 실패: {summary['errors'][title]}")
+            continue
+        store.put(title, rows_hash, locations)
+        summary["done"] += 1
+        logger.info(f"[{i}/{len(titles)}] {title}: 장소 {len(locations)}개 저장")
+    if prune:
+        summary["pruned"] = store.prune(title_index.titles)
+    return summary
 
-# 1. 원하는 JSON 구조를 정의하는 Pydantic 모델
-class LocationInfo(BaseModel):
-    장소: str = Field(description="영화/드라마 촬영 장소의 이름")
-    주소: str = Field(description="영화/드라마 촬영 장소의 주소")
-    장면_설명: str = Field(description="해당 장소에서 촬영된 영화/드라마 장면의 상세 설명")
-    장소_설명: str = Field(description="촬영 장소 상세 설명")
-    위도: float = Field(description="위도")
-    경도: float = Field(description="경도")
 
-# vector DB 검색, 검색 형식 json
-def get_rag_chain_with_json_output(vectorstore):
+# 공유 리소스 관리 (Streamlit 세션/재실행마다 모델을 다시 만들지 않도록)
+class ResourceManager:
+    """
+    임베딩 모델, Chroma, Gemini, 체인처럼 만들기 비싼 객체를 프로세스당 한 번만 만들어 공유합니다.
+    처음 만들 때 걸린 시간은 timings에 기록됩니다.
     """
-    RAG 파이프라인을 구성하고, LLM 답변을 JSON 형식으로 반환합니다.
 
-    Args:
-        vectorstore (Chroma): Chroma 벡터 DB.
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._resources = {}
+        self.timings = {}
+        self.first_query = None
+        self._query_samples = deque(maxlen=200)
+
+    def get(self, key, factory):
+        """key에 해당하는 객체를 반환하고, 없으면 factory()로 만들어 저장합니다."""
+        with self._lock:
+            if key not in self._resources:
+                started = time.perf_counter()
+                self._resources[key] = factory()
+                self.timings[key] = time.perf_counter() - started
+                logger.info(f"공유 리소스 준비: {key} ({self.timings[key]:.2f}s)")
+            return self._resources[key]
+
+    def embeddings(self, model_name: str = "jhgan/ko-sbert-nli", cache_dir: str = "./cache/embeddings"):
+        return self.get(("embeddings", model_name, cache_dir),
+                        lambda: with_embedding_cache(_hf_embedding_factory(model_name), model_name, cache_dir))
+
+    def vectorstore(self, persist_directory: str = "./chroma_db", collection_name: str = "documents",
+                    model_name: str = "jhgan/ko-sbert-nli"):
+        return self.get(("vectorstore", persist_directory, collection_name, model_name),
+                        lambda: load_vector_db(persist_directory, collection_name,
+                                               embeddings=self.embeddings(model_name)))
+
+    def llm(self, model_name: str = LLM_MODEL_NAME):
+        return self.get(("llm", model_name), lambda: create_gemini_llm(model_name))
+
+    def warm_up(self, model_name: str = "jhgan/ko-sbert-nli", persist_directory: str = "./chroma_db",
+                collection_name: str = "documents"):
+        """
+        더미 임베딩과 더미 검색을 한 번 실행해서 모델 가중치와 Chroma 인덱스를 메모리에 올립니다.
+        (임베딩 캐시를 거치지 않도록 원래 모델로 직접 계산)
+
+        Returns:
+            float: 워밍업에 걸린 시간(초).
+        """
+        started = time.perf_counter()
+        embeddings = self.embeddings(model_name)
+        model = embeddings.embedding if isinstance(embeddings, CachedEmbeddings) else embeddings
+        vector = model.embed_query("워밍업")
+        self.vectorstore(persist_directory, collection_name, model_name).similarity_search_by_vector(vector, k=1)
+        self.timings["warm_up"] = time.perf_counter() - started
+        logger.info(f"워밍업 완료 ({self.timings['warm_up']:.2f}s)")
+        return self.timings["warm_up"]
+
+    def record_query_latency(self, seconds: float):
+        """검색 한 번의 지연 시간을 기록합니다. 첫 검색은 따로 보관합니다."""
+        with self._lock:
+            if self.first_query is None:
+                self.first_query = seconds
+            else:
+                self._query_samples.append(seconds)
+
+    def latency_report(self):
+        """
+        콜드 스타트(리소스 생성 합계), 워밍업, 첫 검색, steady-state 지연 시간(초)을 구분해서 반환합니다.
+        """
+        with self._lock:
+            samples = sorted(self._query_samples)
+            build = sum(seconds for key, seconds in self.timings.items() if key != "warm_up")
+            return {
+                "cold_start": build,
+                "warm_up": self.timings.get("warm_up"),
+                "first_query": self.first_query,
+                "steady_p50": samples[len(samples) // 2] if samples else None,
+                "steady_p95": samples[int(len(samples) * 0.95)] if samples else None,
+                "steady_count": len(samples),
+            }
+
+
+_resource_manager = ResourceManager()
+
+
+def get_resource_manager():
+    """프로세스 전체에서 공유하는 ResourceManager를 반환합니다."""
+    return _resource_manager
+
+
+def measure_query_latency(chain, query: str, steady_runs: int = 5):
+    """
+    첫 검색과 이후(steady-state) 검색의 지연 시간을 따로 측정합니다.
+    답변 캐시 없이 체인을 직접 호출합니다.
 
     Returns:
-        RetrievalChain: JSON 출력 파서가 적용된 RAG 체인.
+        dict: first_query, steady_p50, steady_max (초)
     """
-    print("Creating RAG chain with Gemini and JSON output...")
-    
-    # 2. 검색기 설정
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 5})
-    
-    # 3. LLM 설정
-    llm = GoogleGenerativeAI(model="models/gemini-2.5-flash") 
-    
-    # 4. JSON 출력 파서 초기화
-    json_parser = JsonOutputParser(pydantic_object=LocationInfo)
-    
-    # 5. 프롬프트 템플릿 정의
-    prompt = ChatPromptTemplate.from_template("""
-    주어진 맥락을 사용하여 질문에 답변하세요.
-    사용자가 입력한 드라마 제목에서 촬영장소 2개를 출력해주세요.                                        
-    맥락에 없는 내용은 답변하지 마세요.
+    started = time.perf_counter()
+    chain.invoke({"input": query})
+    first_query = time.perf_counter() - started
 
-    {format_instructions}
+    samples = []
+    for _ in range(steady_runs):
+        started = time.perf_counter()
+        chain.invoke({"input": query})
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return {
+        "first_query": first_query,
+        "steady_p50": samples[len(samples) // 2] if samples else None,
+        "steady_max": samples[-1] if samples else None,
+    }
 
-    맥락:
-    {context}
 
-    질문: {input}
-    """)
-    
-    # 프롬프트에 JSON 출력 형식 지시사항을 추가
-    prompt = prompt.partial(format_instructions=json_parser.get_format_instructions())
-    
-    # 6. 체인 구성
-    document_chain = create_stuff_documents_chain(llm, prompt)
-    retrieval_chain = create_retrieval_chain(retriever, document_chain)
-    
-    return retrieval_chain
+# LLM 출력 점진 파싱 (스트리밍 중 LocationInfo 객체가 닫히는 즉시 꺼냄)
+class IncrementalLocationParser:
+    """
+    LLM이 토큰 단위로 내보내는 JSON 배열 텍스트를 받아,
+    최상위 객체({ ... })가 닫힐 때마다 dict로 돌려주는 파서.
+    코드블록 표시(```json), 앞뒤 설명 문장, 배열 괄호/쉼표는 무시합니다.
+    """
+
+    def __init__(self):
+        self._depth = 0
+        self._quote = None
+        self._escape = False
+        self._current = []
+        self.errors = []
+
+    def feed(self, text: str):
+        """
+        텍스트 조각을 넣고, 이번 조각으로 완성된 객체 리스트를 반환합니다.
+        """
+        completed = []
+        for ch in text:
+            if self._depth == 0:
+                if ch == "{":
+                    self._depth = 1
+                    self._current = [ch]
+                continue
+
+            self._current.append(ch)
+            if self._quote:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == self._quote:
+                    self._quote = None
+            elif ch in "\"'":
+                self._quote = ch
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    completed.extend(self._parse_object("".join(self._current)))
+                    self._current = []
+        return completed
+
+    def _parse_object(self, text: str):
+        try:
+            data = json.loads(text)
+        except ValueError:
+            # 파이썬 dict 표기(작은따옴표 등)로 나오는 경우
+            try:
+                data = ast.literal_eval(text)
+            except (ValueError, SyntaxError) as e:
+                self.errors.append(f"{e}: {text[:80]}")
+                return []
+        if not isinstance(data, dict):
+            return []
+        # {"locations": [{...}, ...]} 처럼 한 번 감싸서 나오는 경우 풀어줌
+        if "장소" not in data:
+            nested = [value for value in data.values() if isinstance(value, list)]
+            if nested and all(isinstance(item, dict) for item in nested[0]):
+                return nested[0]
+        return [data]
+
+
+def parse_location_json(text: str):
+    """
+    LLM 답변 문자열 전체에서 LocationInfo 형태의 dict 리스트를 추출합니다.
+    (코드블록이 있거나 일부가 깨져 있어도 온전한 객체는 살려서 반환)
+    """
+    return IncrementalLocationParser().feed(text)
+
+
+def _answer_to_locations(answer):
+    if isinstance(answer, str):
+        return parse_location_json(answer)
+    if isinstance(answer, dict):
+        return [answer]
+    return list(answer or [])
+
+
+def run_rag_query_stream(chain, query: str, cache: AnswerCache = None, precomputed: PrecomputedAnswerStore = None):
+    """
+    run_rag_query의 스트리밍 버전. 이벤트 dict를 차례로 yield 합니다.
+        {"type": "context", "documents": [...]}  검색 결과
+        {"type": "token", "text": "..."}         LLM 출력 조각
+        {"type": "location", "data": {...}}      완성된 장소 객체 (나오는 즉시)
+        {"type": "done", "answer": ...}          전체 답변 (run_rag_query 반환값과 동일)
+    """
+    logger.info("Streaming search for: %s", query)
+    tracer = get_tracer()
+    with tracer.span("rag_query", query=query, stream=True) as root:
+        if precomputed is not None:
+            with tracer.span("precomputed"):
+                hit = precomputed.lookup(query)
+            if hit is not None:
+                logger.info("미리 만든 답변 사용: %s", hit[0])
+                root.attributes["precomputed"] = hit[0]
+                root.attributes["locations"] = len(hit[1])
+                for location in hit[1]:
+                    yield {"type": "location", "data": location}
+                yield {"type": "done", "answer": hit[1]}
+                return
+
+        if cache is not None:
+            with tracer.span("answer_cache"):
+                cached_answer = cache.get(query, rag_chain_config(chain))
+            if cached_answer is not None:
+                logger.info("답변 캐시 적중")
+                root.attributes["cache_hit"] = True
+                locations = _answer_to_locations(cached_answer)
+                root.attributes["locations"] = len(locations)
+                for location in locations:
+                    yield {"type": "location", "data": location}
+                yield {"type": "done", "answer": cached_answer}
+                return
+
+        parser = IncrementalLocationParser()
+        root.attributes["locations"] = 0
+        text_parts = []
+        emitted = []
+        answer = None
+        parse_seconds = 0.0
+        for chunk in chain.stream({"input": query}, config={"callbacks": [_tracing_callback]}):
+            if "context" in chunk:
+                yield {"type": "context", "documents": chunk["context"]}
+            if "answer" not in chunk:
+                continue
+            piece = chunk["answer"]
+            started = time.perf_counter()
+            if isinstance(piece, str):
+                text_parts.append(piece)
+                locations = parser.feed(piece)
+            elif isinstance(piece, FallbackAnswer):
+                # LLM 대체 답변: 스트리밍 도중에 끊겼으면 이미 보여준 장소는 빼고 이어 붙임
+                root.attributes["fallback"] = piece.reason
+                shown = {(location.get("장소"), location.get("주소")) for location in emitted}
+                locations = [location for location in piece if (location.get("장소"), location.get("주소")) not in shown]
+                answer = FallbackAnswer(emitted + locations, reason=piece.reason)
+            else:
+                # retrieval 모드: 답변이 한 번에 리스트로 나옴
+                answer = piece
+                locations = _answer_to_locations(piece)
+            parse_seconds += time.perf_counter() - started
+            if isinstance(piece, str):
+                yield {"type": "token", "text": piece}
+            root.attributes["locations"] += len(locations)
+            emitted.extend(locations)
+            for location in locations:
+                yield {"type": "location", "data": location}
+
+        # JSON 파싱은 토큰마다 조금씩 실행되므로 합계를 span 하나로 기록
+        tracer.record_span("parse_json", parse_seconds, errors=len(parser.errors))
+        if answer is None:
+            answer = "".join(text_parts)
+        if parser.errors:
+            logger.warning("파싱하지 못한 객체 %d개: %s", len(parser.errors), parser.errors)
+        if cache is not None and is_cacheable_answer(answer):
+            cache.set(query, answer, rag_chain_config(chain))
+        yield {"type": "done", "answer": answer}
 
 
 # RAG 기반 쿼리
-def run_rag_query(chain, query: str):
+def run_rag_query(chain, query: str, cache: AnswerCache = None, precomputed: PrecomputedAnswerStore = None):
 
     """
     구성된 RAG 체인을 실행하여 사용자 질문에 대한 답변을 생성합니다.
+    cache가 주어지면 같은 검색어의 답변을 LLM 호출 없이 캐시에서 돌려주고,
+    precomputed가 주어지면 검색어가 제목을 가리킬 때 미리 만든 답변(dict 리스트)을 돌려줍니다.
     """
-    print(f"\nSearching for: {query}")
-    response = chain.invoke({"input": query})
-    
-    # RAG의 Context와 Answer를 분리하여 출력
-    print("\n--- Retrieved Context (Top 5) ---")
-    for doc in response['context']:
-        print(f"Source: {doc.metadata.get('source')}")
-        print(f"Content: {doc.page_content}\n")
+    logger.info("Searching for: %s", query)
+    tracer = get_tracer()
+    with tracer.span("rag_query", query=query, stream=False) as root:
+        if precomputed is not None:
+            with tracer.span("precomputed"):
+                hit = precomputed.lookup(query)
+            if hit is not None:
+                logger.info("미리 만든 답변 사용: %s", hit[0])
+                root.attributes["precomputed"] = hit[0]
+                root.attributes["locations"] = len(hit[1])
+                return hit[1]
+
+        if cache is not None:
+            with tracer.span("answer_cache"):
+                cached_answer = cache.get(query, rag_chain_config(chain))
+            if cached_answer is not None:
+                logger.info("답변 캐시 적중")
+                root.attributes["cache_hit"] = True
+                root.attributes["locations"] = len(_answer_to_locations(cached_answer))
+                return cached_answer
+
+        response = chain.invoke({"input": query}, config={"callbacks": [_tracing_callback]})
+
+        # RAG의 Context와 Answer를 분리하여 출력
+        if logger.isEnabledFor(logging.DEBUG):
+            for doc in response['context']:
+                logger.debug("Retrieved context - Source: %s\n%s", doc.metadata.get('source'), doc.page_content)
+
+        if isinstance(response["answer"], FallbackAnswer):
+            root.attributes["fallback"] = response["answer"].reason
+        elif cache is not None and is_cacheable_answer(response["answer"]):
+            cache.set(query, response["answer"], rag_chain_config(chain))
+
+        root.attributes["locations"] = len(_answer_to_locations(response["answer"]))
+        return response["answer"]
+
+
+# 여러 검색어 일괄 처리 (비동기, 동시 실행 수/호출 속도 제한)
+# Gemini 분당 요청 한도 (gemini-2.5-flash 무료 등급 기준, 유료 등급이면 올려서 사용)
+GEMINI_REQUESTS_PER_MINUTE = 10
+
+
+class TokenBucket:
+    """
+    비동기 토큰 버킷 속도 제한기.
+    rate_per_second 속도로 토큰이 차고, 최대 capacity개까지 몰아서 쓸 수 있습니다.
+    """
+
+    def __init__(self, rate_per_second: float, capacity: float = 1.0):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def _batch_retrieve(queries: list, vectorstore, k: int, title_index: TitleIndex = None):
+    """
+    검색어 목록을 한 번에 검색합니다.
+    제목 인덱스 적중분은 바로 행을 쓰고, 나머지는 검색어 임베딩(embed_queries) + Chroma 질의 한 번으로 처리합니다.
+    """
+    contexts = [None] * len(queries)
+    pending = []
+    for i, query in enumerate(queries):
+        match = title_index.lookup(query) if title_index is not None else None
+        if match is not None:
+            contexts[i] = title_index.get_documents(match.title, k=k)
+        else:
+            pending.append(i)
+
+    if pending:
+        vectors = embed_queries(vectorstore.embeddings, [queries[i] for i in pending])
+        if isinstance(vectorstore, (MemmapVectorStore, ShardedVectorStore)):
+            # memmap 저장소는 행렬 곱 한 번, 샤드 저장소는 샤드별 질의 한 번으로 검색어 전체를 검색
+            for i, results in zip(pending, vectorstore.similarity_search_by_vectors_with_score(vectors, k=k)):
+                contexts[i] = expand_row_documents([doc for doc, _ in results])
+            return contexts
+        result = vectorstore._collection.query(query_embeddings=vectors, n_results=k,
+                                               include=["documents", "metadatas"])
+        for slot, i in enumerate(pending):
+            contexts[i] = expand_row_documents([
+                Document(page_content=text, metadata=metadata or {}, id=doc_id)
+                for doc_id, text, metadata in zip(result["ids"][slot], result["documents"][slot],
+                                                  result["metadatas"][slot])
+            ])
+    return contexts
+
+
+async def arun_rag_queries(queries: list,
+                           vectorstore,
+                           llm=None,
+                           concurrency: int = 4,
+                           requests_per_minute: float = GEMINI_REQUESTS_PER_MINUTE,
+                           k: int = 5,
+                           title_index: TitleIndex = None,
+                           answer_count: int = 2,
+                           filter_extractor: QueryFilterExtractor = None,
+                           retrieval_mode: str = "vector",
+                           lexical_index: LexicalIndex = None,
+                           context_token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET,
+                           token_usage: TokenUsageCallbackHandler = None,
+                           llm_guard: LLMGuard = None):
+    """
+    여러 검색어를 한꺼번에 처리합니다.
+    검색기, 프롬프트, 맥락 압축, LLMGuard는 get_rag_chain_with_json_output(llm 모드)과 같은 구성을 쓰므로
+    같은 인자로 만든 체인의 run_rag_query와 같은 답변이 나옵니다.
+    필터 추출기 없이 벡터 검색만 쓰면 검색어 임베딩과 벡터 DB 질의를 배치로 한 번에 하고,
+    필터 추출기나 하이브리드 검색을 쓰면 같은 검색기로 검색어마다 동시에 검색합니다.
+    LLM 호출은 세마포어(concurrency)와 토큰 버킷(requests_per_minute)으로 동시 실행 수와 속도를 제한해서 병렬로 보냅니다.
+
+    Args:
+        queries (list): 검색어 리스트.
+        vectorstore (Chroma): Chroma 벡터 DB.
+        llm: 사용할 LLM 객체. None이면 Gemini.
+        concurrency (int): 동시에 진행할 검색/LLM 호출 수.
+        requests_per_minute (float): 분당 LLM 호출 한도. None이면 제한 없음.
+        k (int): 검색어당 검색 문서 수.
+        title_index (TitleIndex): 제목 인덱스 (선택).
+        answer_count, filter_extractor, retrieval_mode, lexical_index, context_token_budget, token_usage, llm_guard:
+            get_rag_chain_with_json_output 참고.
+
+    Returns:
+        list: 입력 순서대로 {"query", "answer", "context", "error", "seconds"} dict 리스트.
+            실패한 항목은 error에 메시지가 들어가고 answer는 None.
+    """
+    document_chain = build_location_document_chain(llm, answer_count=answer_count, token_usage=token_usage,
+                                                   llm_guard=llm_guard)
+    k = max(k, answer_count)
+
+    results = [{"query": query, "answer": None, "context": [], "error": None, "seconds": None}
+               for query in queries]
+    if retrieval_mode == "vector" and filter_extractor is None:
+        try:
+            contexts = await asyncio.to_thread(_batch_retrieve, list(queries), vectorstore, k, title_index)
+        except Exception as e:
+            for result in results:
+                result["error"] = f"검색 실패: {e}"
+            return results
+        if context_token_budget is not None:
+            contexts = [compact_context(docs, max_tokens=context_token_budget) for docs in contexts]
+    else:
+        retriever = build_rag_retriever(vectorstore, title_index=title_index, filter_extractor=filter_extractor,
+                                        retrieval_mode=retrieval_mode, lexical_index=lexical_index, k=k,
+                                        context_token_budget=context_token_budget)
+        contexts = await retriever.abatch(list(queries), config={"max_concurrency": concurrency},
+                                          return_exceptions=True)
+        for result, context in zip(results, contexts):
+            if isinstance(context, Exception):
+                result["error"] = f"검색 실패: {context}"
+
+    semaphore = asyncio.Semaphore(concurrency)
+    bucket = TokenBucket(requests_per_minute / 60.0) if requests_per_minute else None
+
+    async def answer(i):
+        result = results[i]
+        if result["error"] is not None:
+            return
+        result["context"] = contexts[i]
+        async with semaphore:
+            if bucket is not None:
+                await bucket.acquire()
+            started = time.perf_counter()
+            try:
+                result["answer"] = await document_chain.ainvoke({"input": result["query"], "context": contexts[i]})
+            except Exception as e:
+                result["error"] = f"{type(e).__name__}: {e}"
+            result["seconds"] = time.perf_counter() - started
+
+    await asyncio.gather(*(answer(i) for i in range(len(queries))))
+    return results
+
+
+def run_rag_queries(queries: list, vectorstore, **kwargs):
+    """arun_rag_queries의 동기 버전 (인자는 동일)"""
+    return asyncio.run(arun_rag_queries(queries, vectorstore, **kwargs))
 
-    return response["answer"]
+
+def report_concurrency_throughput(queries: list, vectorstore, llm, levels=(1, 2, 4, 8, 16), **kwargs):
+    """
+    동시 실행 수별 처리량(queries/s)을 측정해서 출력합니다.
+
+    Returns:
+        list: 동시 실행 수별 {"concurrency", "seconds", "qps", "errors"} dict 리스트.
+    """
+    report = []
+    for concurrency in levels:
+        started = time.perf_counter()
+        results = run_rag_queries(queries, vectorstore, llm=llm, concurrency=concurrency, **kwargs)
+        seconds = time.perf_counter() - started
+        report.append({
+            "concurrency": concurrency,
+            "seconds": seconds,
+            "qps": len(queries) / seconds if seconds else 0.0,
+            "errors": sum(1 for result in results if result["error"]),
+        })
+        logger.info(f"concurrency={concurrency:>3}  {seconds:7.2f}s  {report[-1]['qps']:7.1f} q/s  "
+                    f"errors={report[-1]['errors']}")
+    return report
 
 
 if __name__ == "__main__":
-    
+    configure_logging()
+    enable_query_log()
+
     # 1. 데이터 로드 및 분할
     # 1-1 웹 url 문서 로더
     # 여러 URL 리스트
@@ -262,24 +4367,41 @@ if __name__ == "__main__":
     # file_path = os.path.join(folder_path, file_name)
     file_path=f'{folder_path}/{file_name}'
     document_splits = load_csv_and_split_documents(file_path)
+    # 행 단위 임베딩 (제목 + 장소명 + 관련장소설명만 임베딩, 행 하나 = 벡터 하나)
+    # document_splits = load_csv_and_split_documents(file_path, embed_fields=list(DEFAULT_EMBED_FIELDS))
+    title_index = build_title_index(load_csv_documents(file_path))
     
     
-    # 2. 벡터 DB 생성
-    vector_db = create_vector_db_with_hf(document_splits)
+    # 2. 벡터 DB 생성 (증분 적재: 바뀐 행만 다시 임베딩)
+    vector_db = create_vector_db_with_hf(document_splits, incremental=True)
+    # Chroma 대신 양자화 memmap 저장소 (읽기 전용, 로딩이 빠르고 메모리를 적게 씀)
+    # vector_db = create_memmap_vector_db(document_splits, dtype="float16")
+    # vector_db = load_memmap_vector_db()
     
 
-    # vector db 구성 되어있을 경우
-    vector_db = load_vector_db()
+    # vector db 구성 되어있을 경우 (공유 리소스 + 워밍업)
+    manager = get_resource_manager()
+    vector_db = manager.vectorstore()
+    manager.warm_up()
 
     # 3. RAG 체인 구성
     # rag_chain = get_rag_chain(vector_db)
-    rag_chain = get_rag_chain_with_json_output(vector_db)
+    token_usage = TokenUsageCallbackHandler()
+    rag_chain = get_rag_chain_with_json_output(vector_db, title_index=title_index, llm=manager.llm(),
+                                               token_usage=token_usage)
     
     # 4. 사용자 쿼리 실행
     # query = "18 어게인"
     # query = "좋은 맛에 취하다"
     query = "슬기로운 의사생활"
     resutl = run_rag_query(rag_chain, query)
-    print("--- Generated Answer ---")
+    logger.info("--- Generated Answer ---")
+
+    logger.info(resutl)
 
-    print(resutl)
+    # 콜드 스타트 / 첫 검색 / steady-state 지연 시간
+    logger.info("--- Latency ---")
+    logger.info(f"cold start: {manager.timings}")
+    logger.info(f"query: {measure_query_latency(rag_chain, query)}")
+    logger.info(f"tokens: {token_usage.report()}")
+    logger.info("stages:\n" + span_histogram.prometheus_text())
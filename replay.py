@@ -0,0 +1,346 @@
+"""
+요청 재생 도구 (용량 산정용)
+
+앱이 기록한 요청 로그(logs/requests.jsonl) 또는 합성 검색어를 RAG 파이프라인에 다시 흘려 보내고,
+실제로 처리한 처리량(queries/s)과 지연 시간 분포(p50/p90/p95/p99)를 출력합니다.
+
+부하 방식:
+    --concurrency N      닫힌 루프. N개 작업자가 앞 요청이 끝나는 대로 다음 요청을 보냄 (최대 처리량 측정)
+    --qps X              열린 루프. 응답과 상관없이 초당 X건씩 도착. 지연 시간은 예정 도착 시각부터 재므로
+                         처리가 밀리면 대기 시간까지 포함됩니다.
+    --recorded-timing    열린 루프. 로그에 기록된 도착 간격 그대로 (--speed 배 빠르게)
+
+--fake면 가짜 임베딩/가짜 LLM으로 (모델 다운로드, API 키 없이) 파이프라인 자체의 용량을 재고,
+없으면 앱과 같은 벡터 DB(./chroma_db)와 Gemini를 씁니다. (Gemini 요청 한도에 주의)
+
+사용 예:
+    python replay.py --log logs/requests.jsonl --qps 5 --fake --llm-latency 0.8
+    python replay.py --synthetic 200 --concurrency 1 2 4 8 --fake
+    python replay.py --log logs/requests.jsonl --recorded-timing --speed 10 --fake
+    # LLM 장애 흉내 (5% 느린 응답, 2% 오류) + 마감 시간/헤지
+    python replay.py --synthetic 300 --concurrency 4 --fake --llm-latency 0.3 --llm-slow-rate 0.05 \\
+        --llm-slow-latency 10 --llm-error-rate 0.02 --llm-deadline 3 --hedge
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+SOURCE_CSV = "data/test_data_small.csv"
+COLLECTION_NAME = "replay"
+
+
+# 재생할 요청 목록
+def load_traffic(args):
+    """
+    재생할 요청 목록을 만듭니다.
+
+    Returns:
+        list: {"query", "offset", "answer_mode", "retrieval_mode"} dict 리스트.
+            offset은 첫 요청 기준 도착 시각(초). 합성 검색어면 None.
+    """
+    if args.log:
+        import rag_funcs
+        records = sorted(rag_funcs.read_query_log(args.log), key=lambda record: record.get("ts") or 0)
+        if not records:
+            raise SystemExit(f"재생할 요청이 없습니다: {args.log}")
+        first_ts = records[0].get("ts") or 0
+        return [{
+            "query": record["query"],
+            "offset": (record.get("ts") or first_ts) - first_ts,
+            "answer_mode": record.get("answer_mode") or args.answer_mode,
+            "retrieval_mode": record.get("retrieval_mode") or args.retrieval_mode,
+        } for record in records]
+
+    from benchmark import make_queries
+    return [{"query": query, "offset": None, "answer_mode": args.answer_mode, "retrieval_mode": args.retrieval_mode}
+            for query in make_queries(args.csv, args.synthetic, seed=args.seed)]
+
+
+def expand_traffic(traffic: list, n_requests: int):
+    """요청 수가 로그보다 많으면 로그를 이어 붙여 반복합니다. (도착 시각도 한 바퀴 길이만큼 밀어서)"""
+    offsets = [item["offset"] for item in traffic if item["offset"] is not None]
+    span = max(offsets) + (max(offsets) / max(1, len(offsets) - 1)) if offsets else 0.0
+    expanded = []
+    for i in range(n_requests):
+        item = dict(traffic[i % len(traffic)])
+        if item["offset"] is not None:
+            item["offset"] += span * (i // len(traffic))
+        expanded.append(item)
+    return expanded
+
+
+# 파이프라인
+class Pipeline:
+    """답변 방식/검색 방식별 RAG 체인을 처음 쓸 때 한 번만 만들어 여러 스레드가 공유합니다."""
+
+    def __init__(self, args):
+        import rag_funcs
+        self.rag_funcs = rag_funcs
+        self.args = args
+        self._chains = {}
+        self._lock = threading.Lock()
+
+        row_documents = rag_funcs.load_csv_documents(args.csv)
+        self.title_index = rag_funcs.build_title_index(row_documents)
+        if args.fake:
+            import fakes
+
+            embeddings = fakes.HashEmbeddings()
+            db_path = os.path.join(args.workdir, "chroma_" + os.path.splitext(os.path.basename(args.csv))[0])
+            if not os.path.exists(os.path.join(db_path, "chroma.sqlite3")):
+                rag_funcs.create_vector_db_with_hf(rag_funcs.load_csv_and_split_documents(args.csv),
+                                                   db_path=db_path, collection_name=COLLECTION_NAME,
+                                                   embeddings=embeddings, embedding_cache_dir=None)
+            self.vectorstore = rag_funcs.load_vector_db(db_path, COLLECTION_NAME, embeddings=embeddings)
+            self.llm = fakes.FakeLocationLLM(latency=args.llm_latency, slow_rate=args.llm_slow_rate,
+                                             slow_latency=args.llm_slow_latency,
+                                             error_rate=args.llm_error_rate)
+        else:
+            manager = rag_funcs.get_resource_manager()
+            self.vectorstore = manager.vectorstore()
+            self.llm = manager.llm()
+            manager.warm_up()
+        self.filter_extractor = rag_funcs.build_query_filter_extractor(row_documents, title_index=self.title_index)
+        self.llm_guard = None
+        if args.llm_deadline:
+            self.llm_guard = rag_funcs.LLMGuard(deadline=args.llm_deadline, hedge=args.hedge)
+        self.cache = None
+        if args.use_cache:
+            self.cache = rag_funcs.AnswerCache(path=os.path.join(args.workdir, "replay_answer_cache.sqlite3"),
+                                               collection_version=rag_funcs.get_collection_version(self.vectorstore))
+
+    def chain(self, answer_mode: str, retrieval_mode: str):
+        key = (answer_mode, retrieval_mode)
+        with self._lock:
+            if key not in self._chains:
+                lexical_index = None
+                if retrieval_mode == "hybrid":
+                    lexical_index = self.rag_funcs.build_lexical_index(self.vectorstore)
+                self._chains[key] = self.rag_funcs.get_rag_chain_with_json_output(
+                    self.vectorstore, title_index=self.title_index, llm=self.llm, answer_mode=answer_mode,
+                    answer_count=self.args.answer_count, filter_extractor=self.filter_extractor,
+                    retrieval_mode=retrieval_mode, lexical_index=lexical_index, llm_guard=self.llm_guard,
+                )
+            return self._chains[key]
+
+    def run(self, item: dict):
+        """요청 하나를 실행하고 (결과, 에러 메시지)를 반환합니다."""
+        chain = self.chain(item["answer_mode"], item["retrieval_mode"])
+        # 앱과 같이 답변 캐시는 LLM 모드에서만 사용
+        use_cache = item["answer_mode"] == "llm"
+        try:
+            answer = self.rag_funcs.run_rag_query(chain, item["query"], cache=self.cache if use_cache else None)
+        except Exception as e:
+            return "error", f"{type(e).__name__}: {e}"
+        if isinstance(answer, self.rag_funcs.FallbackAnswer):
+            return "fallback", answer.reason
+        if isinstance(answer, str):
+            answer = self.rag_funcs.parse_location_json(answer)
+        return ("ok" if answer else "empty"), None
+
+
+# 부하 발생
+def _execute(pipeline, item: dict, scheduled: float, results: list):
+    started = time.perf_counter()
+    outcome, error = pipeline.run(item)
+    finished = time.perf_counter()
+    results.append({
+        "query": item["query"],
+        "outcome": outcome,
+        "error": error,
+        # 열린 루프: 예정 도착 시각부터 (대기 포함), 닫힌 루프: 보낸 시각부터
+        "latency": finished - scheduled,
+        "service": finished - started,
+        "queue": started - scheduled,
+    })
+
+
+def run_closed_loop(pipeline, traffic: list, concurrency: int):
+    """concurrency개 작업자가 쉬지 않고 요청을 보냅니다."""
+    results = []
+    position = iter(range(len(traffic)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                i = next(position, None)
+            if i is None:
+                return
+            _execute(pipeline, traffic[i], time.perf_counter(), results)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def run_open_loop(pipeline, traffic: list, arrivals: list, max_workers: int):
+    """
+    arrivals(시작 기준 초)에 맞춰 요청을 보냅니다. 응답을 기다리지 않으므로 처리가 밀리면
+    작업자 풀 앞에 대기열이 생기고, 그 대기 시간이 지연 시간에 그대로 잡힙니다.
+    """
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        started = time.perf_counter()
+        for item, arrival in zip(traffic, arrivals):
+            scheduled = started + arrival
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(_execute, pipeline, item, scheduled, results)
+    return results
+
+
+# 결과 요약
+def _percentile(sorted_values: list, q: float):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def summarize(results: list, seconds: float, label: str, offered_qps: float = None):
+    latencies = sorted(result["latency"] for result in results)
+    services = sorted(result["service"] for result in results)
+    outcomes = Counter(result["outcome"] for result in results)
+    summary = {
+        "load": label,
+        "requests": len(results),
+        "seconds": seconds,
+        "offered_qps": offered_qps,
+        "achieved_qps": len(results) / seconds if seconds else None,
+        "outcomes": dict(outcomes),
+        "error_rate": outcomes.get("error", 0) / len(results) if results else None,
+    }
+    if latencies:
+        for name, q in (("p50", 0.50), ("p90", 0.90), ("p95", 0.95), ("p99", 0.99)):
+            summary[f"{name}_ms"] = _percentile(latencies, q) * 1000
+        summary["max_ms"] = latencies[-1] * 1000
+        summary["mean_ms"] = sum(latencies) / len(latencies) * 1000
+        summary["service_p50_ms"] = _percentile(services, 0.50) * 1000
+        summary["service_p95_ms"] = _percentile(services, 0.95) * 1000
+        summary["queue_p95_ms"] = _percentile(sorted(result["queue"] for result in results), 0.95) * 1000
+    errors = Counter(result["error"] for result in results if result["error"] and result["outcome"] == "error")
+    if errors:
+        summary["top_errors"] = errors.most_common(3)
+    return summary
+
+
+def print_summary(summary: dict):
+    offered = f"{summary['offered_qps']:.2f}" if summary["offered_qps"] else "-"
+    print(f"\n[{summary['load']}] {summary['requests']}건 / {summary['seconds']:.2f}s  "
+          f"offered {offered} q/s  achieved {summary['achieved_qps']:.2f} q/s  outcomes {summary['outcomes']}")
+    if "p50_ms" in summary:
+        print(f"  latency ms  p50 {summary['p50_ms']:.1f}  p90 {summary['p90_ms']:.1f}  "
+              f"p95 {summary['p95_ms']:.1f}  p99 {summary['p99_ms']:.1f}  max {summary['max_ms']:.1f}")
+        print(f"  service p50 {summary['service_p50_ms']:.1f}  service p95 {summary['service_p95_ms']:.1f}  "
+              f"queue p95 {summary['queue_p95_ms']:.1f}")
+    for error, count in summary.get("top_errors", []):
+        print(f"  error x{count}: {error}")
+
+
+def print_stage_summary(rag_funcs):
+    summary = rag_funcs.span_histogram.summary()
+    if not summary:
+        return
+    print(f"\n{'stage':<40} {'count':>7} {'p50 ms':>9} {'p95 ms':>9}")
+    for name, stats in sorted(summary.items()):
+        print(f"{name:<40} {stats['count']:>7} {stats['p50'] * 1000:9.2f} {stats['p95'] * 1000:9.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="기록된/합성 요청을 RAG 파이프라인에 재생해서 처리량과 지연 시간 측정")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--log", help="요청 로그 JSONL (앱이 기록한 logs/requests.jsonl)")
+    source.add_argument("--synthetic", type=int, help="합성 검색어 수 (CSV의 제목명/장소명 + 일반 검색어)")
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--concurrency", type=int, nargs="+", help="닫힌 루프 동시 요청 수 (여러 개면 차례로 측정)")
+    load.add_argument("--qps", type=float, nargs="+", help="열린 루프 목표 초당 요청 수 (여러 개면 차례로 측정)")
+    load.add_argument("--recorded-timing", action="store_true", help="로그에 기록된 도착 간격 그대로 재생")
+    parser.add_argument("--speed", type=float, default=1.0, help="--recorded-timing 재생 배속")
+    parser.add_argument("--requests", type=int, help="보낼 요청 수 (기본: 로그/합성 검색어 수, 많으면 반복)")
+    parser.add_argument("--max-workers", type=int, default=64, help="열린 루프 작업자 스레드 수")
+    parser.add_argument("--fake", action="store_true", help="가짜 임베딩/가짜 LLM 사용 (API 키 불필요)")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="--fake LLM 응답 지연(초)")
+    parser.add_argument("--llm-slow-rate", type=float, default=0.0, help="--fake LLM이 느리게 응답할 확률")
+    parser.add_argument("--llm-slow-latency", type=float, default=0.0, help="느린 응답에 더해지는 지연(초)")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="--fake LLM 오류 확률")
+    parser.add_argument("--llm-deadline", type=float, help="LLMGuard 마감 시간(초). 주면 재시도/차단기/대체 답변 적용")
+    parser.add_argument("--hedge", action="store_true", help="--llm-deadline과 함께 p95 기준 헤지 요청 사용")
+    parser.add_argument("--answer-mode", choices=("llm", "retrieval"), default="llm",
+                        help="로그에 답변 방식이 없을 때 쓸 값")
+    parser.add_argument("--retrieval-mode", choices=("vector", "hybrid"), default="vector",
+                        help="로그에 검색 방식이 없을 때 쓸 값")
+    parser.add_argument("--answer-count", type=int, default=2)
+    parser.add_argument("--use-cache", action="store_true", help="답변 캐시 사용 (기본은 매번 새로 처리)")
+    parser.add_argument("--csv", default=SOURCE_CSV, help="제목 인덱스와 (--fake) 벡터 DB를 만들 CSV")
+    parser.add_argument("--workdir", default="./cache/replay", help="--fake 벡터 DB와 답변 캐시 경로")
+    parser.add_argument("--request-log", help="재생한 요청도 요청 로그로 남길 경로 (원본 로그와 다른 파일로)")
+    parser.add_argument("--out", help="결과 JSON 저장 경로")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args(argv)
+
+    if args.fake:
+        os.environ.setdefault("GOOGLE_API_KEY", "replay")
+    os.makedirs(args.workdir, exist_ok=True)
+    import rag_funcs
+    rag_funcs.configure_logging(args.log_level)
+    if args.request_log:
+        if args.log and os.path.abspath(args.request_log) == os.path.abspath(args.log):
+            raise SystemExit("--request-log는 재생하는 로그와 다른 파일이어야 합니다.")
+        rag_funcs.enable_query_log(args.request_log)
+
+    traffic = load_traffic(args)
+    traffic = expand_traffic(traffic, args.requests or len(traffic))
+    pipeline = Pipeline(args)
+    # 체인 구성/첫 호출 준비 비용은 측정에서 제외
+    for key in {(item["answer_mode"], item["retrieval_mode"]) for item in traffic}:
+        pipeline.chain(*key)
+    pipeline.run(traffic[0])
+
+    runs = []
+    if args.recorded_timing:
+        if traffic[0]["offset"] is None:
+            raise SystemExit("--recorded-timing은 --log와 함께 써야 합니다.")
+        arrivals = [item["offset"] / args.speed for item in traffic]
+        offered = len(traffic) / arrivals[-1] if arrivals[-1] else None
+        runs.append((f"recorded x{args.speed:g}", lambda: run_open_loop(pipeline, traffic, arrivals, args.max_workers),
+                     offered))
+    elif args.qps:
+        for qps in args.qps:
+            arrivals = [i / qps for i in range(len(traffic))]
+            runs.append((f"qps={qps:g}", lambda arrivals=arrivals: run_open_loop(pipeline, traffic, arrivals,
+                                                                                 args.max_workers), qps))
+    else:
+        for concurrency in args.concurrency or [1]:
+            runs.append((f"concurrency={concurrency}",
+                         lambda concurrency=concurrency: run_closed_loop(pipeline, traffic, concurrency), None))
+
+    summaries = []
+    for label, run, offered in runs:
+        print(f"{label}: {len(traffic)}건 재생 중 ...", flush=True)
+        started = time.perf_counter()
+        results = run()
+        summaries.append(summarize(results, time.perf_counter() - started, label, offered))
+        print_summary(summaries[-1])
+    print_stage_summary(rag_funcs)
+    if pipeline.llm_guard is not None:
+        print(f"\nLLMGuard: {pipeline.llm_guard.report()}")
+
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "runs": summaries, "stages": rag_funcs.span_histogram.summary()},
+                      f, ensure_ascii=False, indent=2)
+        print(f"\n결과 저장: {args.out}")
+    return 1 if any(summary["error_rate"] for summary in summaries) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,276 @@
+"""
+오프라인 동작 확인 (GPU, 모델 다운로드, Gemini API 키 없이 실행)
+
+가짜 임베딩/가짜 LLM(fakes.py)으로 성능 수치가 아니라 동작이 맞는지를 확인합니다.
+확인 항목 하나라도 실패하면 종료 코드 1을 돌려줍니다. (배포 전, benchmark.py와 함께 실행)
+
+    batch_queries - run_rag_queries 결과가 입력 순서대로 오고, 실패가 그 항목에만 기록되며,
+                    같은 설정의 run_rag_query(체인)와 같은 맥락/답변이 나오는지 (벡터/필터/하이브리드)
+    llm_guard     - LLMGuard로 감싼 문서 체인이 마감 시간을 넘으면 대체 답변을 내고, 실패한 호출은 재시도하며,
+                    느린 첫 호출은 헤지 요청으로 대신하고, 연속 실패 시 회로 차단기가 열리는지
+    web_fetch     - 로컬 HTTP 서버로 fetch_web_pages가 처음엔 새로 받고(miss), 다시 받을 때
+                    Last-Modified / ETag 조건부 요청으로 재검증(304)하며, 404는 error 결과가 되는지
+
+사용 예:
+    python selfcheck.py
+    python selfcheck.py --checks batch_queries llm_guard web_fetch
+"""
+import argparse
+import os
+import shutil
+import sys
+import time
+import traceback
+
+DATA_FILE_PATH = "data/test_data_small.csv"
+COLLECTION_NAME = "selfcheck"
+CHECKS = ("batch_queries", "llm_guard", "web_fetch")
+BATCH_QUERIES = ["슬기로운 의사생활", "부산 영화 촬영지", "강릉 카페", "서울 병원 촬영지", "드라마 공원",
+                 "18 어게인", "부산 영화 촬영지", "영화 촬영지 식당", "바다가 보이는 카페", "서울 드라마 촬영지"]
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def expect(condition, message: str):
+    if not condition:
+        raise CheckFailed(message)
+
+
+def _load_fixture(workdir: str):
+    """확인용 벡터 DB(가짜 임베딩), 제목 인덱스, 필터 추출기를 준비합니다."""
+    import rag_funcs
+    import fakes
+
+    embeddings = fakes.HashEmbeddings()
+    db_path = os.path.join(workdir, "chroma")
+    shutil.rmtree(db_path, ignore_errors=True)
+    vector_db = rag_funcs.create_vector_db_with_hf(rag_funcs.load_csv_and_split_documents(DATA_FILE_PATH),
+                                                   db_path=db_path, collection_name=COLLECTION_NAME,
+                                                   embeddings=embeddings, embedding_cache_dir=None)
+    row_documents = rag_funcs.load_csv_documents(DATA_FILE_PATH)
+    title_index = rag_funcs.build_title_index(row_documents)
+    filter_extractor = rag_funcs.build_query_filter_extractor(row_documents, title_index=title_index)
+    return vector_db, title_index, filter_extractor
+
+
+def check_batch_queries(workdir: str):
+    import rag_funcs
+    import fakes
+
+    vector_db, title_index, filter_extractor = _load_fixture(workdir)
+    configs = {
+        "vector": {},
+        "filter": {"filter_extractor": filter_extractor},
+        "hybrid": {"retrieval_mode": "hybrid", "lexical_index": rag_funcs.build_lexical_index(vector_db),
+                   "filter_extractor": filter_extractor},
+    }
+    for name, config in configs.items():
+        # 응답 시간을 들쭉날쭉하게 해서 완료 순서가 입력 순서와 달라지게 하고, 첫 LLM 호출 한 건은 실패시킴
+        llm = fakes.FakeLocationLLM(slow_rate=0.5, slow_latency=0.02, fail_first=1)
+        batch = rag_funcs.run_rag_queries(BATCH_QUERIES, vector_db, llm=llm, concurrency=8,
+                                          requests_per_minute=None, title_index=title_index, **config)
+        expect(len(batch) == len(BATCH_QUERIES), f"[{name}] 결과 {len(batch)}개, 검색어 {len(BATCH_QUERIES)}개")
+        failed = [i for i, item in enumerate(batch) if item["error"] is not None]
+        expect(len(failed) == 1 and batch[failed[0]]["answer"] is None,
+               f"[{name}] 실패 항목이 한 건이어야 함 (실패 위치 {failed})")
+        expect("fake LLM error" in batch[failed[0]]["error"], f"[{name}] 실패 메시지: {batch[failed[0]]['error']}")
+
+        # 같은 설정의 단건 체인(실패 주입 없는 가짜 LLM)과 항목별로 비교
+        chain = rag_funcs.get_rag_chain_with_json_output(vector_db, title_index=title_index,
+                                                         llm=fakes.FakeLocationLLM(), **config)
+        for i, (query, item) in enumerate(zip(BATCH_QUERIES, batch)):
+            reference = chain.invoke({"input": query})
+            expect(item["query"] == query, f"[{name}] {i}번 결과의 검색어가 다름: {item['query']}")
+            expect([doc.page_content for doc in item["context"]] ==
+                   [doc.page_content for doc in reference["context"]],
+                   f"[{name}] {i}번 결과의 맥락이 run_rag_query와 다름")
+            if i not in failed:
+                expect(item["answer"] == reference["answer"], f"[{name}] {i}번 결과의 답변이 run_rag_query와 다름")
+
+
+def check_llm_guard(workdir: str):
+    import rag_funcs
+    import fakes
+
+    inputs = {"input": "슬기로운 의사생활", "context": rag_funcs.load_csv_documents(DATA_FILE_PATH)[:3]}
+    expected = rag_funcs.build_location_document_chain(fakes.FakeLocationLLM()).invoke(inputs)
+
+    def run(llm, guard):
+        started = time.perf_counter()
+        answer = rag_funcs.build_location_document_chain(llm, llm_guard=guard).invoke(inputs)
+        return answer, time.perf_counter() - started
+
+    # 마감 시간: 2초 걸리는 LLM을 0.5초에 끊고 검색된 행으로 대체 답변
+    answer, seconds = run(fakes.FakeLocationLLM(latency=2.0), rag_funcs.LLMGuard(deadline=0.5))
+    expect(isinstance(answer, rag_funcs.FallbackAnswer) and answer.reason == "deadline",
+           f"[deadline] 대체 답변이 아님: {answer!r}")
+    expect(len(answer) > 0, "[deadline] 대체 답변이 비어 있음")
+    expect(seconds < 1.0, f"[deadline] 마감 시간 0.5초인데 {seconds:.2f}초 걸림")
+
+    # 재시도: 첫 호출만 실패하면 두 번째 호출의 답변이 그대로 나옴
+    llm = fakes.FakeLocationLLM(fail_first=1)
+    guard = rag_funcs.LLMGuard(deadline=5.0, max_retries=2, backoff_base=0.01)
+    answer, _ = run(llm, guard)
+    expect(not isinstance(answer, rag_funcs.FallbackAnswer), f"[retry] 대체 답변이 나옴: {answer!r}")
+    expect(answer == expected, "[retry] 재시도한 답변이 LLMGuard 없는 체인과 다름")
+    expect(llm.calls == 2, f"[retry] LLM 호출 {llm.calls}번 (2번이어야 함)")
+    expect(guard.breaker.state == "closed", f"[retry] 성공 후 차단기 상태: {guard.breaker.state}")
+
+    # 헤지: 최근 응답 시간(p95 0.05초)보다 늦는 첫 호출 대신 헤지 요청의 답변을 씀
+    llm = fakes.FakeLocationLLM(slow_first=1, slow_latency=2.0)
+    guard = rag_funcs.LLMGuard(deadline=5.0, hedge=True, hedge_min_samples=1)
+    guard.record_latency(0.05)
+    answer, seconds = run(llm, guard)
+    expect(answer == expected, f"[hedge] 헤지한 답변이 LLMGuard 없는 체인과 다름: {answer!r}")
+    expect(llm.calls == 2, f"[hedge] LLM 호출 {llm.calls}번 (헤지 포함 2번이어야 함)")
+    expect(seconds < 1.0, f"[hedge] 느린 첫 호출(2초)을 기다림: {seconds:.2f}초")
+
+    # 회로 차단기: 연속 3번 실패하면 열리고, 그 뒤로는 LLM을 호출하지 않고 대체 답변
+    llm = fakes.FakeLocationLLM(error_rate=1.0)
+    guard = rag_funcs.LLMGuard(deadline=5.0, max_retries=0,
+                               breaker=rag_funcs.CircuitBreaker(failure_threshold=3, reset_timeout=60.0))
+    for i in range(3):
+        answer, _ = run(llm, guard)
+        expect(isinstance(answer, rag_funcs.FallbackAnswer) and answer.reason == "error",
+               f"[breaker] {i + 1}번째 실패의 답변: {answer!r}")
+    expect(guard.breaker.state == "open", f"[breaker] 연속 3번 실패 후 차단기 상태: {guard.breaker.state}")
+    answer, _ = run(llm, guard)
+    expect(isinstance(answer, rag_funcs.FallbackAnswer) and answer.reason == "circuit_open",
+           f"[breaker] 차단기가 열린 뒤의 답변: {answer!r}")
+    expect(llm.calls == 3, f"[breaker] 차단기가 열린 뒤에도 LLM을 호출함 (호출 {llm.calls}번)")
+
+
+def _serve_pages(pages: dict):
+    """
+    pages({경로: {"body", "etag" 또는 "last_modified"}})를 돌려주는 로컬 HTTP 서버를 스레드로 띄웁니다.
+    http.server는 ETag/조건부 요청을 처리하지 않으므로 직접 304를 보냅니다. 없는 경로는 404.
+
+    Returns:
+        tuple: (서버, 기본 URL, 받은 요청 리스트 [(경로, 조건부 헤더 dict, 응답 코드)])
+    """
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            page = pages.get(self.path)
+            conditions = {key: self.headers[key] for key in ("If-None-Match", "If-Modified-Since")
+                          if self.headers[key] is not None}
+            if page is None:
+                status = 404
+            elif (page.get("etag") and conditions.get("If-None-Match") == page["etag"]) or \
+                    (page.get("last_modified") and conditions.get("If-Modified-Since") == page["last_modified"]):
+                status = 304
+            else:
+                status = 200
+            requests_seen.append((self.path, conditions, status))
+            self.send_response(status)
+            if page is not None:
+                if page.get("etag"):
+                    self.send_header("ETag", page["etag"])
+                if page.get("last_modified"):
+                    self.send_header("Last-Modified", page["last_modified"])
+            body = page["body"].encode("utf-8") if status == 200 else b""
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}", requests_seen
+
+
+def check_web_fetch(workdir: str):
+    import rag_funcs
+
+    pages = {
+        "/last-modified.html": {"body": "<p>부산 촬영지</p>", "last_modified": "Wed, 01 Jan 2025 00:00:00 GMT"},
+        "/etag.html": {"body": "<p>강릉 카페</p>", "etag": '"v1"'},
+    }
+    server, base, requests_seen = _serve_pages(pages)
+    try:
+        shutil.rmtree(workdir, ignore_errors=True)
+        cache = rag_funcs.WebPageCache(workdir)
+        urls = [base + "/last-modified.html", base + "/etag.html", base + "/missing.html"]
+
+        def fetch(**kwargs):
+            requests_seen.clear()
+            results = rag_funcs.fetch_web_pages(urls, cache=cache, timeout=5.0, **kwargs)
+            expect([result.url for result in results] == urls, "결과가 URL 순서가 아님")
+            return results, {path: (conditions, status) for path, conditions, status in requests_seen}
+
+        # 처음: 캐시가 비어 있으므로 새로 받음, 404는 error
+        results, seen = fetch()
+        expect([result.cache_status for result in results] == ["miss", "miss", "error"],
+               f"[첫 요청] cache_status: {[result.cache_status for result in results]}")
+        expect(results[0].body == pages["/last-modified.html"]["body"].encode("utf-8"), "[첫 요청] 본문이 다름")
+        expect(results[2].status == 404 and results[2].body is None and results[2].error == "HTTP 404",
+               f"[404] 결과: status={results[2].status} error={results[2].error}")
+        expect(all(not conditions for conditions, _ in seen.values()), f"[첫 요청] 조건부 헤더를 보냄: {seen}")
+
+        # 다시: Last-Modified / ETag 조건부 요청으로 304를 받고 캐시 본문을 씀
+        results, seen = fetch()
+        expect([result.cache_status for result in results] == ["revalidated", "revalidated", "error"],
+               f"[재검증] cache_status: {[result.cache_status for result in results]}")
+        expect(seen["/last-modified.html"] == ({"If-Modified-Since": pages["/last-modified.html"]["last_modified"]},
+                                               304), f"[재검증] Last-Modified 요청: {seen['/last-modified.html']}")
+        expect(seen["/etag.html"] == ({"If-None-Match": '"v1"'}, 304), f"[재검증] ETag 요청: {seen['/etag.html']}")
+        expect(results[1].body == pages["/etag.html"]["body"].encode("utf-8"), "[재검증] 캐시 본문이 다름")
+
+        # 페이지가 바뀌면(ETag 변경) 200으로 새 본문을 받음
+        pages["/etag.html"] = {"body": "<p>강릉 바다 카페</p>", "etag": '"v2"'}
+        results, seen = fetch()
+        expect(results[1].cache_status == "miss" and results[1].body == pages["/etag.html"]["body"].encode("utf-8"),
+               f"[변경] ETag가 바뀐 페이지: {results[1].cache_status}")
+        expect(results[1].meta["etag"] == '"v2"', f"[변경] 캐시에 저장된 ETag: {results[1].meta['etag']}")
+
+        # max_age 안이면 요청 없이 캐시 사용 (404는 캐시에 없으므로 다시 요청)
+        results, seen = fetch(max_age=60.0)
+        expect([result.cache_status for result in results] == ["fresh", "fresh", "error"],
+               f"[max_age] cache_status: {[result.cache_status for result in results]}")
+        expect(list(seen) == ["/missing.html"], f"[max_age] 캐시가 있는데 요청을 보냄: {list(seen)}")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="가짜 모델로 RAG 동작 확인")
+    parser.add_argument("--checks", nargs="+", choices=CHECKS, default=list(CHECKS))
+    parser.add_argument("--workdir", default="./cache/selfcheck", help="확인용 벡터 DB 경로")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("GOOGLE_API_KEY", "selfcheck")
+    import rag_funcs
+    rag_funcs.configure_logging(args.log_level)
+
+    failures = 0
+    for name in CHECKS:
+        if name not in args.checks:
+            continue
+        started = time.perf_counter()
+        try:
+            globals()[f"check_{name}"](os.path.join(args.workdir, name))
+        except CheckFailed as e:
+            failures += 1
+            print(f"FAIL  {name}: {e}")
+        except Exception:
+            failures += 1
+            print(f"ERROR {name}")
+            traceback.print_exc()
+        else:
+            print(f"ok    {name} ({time.perf_counter() - started:.2f}s)")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())